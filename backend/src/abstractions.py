@@ -1,10 +1,70 @@
 '''
     This file contains abstractions for working with the JSON files.
 '''
-import json
+import bisect
+import contextlib
+import copy
 import datetime
+import functools
 import os
-from error import DataError
+import threading
+import uuid
+import config
+import datastore
+import journal
+import serializers
+import sqlite_store
+from error import ConflictError, DataError
+
+# How each data file is laid out: file name -> (records key, id key)
+LAYOUTS = {
+    "channels": ("channels", "channel_id"),
+    "users": ("users", "user_id"),
+    "messages": ("messages", "message_id"),
+    "standups": ("standups", "standup_id"),
+    "hangman": ("hangmen", "hangman_id"),
+}
+
+# Data files that are written through a journal rather than rewritten
+JOURNALED = ("channels", "messages", "standups")
+
+# Data files split into one file per value of a field: file name -> field
+SHARDED = {
+    "messages": "channel_id",
+}
+
+# Fields that get looked up often enough to be indexed
+INDEXES = {
+    "users": ("email", "handle"),
+    "messages": ("channel_id", "author_id"),
+}
+
+# List fields that are indexed by each of their items, eg. to find the
+# channels a user is in
+LIST_INDEXES = {
+    "channels": ("user_member_ids", "owner_member_ids"),
+}
+
+# Text fields that are indexed for searching
+TEXT_INDEXES = {
+    "messages": ("content",),
+}
+
+# Indexed fields that no two records can share (unless they are empty,
+# eg. a handle that hasn't been set yet)
+UNIQUE = {
+    "users": ("email", "handle"),
+}
+
+# How many times retry_on_conflict runs a function before giving up
+CONFLICT_ATTEMPTS = 5
+
+# The in-memory store, created the first time it is needed
+STORE = None
+
+# The records each thread has read during its current request, and how
+# many reads they have saved (see start_request)
+IDENTITY_MAP = threading.local()
 
 
 def get_path():
@@ -20,9 +80,128 @@ def get_file_directory(file_name):
     '''
     Return a file dirctory when the file name is passed in
     '''
-    return os.path.join(get_path(), f"{file_name}.json")
+    extension = serializers.get_serializer(config.STORAGE_FORMAT).extension
+    return os.path.join(get_path(), f"{file_name}{extension}")
 
 
+def create_store(backend: str):
+    '''
+    Create the store for the named backend, either "json" or "sqlite"
+    '''
+    serializer = serializers.get_serializer(config.STORAGE_FORMAT)
+    if backend == "json":
+        store = datastore.Store(get_path(), LAYOUTS, serializer, JOURNALED, SHARDED,
+                                INDEXES, LIST_INDEXES, TEXT_INDEXES)
+        # Finish off a commit that was interrupted by a crash
+        store.recover()
+        return store
+    if backend == "sqlite":
+        return sqlite_store.SqliteStore(os.path.join(get_path(), "slackr.db"), LAYOUTS,
+                                        serializer, INDEXES, LIST_INDEXES, TEXT_INDEXES)
+    raise ValueError(f"Unknown storage backend {backend}")
+
+
+def use_backend(backend: str):
+    '''
+    Switch the store to the named backend
+    '''
+    global STORE                                    # pylint: disable=W0603
+    STORE = create_store(backend)
+    return STORE
+
+
+def get_store():
+    '''
+    Return the store, creating it with the configured backend if this is
+    the first call
+    '''
+    if STORE is None:
+        use_backend(config.STORAGE_BACKEND)
+    return STORE
+
+
+def start_checkpointer():
+    '''
+    Start the background thread that folds journals into their data files.
+    Only needs to be called by the server.
+    '''
+    # Load the journaled collections now so recovery happens at startup
+    for collection in get_store().journaled_collections():
+        collection.data()
+    return journal.start_checkpointer(get_store().journaled_collections)
+
+
+def checkpoint_all():
+    '''
+    Fold every journal into its data file
+    '''
+    for collection in get_store().journaled_collections():
+        collection.checkpoint()
+
+
+def get_collection(file_name):
+    '''
+    Return the in-memory collection for a data file.
+    The file is only read from disk the first time or if it has changed.
+    '''
+    return get_store().collection(file_name)
+
+
+def synchronised(function):
+    '''
+    Decorator so that only one thread at a time works with the store.
+    Changes are committed once the lock has been let go, together with
+    those of any other threads that were changing the store at the time.
+    '''
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        store = get_store()
+        with store.group_commit(), store.lock:
+            return function(*args, **kwargs)
+    return wrapper
+
+
+@contextlib.contextmanager
+def transaction():
+    '''
+    Context manager for changes to several records (in any of the data
+    files) that must be written all together or not at all, eg. a new
+    message and the channel's list of messages.
+    Nothing is written until the with block ends, and a crash while
+    writing is finished off when the store is next created. If an
+    exception is raised, every change made inside it is thrown away.
+    '''
+    store = get_store()
+    try:
+        with store.transaction(), store.lock:
+            yield
+    except BaseException:
+        # The identity map may hold records as they were changed
+        if getattr(IDENTITY_MAP, 'records', None) is not None:
+            IDENTITY_MAP.records = {}
+        raise
+
+
+def retry_on_conflict(function):
+    '''
+    Decorator for functions that read records, change them and update
+    them. If a record was updated by someone else in between (so the
+    update raises ConflictError), the whole function is run again with
+    fresh data. Everything before the update must be safe to repeat.
+    '''
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        for attempt in range(CONFLICT_ATTEMPTS):
+            try:
+                return function(*args, **kwargs)
+            except ConflictError:
+                if attempt == CONFLICT_ATTEMPTS - 1:
+                    raise
+        return None
+    return wrapper
+
+
+@synchronised
 def setup_channels_json():
     '''
     Sets up the channels json file to have the correct structure.
@@ -30,14 +209,15 @@ def setup_channels_json():
     '''
     channels_structure = {
         "latest_channel_id": 0,
-        "channel_ids": [],
-        "channels": []
+        # Tells the channels made after this reset apart from those made
+        # before it, which had the same ids (see get_channel_generations)
+        "reset_id": uuid.uuid4().hex,
+        "channels": {}
     }
-    with open(get_file_directory('channels'), 'w') as f:
-        json.dump(channels_structure, f, sort_keys=True,
-                  indent=4, separators=(',', ': '))
+    get_collection('channels').reset(channels_structure)
 
 
+@synchronised
 def setup_users_json():
     '''
     Sets up the users json file to have the correct structure.
@@ -45,14 +225,12 @@ def setup_users_json():
     '''
     users_structure = {
         "latest_user_id": 0,
-        "user_ids": [],
-        "users": []
+        "users": {}
     }
-    with open(get_file_directory('users'), 'w') as f:
-        json.dump(users_structure, f, sort_keys=True,
-                  indent=4, separators=(',', ': '))
+    get_collection('users').reset(users_structure)
 
 
+@synchronised
 def setup_messages_json():
     '''
     Sets up the messages json file to have the correct structure.
@@ -60,15 +238,13 @@ def setup_messages_json():
     '''
     messages_structure = {
         "latest_message_id": 0,
-        "message_ids": [],
-        "messages": [],
+        "messages": {},
         "unsent_message_ids": []
     }
-    with open(get_file_directory('messages'), 'w') as f:
-        json.dump(messages_structure, f, sort_keys=True,
-                  indent=4, separators=(',', ': '))
+    get_collection('messages').reset(messages_structure)
 
 
+@synchronised
 def setup_standups_json():
     '''
     Sets up the standups json file to have the correct structure.
@@ -76,14 +252,12 @@ def setup_standups_json():
     '''
     standups_structure = {
         "latest_standup_id": 0,
-        "standup_ids": [],
-        "standups": []
+        "standups": {}
     }
-    with open(get_file_directory('standups'), 'w') as f:
-        json.dump(standups_structure, f, sort_keys=True,
-                  indent=4, separators=(',', ': '))
+    get_collection('standups').reset(standups_structure)
 
 
+@synchronised
 def setup_hangman_json():
     '''
     Sets up the hangman json file to have the correct structure.
@@ -91,27 +265,257 @@ def setup_hangman_json():
     '''
     hangman_structure = {
         "latest_hangman_id": 0,
-        "hangman_ids": [],
-        "hangmen": []
+        "hangmen": {}
     }
-    with open(get_file_directory('hangman'), 'w') as f:
-        json.dump(hangman_structure, f, sort_keys=True,
-                  indent=4, separators=(',', ': '))
+    get_collection('hangman').reset(hangman_structure)
+
+
+def start_request():
+    '''
+    Start an identity map for this thread's request. Until end_request(),
+    reading a record again hands back the copy that was read the first
+    time instead of going back to the store.
+    '''
+    IDENTITY_MAP.records = {}
+    IDENTITY_MAP.saved = 0
+
+
+def end_request():
+    '''
+    Drop this thread's identity map.
+    Returns how many reads it saved.
+    '''
+    saved = reads_saved()
+    IDENTITY_MAP.records = None
+    IDENTITY_MAP.saved = 0
+    return saved
+
+
+def reads_saved():
+    '''
+    Returns how many reads this thread's identity map has saved so far
+    '''
+    return getattr(IDENTITY_MAP, 'saved', 0)
+
+
+def remember_record(file_name: str, record_id: int, record: dict = None):
+    '''
+    Replace (or, if record is None, forget) a record in this thread's
+    identity map once it has been written
+    '''
+    records = getattr(IDENTITY_MAP, 'records', None)
+    if records is None:
+        return
+    if record is None:
+        records.pop((file_name, int(record_id)), None)
+    else:
+        records[(file_name, int(record_id))] = record
+
+
+def get_record(file_name: str, record_id: int):
+    '''
+    Gets a copy of the record with record_id from a data file.
+    Returns None if a matching record is not found.
+    During a request the same copy is handed back every time.
+    '''
+    records = getattr(IDENTITY_MAP, 'records', None)
+    key = (file_name, int(record_id))
+    if records is not None and key in records:
+        IDENTITY_MAP.saved += 1
+        return records[key]
+    record = get_collection(file_name).get(record_id)
+    # Hand back a copy so callers can't change the stored data
+    record = copy.deepcopy(record)
+    if records is not None and record is not None:
+        records[key] = record
+    return record
+
+
+def get_records(file_name: str, record_ids: list):
+    '''
+    Gets copies of the records with the given record_ids from a data file,
+    in the same order, reading the file once for all of them.
+    Any that are not found are None.
+    '''
+    records = getattr(IDENTITY_MAP, 'records', None)
+    keys = [(file_name, int(record_id)) for record_id in record_ids]
+    missing = [key[1] for key in keys if records is None or key not in records]
+    found = dict(zip(missing, get_collection(file_name).get_many(missing)))
+    result = []
+    for key in keys:
+        if records is not None and key in records:
+            IDENTITY_MAP.saved += 1
+            result.append(records[key])
+            continue
+        # Hand back a copy so callers can't change the stored data
+        record = copy.deepcopy(found[key[1]])
+        if records is not None and record is not None:
+            records[key] = record
+        result.append(record)
+    return result
+
+
+def check_unique(file_name: str, record_id: int, fields: dict):
+    '''
+    Raises DataError if another record already has one of the values in
+    fields that must be unique (see UNIQUE)
+    '''
+    collection = get_collection(file_name)
+    for field in UNIQUE.get(file_name, ()):
+        if not fields.get(field):
+            continue
+        if any(other != int(record_id) for other in collection.find(field, fields[field])):
+            raise DataError
+
+
+def update_record(file_name: str, record_id: int, record_data: dict):
+    '''
+    Replaces the record with record_id in a data file.
+    Returns None if a matching record is not found.
+    If record_data has a version (ie. it was read with get_record) and the
+    record has been updated since, ConflictError is raised instead.
+    '''
+    collection = get_collection(file_name)
+    # Verify that the id is not being updated.
+    if int(record_id) != record_data[collection.id_key]:
+        raise DataError
+    check_unique(file_name, record_id, record_data)
+    record = copy.deepcopy(record_data)
+    version = record.get('version')
+    if version is None:
+        # Nothing to compare against, so replace whatever is stored
+        current = collection.get(record_id)
+        if current is None:
+            return None
+        version = current.get('version', 0)
+    record['version'] = version + 1
+    result = collection.swap(record, version)
+    if result is not True:
+        # Read it again next time
+        remember_record(file_name, record_id)
+    if result is False:
+        raise ConflictError
+    if result:
+        # The copy that was written is what the store now has
+        remember_record(file_name, record_id, copy.deepcopy(record))
+    return result
+
+
+def change_record(file_name: str, record_id: int, change: dict):
+    '''
+    Applies a field level change (see datastore.apply_change) to the
+    record with record_id, without reading or writing the whole record.
+    Returns None if a matching record is not found.
+    '''
+    collection = get_collection(file_name)
+    changed = change['fields'] if change['op'] == 'patch' else (change['field'],)
+    # Verify that the id (or the field the file is split up by) is not being changed.
+    if collection.id_key in changed or SHARDED.get(file_name) in changed:
+        raise DataError
+    if change['op'] == 'patch':
+        check_unique(file_name, record_id, change['fields'])
+    remember_record(file_name, record_id)
+    # The store keeps the values it is given
+    return collection.change(record_id, copy.deepcopy(change))
+
+
+def delete_record(file_name: str, record_id: int):
+    '''
+    Removes the record with record_id from a data file.
+    Returns None if a matching record is not found.
+    '''
+    remember_record(file_name, record_id)
+    return get_collection(file_name).delete(record_id)
+
+
+def patch_record(file_name: str, record_id: int, fields: dict):
+    '''
+    Sets only the given fields of the record with record_id.
+    Returns None if a matching record is not found.
+    '''
+    return change_record(file_name, record_id, {"op": "patch", "fields": fields})
+
+
+@synchronised
+def append_to(file_name: str, record_id: int, field: str, value):
+    '''
+    Appends value to the list in field of the record with record_id.
+    Returns None if a matching record is not found.
+    '''
+    return change_record(file_name, record_id,
+                         {"op": "append", "field": field, "value": value})
+
+
+@synchronised
+def remove_from(file_name: str, record_id: int, field: str, value):
+    '''
+    Removes value from the list in field of the record with record_id,
+    if it is there.
+    Returns None if a matching record is not found.
+    '''
+    return change_record(file_name, record_id,
+                         {"op": "remove", "field": field, "value": value})
+
+
+@synchronised
+def get_field(file_name: str, record_id: int, field: str, default=None):
+    '''
+    Gets a copy of one field of the record with record_id (default if it
+    doesn't have it), without copying the rest of the record.
+    Returns None if a matching record is not found.
+    '''
+    record = get_collection(file_name).get(record_id)
+    if record is None:
+        return None
+    return copy.deepcopy(record.get(field, default))
+
+
+@synchronised
+def get_entries_since(file_name: str, record_id: int, field: str, seq: int):
+    '''
+    Gets copies of the entries after seq in the list in field of the
+    record with record_id, which holds [seq, ...] entries in seq order,
+    without copying the rest of the list or the record.
+    Returns None if a matching record (or the field) is not found.
+    '''
+    record = get_collection(file_name).get(record_id)
+    if record is None or field not in record:
+        return None
+    entries = record[field]
+    return copy.deepcopy(entries[bisect.bisect_right(entries, [seq, float('inf')]):])
+
+
+@synchronised
+def in_list(file_name: str, record_id: int, field: str, value):
+    '''
+    Returns whether value is in the list in field of the record with
+    record_id, without copying the record.
+    Returns False if a matching record is not found.
+    '''
+    record = get_collection(file_name).get(record_id)
+    return record is not None and value in record.get(field, [])
+
+
+@synchronised
+def increment(file_name: str, record_id: int, field: str, amount: int = 1):
+    '''
+    Adds amount to the number in field of the record with record_id.
+    Returns None if a matching record is not found.
+    '''
+    return change_record(file_name, record_id,
+                         {"op": "increment", "field": field, "amount": amount})
 
 
+@synchronised
 def create_channel(channel_name: str, private: bool, creator_id: int):
     '''
     Creates a channel with given channel_name, privacy status.
     The creator will be the user with u_id == creator_id.
     Returns the channel_id of the newly created channel.
     '''
-    # Load the data
-    with open(get_file_directory('channels'), 'r') as f:
-        current_data = json.load(f)
-    # Get the current maximum channel id
-    latest_channel_id = current_data['latest_channel_id']
+    channels = get_collection('channels')
     # Get the new maximum channel id
-    new_channel_id = latest_channel_id + 1
+    new_channel_id = channels.next_id()
     # Create the channel dictionary
     channel_dict = {
         "channel_id": new_channel_id,
@@ -124,113 +528,148 @@ def create_channel(channel_name: str, private: bool, creator_id: int):
         "standup_id": None,
         "hangman_id": None,
         "message_ids": [],
+        "message_seqs": [],
+        "change_seq": 0,
+        "changed_messages": [],
+        "removed_messages": [],
+        "version": 1,
     }
-    # Increment the maximum channel id
-    current_data['latest_channel_id'] = new_channel_id
-    # Add the new channel ID to the list of channel_ids
-    current_data['channel_ids'].append(new_channel_id)
-    # Add the channel dictionary to the list of channels
-    current_data['channels'].append(channel_dict)
-    # Save the data
-    with open(get_file_directory('channels'), 'w') as f:
-        json.dump(current_data, f, sort_keys=True,
-                  indent=4, separators=(',', ': '))
+    # Save the channel
+    channels.put(channel_dict)
     # Return the new channel_id
     return new_channel_id
 
 
+@synchronised
+def next_change_seq(channel_id: int):
+    '''
+    Moves the channel's change sequence on by one and returns the new
+    number, which is higher than any given out for the channel before.
+    Returns None if a matching channel is not found.
+    '''
+    with transaction():
+        if increment('channels', channel_id, 'change_seq') is None:
+            return None
+        # Nothing else can change it until the transaction ends
+        return get_field('channels', channel_id, 'change_seq')
+
+
+def message_positions(channel: dict):
+    '''
+    Returns the positions of a channel's messages, in the same order as
+    its message_ids: the change sequence number each was added with, kept
+    in message_seqs. Messages added before those were kept are numbered
+    up to 0.
+    '''
+    message_seqs = channel.get('message_seqs', [])
+    unnumbered = len(channel['message_ids']) - len(message_seqs)
+    if unnumbered:
+        return list(range(-unnumbered, 0)) + message_seqs
+    return message_seqs
+
+
+@synchronised
+def get_channel_page(channel_id: int, before: int, count: int):
+    '''
+    Gets the last count messages added to the channel before position
+    before (or the newest count, if it is None), as [position, message_id]
+    pairs, newest first, without copying the rest of the channel.
+    A message that has been removed still marks the same place.
+    Returns None if a matching channel is not found.
+    '''
+    channel = get_collection('channels').get(channel_id)
+    if channel is None:
+        return None
+    positions = message_positions(channel)
+    finish = len(positions) if before is None else bisect.bisect_left(positions, before)
+    start = max(finish - count, 0)
+    page = [list(pair) for pair in zip(positions[start:finish],
+                                       channel['message_ids'][start:finish])]
+    page.reverse()
+    return page
+
+
+@synchronised
+def get_channel_message_position(channel_id: int, message_id: int):
+    '''
+    Gets the position a message was added to its channel at (see
+    message_positions).
+    Returns None if the channel is not found or the message isn't in it.
+    '''
+    channel = get_collection('channels').get(channel_id)
+    if channel is None:
+        return None
+    try:
+        index = channel['message_ids'].index(int(message_id))
+    except ValueError:
+        return None
+    return message_positions(channel)[index]
+
+
+@synchronised
+def get_channel_generations(channel_ids: list):
+    '''
+    Returns something that changes whenever a message in any of the given
+    channels is sent, changed or removed: their change sequences (None
+    for a channel that is not found), and which reset they are from.
+    '''
+    channels = get_collection('channels')
+    # Only one field of each is needed, so they aren't copied
+    return (channels.get_meta('reset_id'), tuple(
+        None if channel is None else channel.get('change_seq', 0)
+        for channel in channels.get_many(channel_ids)
+    ))
+
+
+@synchronised
 def get_channel(channel_id: int):
     '''
     Gets a channel with given channel_id.
     Returns None if a matching channel is not found.
     '''
-    # Load the data
-    with open(get_file_directory('channels'), 'r') as f:
-        current_data = json.load(f)
-    # Check to see if a channel exists with that id
-    if int(channel_id) not in current_data['channel_ids']:
-        return None
-    for channel in current_data['channels']:
-        if channel['channel_id'] == int(channel_id):
-            return channel
+    return get_record('channels', channel_id)
 
 
+@synchronised
 def update_channel(channel_id: int, channel_data: dict):
     '''
     Updates a channel with given channel_id.
     This will replace all stored channel data for that channel.
     Returns None if the channel could not be updated.
     '''
-    # Verify that the channel_id is not being updated.
-    if int(channel_id) != channel_data["channel_id"]:
-        raise DataError
-        return
-    # Load the data
-    with open(get_file_directory('channels'), 'r') as f:
-        current_data = json.load(f)
-    # Check to see if a channel exists with that id
-    if int(channel_id) not in current_data['channel_ids']:
-        return None
+    return update_record('channels', channel_id, channel_data)
 
-    # Iterate through the channels
-    for channel_index in range(len(current_data['channels'])):
-        # Check for a match
-        if current_data['channels'][channel_index]['channel_id'] == channel_data['channel_id']:
-            # Replace the current data with the new data
-            current_data['channels'][channel_index] = channel_data
-            break
 
-    # Save the data
-    with open(get_file_directory('channels'), 'w') as f:
-        json.dump(current_data, f, sort_keys=True,
-                  indent=4, separators=(',', ': '))
+@synchronised
+def patch_channel(channel_id: int, fields: dict):
+    '''
+    Updates only the given fields of a channel with the given channel_id.
+    Returns None if a matching channel is not found.
+    '''
+    return patch_record('channels', channel_id, fields)
 
 
+@synchronised
 def delete_channel(channel_id: int):
     '''
     Deletes a channel with given channel_id.
     Returns None if the channel was not found.
     '''
-    # Load the data
-    with open(get_file_directory('channels'), 'r') as f:
-        current_data = json.load(f)
-    # Check to see if a channel exists with that id
-    if int(channel_id) not in current_data['channel_ids']:
-        return None
-
-    # Typecast channel_id to be an int
-    channel_id = int(channel_id)
-
-    # Remove the channel_id from the list of channel ids
-    channel_ids = current_data['channel_ids']
-    channel_ids.remove(channel_id)
-    # Iterate through the channels and find the channel
-    for channel in current_data['channels']:
-        # Check for a match
-        if channel['channel_id'] == channel_id:
-            # Remove the channel
-            current_data['channels'].remove(channel)
-            break
-    # Save the data
-    with open(get_file_directory('channels'), 'w') as f:
-        json.dump(current_data, f, sort_keys=True,
-                  indent=4, separators=(',', ': '))
-    return True
+    return delete_record('channels', channel_id)
 
 
+@synchronised
 def create_user(firstname: str, lastname: str, email: str, password: str):
     '''
     Creates a user with given firstname, lastname, email and password.
     By default this user will not be logged in or have a handle.
     Returns the user_id of the newly created user.
+    Raises DataError if another user already has the email.
     '''
-    # Load the data
-    with open(get_file_directory('users'), 'r') as f:
-        current_data = json.load(f)
-    # Get the current maximum user id
-    latest_user_id = current_data['latest_user_id']
+    users = get_collection('users')
+    check_unique('users', 0, {"email": email})
     # Get the new maximum user id
-    new_user_id = latest_user_id + 1
+    new_user_id = users.next_id()
     # Create the user dictionary
     user_dict = {
         "user_id": new_user_id,
@@ -244,100 +683,84 @@ def create_user(firstname: str, lastname: str, email: str, password: str):
         "profile_pic_url": "default.jpg",
         "permission_level": 2,
         "reset_code": False,
+        "version": 1,
     }
-    # Increment the maximum user id
-    current_data['latest_user_id'] = new_user_id
-    # Add the new user ID to the list of user_ids
-    current_data['user_ids'].append(new_user_id)
-    # Add the user dictionary to the list of users
-    current_data['users'].append(user_dict)
-    # Save the data
-    with open(get_file_directory('users'), 'w') as f:
-        json.dump(current_data, f, sort_keys=True,
-                  indent=4, separators=(',', ': '))
+    # Save the user
+    users.put(user_dict)
     # Return the new user_id
     return new_user_id
 
 
+@synchronised
 def get_user(user_id: int):
     '''
     Gets a user with given user_id.
     Returns None if the user is not found.
     '''
-    # Load the data
-    with open(get_file_directory('users'), 'r') as f:
-        current_data = json.load(f)
-    # Check to see if a user exists with that id
-    if int(user_id) not in current_data['user_ids']:
+    return get_record('users', user_id)
+
+
+@synchronised
+def get_user_by_email(email: str):
+    '''
+    Gets the user with the given email.
+    Returns None if no user has that email.
+    '''
+    user_ids = get_collection('users').find('email', email)
+    if not user_ids:
         return None
-    for user in current_data['users']:
-        if user['user_id'] == int(user_id):
-            return user
+    return get_record('users', user_ids[0])
 
 
+@synchronised
+def get_user_by_handle(handle: str):
+    '''
+    Gets the user with the given handle.
+    Returns None if no user has that handle.
+    '''
+    user_ids = get_collection('users').find('handle', handle)
+    if not user_ids:
+        return None
+    return get_record('users', user_ids[0])
+
+
+@synchronised
+def count_users():
+    '''
+    Returns how many users there are
+    '''
+    return get_collection('users').count()
+
+
+@synchronised
 def update_user(user_id: int, user_data: dict):
     '''
     Updates a user with the given user_id.
     This will replace all stored user data for that user.
     Returns None if a matching user is not found.
     '''
-    # Verify that the user_id is not being updated.
-    if int(user_id) != user_data["user_id"]:
-        raise DataError
-        return
-    # Load the data
-    with open(get_file_directory('users'), 'r') as f:
-        current_data = json.load(f)
-    # Check to see if a user exists with that id
-    if int(user_id) not in current_data['user_ids']:
-        return None
+    return update_record('users', user_id, user_data)
 
-    # Iterate through the users
-    for user_index in range(len(current_data['users'])):
-        # Check for a match
-        if current_data['users'][user_index]['user_id'] == user_data['user_id']:
-            # Replace the current data with the new data
-            current_data['users'][user_index] = user_data
-            break
 
-    # Save the data
-    with open(get_file_directory('users'), 'w') as f:
-        json.dump(current_data, f, sort_keys=True,
-                  indent=4, separators=(',', ': '))
+@synchronised
+def patch_user(user_id: int, fields: dict):
+    '''
+    Updates only the given fields of an user with the given user_id.
+    Returns None if a matching user is not found.
+    '''
+    return patch_record('users', user_id, fields)
 
 
+@synchronised
 def delete_user(user_id: int):
     '''
     Deletes a user with given user_id.
     Returns None if the user was not found.
     '''
-    # Load the data
-    with open(get_file_directory('users'), 'r') as f:
-        current_data = json.load(f)
-    # Check to see if a user exists with that id
-    if int(user_id) not in current_data['user_ids']:
-        return None
-
-    # Typecast user_id to be an int
-    user_id = int(user_id)
-
-    # Remove the user_id from the list of user ids
-    user_ids = current_data['user_ids']
-    user_ids.remove(user_id)
-    # Iterate through the users and find the user
-    for user in current_data['users']:
-        # Check for a match
-        if user['user_id'] == user_id:
-            # Remove the user
-            current_data['users'].remove(user)
-            break
-    # Save the data
-    with open(get_file_directory('users'), 'w') as f:
-        json.dump(current_data, f, sort_keys=True,
-                  indent=4, separators=(',', ': '))
-    return True
+    return delete_record('users', user_id)
 
 
+@synchronised
 def create_message(author_id: int, message_content: str, channel_id: int):
     '''
     Creates a message from user with matching u_id == author id with
@@ -345,13 +768,9 @@ def create_message(author_id: int, message_content: str, channel_id: int):
     channel_id == channel_id.
     Returns the message_id of the newly created message.
     '''
-    # Load the data
-    with open(get_file_directory('messages'), 'r') as f:
-        current_data = json.load(f, object_hook=decode_datetime)
-    # Get the current maximum message id
-    latest_message_id = current_data['latest_message_id']
+    messages = get_collection('messages')
     # Get the new maximum message id
-    new_message_id = latest_message_id + 1
+    new_message_id = messages.next_id()
     # Create the message dictionary
     message_dict = {
         "message_id": new_message_id,
@@ -362,138 +781,99 @@ def create_message(author_id: int, message_content: str, channel_id: int):
         "reactions": [],
         "pinned": False,
         "edited": False,
+        "version": 1,
     }
-    # Increment the maximum message id
-    current_data['latest_message_id'] = new_message_id
-    # Add the new message ID to the list of message_ids
-    current_data['message_ids'].append(new_message_id)
-    # Add the message dictionary to the list of messages
-    current_data['messages'].append(message_dict)
-    # Save the data
-    with open(get_file_directory('messages'), 'w') as f:
-        json.dump(current_data, f, sort_keys=True,
-                  indent=4, separators=(',', ': '), cls=DateTimeEncoder)
+    # Save the message
+    messages.put(message_dict)
     # Return the new message_id
     return new_message_id
 
 
+@synchronised
 def get_message(message_id: int):
     '''
     Gets a message with given message_id.
     Returns None if the message is not found.
     '''
-    # Load the data
-    with open(get_file_directory('messages'), 'r') as f:
-        current_data = json.load(f, object_hook=decode_datetime)
-    # Check to see if a message exists with that id
-    if int(message_id) not in current_data['message_ids']:
-        return None
-    for message in current_data['messages']:
-        if message['message_id'] == int(message_id):
-            return message
+    return get_record('messages', message_id)
+
+
+@synchronised
+def get_search_candidates(query_str: str):
+    '''
+    Gets the ids of the messages that could contain query_str (ignoring
+    case), oldest first, without reading the messages. Every message that
+    does is in the list, but so may some that don't.
+    '''
+    return get_collection('messages').candidates('content', query_str)
+
+
+@synchronised
+def select_channel_message_ids(message_ids: list, channel_ids):
+    '''
+    Gets those of message_ids (in the same order) that are in one of the
+    given channels, without reading the messages
+    '''
+    return get_collection('messages').select(message_ids, 'channel_id', channel_ids)
 
 
+@synchronised
+def get_messages(message_ids: list):
+    '''
+    Gets the messages with the given message_ids, in the same order,
+    with one read. Any that are not found are None.
+    '''
+    return get_records('messages', message_ids)
+
+
+@synchronised
 def update_message(message_id: int, message_data: dict):
     '''
     Updates a message with the given message_id.
     This will replace all stored message data for that message.
     Returns None if a matching message is not found.
     '''
-    # Verify that the message_id is not being updated.
-    if int(message_id) != message_data["message_id"]:
-        raise DataError
-        return
-    # Load the data
-    with open(get_file_directory('messages'), 'r') as f:
-        current_data = json.load(f, object_hook=decode_datetime)
-    # Check to see if a message exists with that id
-    if int(message_id) not in current_data['message_ids']:
-        return None
+    return update_record('messages', message_id, message_data)
 
-    # Iterate through the messages
-    for message_index in range(len(current_data['messages'])):
-        # Check for a match
-        if current_data['messages'][message_index]['message_id'] == message_data['message_id']:
-            # Replace the current data with the new data
-            current_data['messages'][message_index] = message_data
-            break
 
-    # Save the data
-    with open(get_file_directory('messages'), 'w') as f:
-        json.dump(current_data, f, sort_keys=True,
-                  indent=4, separators=(',', ': '), cls=DateTimeEncoder)
+@synchronised
+def patch_message(message_id: int, fields: dict):
+    '''
+    Updates only the given fields of a message with the given message_id.
+    Returns None if a matching message is not found.
+    '''
+    return patch_record('messages', message_id, fields)
 
 
+@synchronised
 def delete_message(message_id: int):
     '''
     Deletes a message with given message_id.
     Returns None if the message was not found.
     '''
-    # Load the data
-    with open(get_file_directory('messages'), 'r') as f:
-        current_data = json.load(f, object_hook=decode_datetime)
-    # Check to see if a message exists with that id
-    if int(message_id) not in current_data['message_ids']:
-        return None
-
-    # Typecast message_id to be an int
-    message_id = int(message_id)
-
-    # Remove the message_id from the list of message ids
-    message_ids = current_data['message_ids']
-    message_ids.remove(message_id)
-    # Iterate through the messages and find the message
-    for message in current_data['messages']:
-        # Check for a match
-        if message['message_id'] == message_id:
-            # Remove the message
-            current_data['messages'].remove(message)
-            break
-    # Save the data
-    with open(get_file_directory('messages'), 'w') as f:
-        json.dump(current_data, f, sort_keys=True,
-                  indent=4, separators=(',', ': '), cls=DateTimeEncoder)
-    return True
+    return delete_record('messages', message_id)
 
 
+@synchronised
 def create_unsent_message_id(message_id: int):
     '''
     Create unsent message id
     Return True if successful, otherwise return None
     '''
-    # Load the data
-    with open(get_file_directory('messages'), 'r') as f:
-        current_data = json.load(f, object_hook=decode_datetime)
-    if message_id in current_data['unsent_message_ids']:
-        return None
-    current_data['unsent_message_ids'].append(int(message_id))
-
-    # Save the data
-    with open(get_file_directory('messages'), 'w') as f:
-        json.dump(current_data, f, sort_keys=True,
-                  indent=4, separators=(',', ': '), cls=DateTimeEncoder)
-    return True
+    return get_collection('messages').add_to_meta('unsent_message_ids', int(message_id))
 
 
+@synchronised
 def delete_unsent_message_id(message_id: int):
     '''
     Delete the unsent message id
     If successful return True, otherwise return None
+    (so only one thread or process gets True for the same id)
     '''
-    # Load the data
-    with open(get_file_directory('messages'), 'r') as f:
-        current_data = json.load(f, object_hook=decode_datetime)
-    if message_id not in current_data['unsent_message_ids']:
-        return None
-    current_data['unsent_message_ids'].remove(int(message_id))
-
-    # Save the data
-    with open(get_file_directory('messages'), 'w') as f:
-        json.dump(current_data, f, sort_keys=True,
-                  indent=4, separators=(',', ': '), cls=DateTimeEncoder)
-    return True
+    return get_collection('messages').remove_from_meta('unsent_message_ids', int(message_id))
 
 
+@synchronised
 def create_standup(start_time: datetime.datetime,
                    finish_time: datetime.datetime, creator_id: int, channel_id: int):
     '''
@@ -502,13 +882,9 @@ def create_standup(start_time: datetime.datetime,
     with channel_id == channel_id.
     Returns the standup_id of the newly created standup.
     '''
-    # Load the data
-    with open(get_file_directory('standups'), 'r') as f:
-        current_data = json.load(f, object_hook=decode_datetime)
-    # Get the current maximum standup id
-    latest_standup_id = current_data['latest_standup_id']
+    standups = get_collection('standups')
     # Get the new maximum standup id
-    new_standup_id = latest_standup_id + 1
+    new_standup_id = standups.next_id()
     # Check if the standup is in progress
     now = datetime.datetime.now()
     if start_time <= now <= finish_time:
@@ -523,102 +899,55 @@ def create_standup(start_time: datetime.datetime,
         "creator_id": int(creator_id),
         "channel_id": int(channel_id),
         "in_progress": in_progress,
-        "message_id": None
-
+        "message_id": None,
+        # What has been sent so far, one line per standup_send
+        "lines": [],
+        "version": 1,
     }
-    # Increment the maximum standup id
-    current_data['latest_standup_id'] = new_standup_id
-    # Add the new standup ID to the list of standup_ids
-    current_data['standup_ids'].append(new_standup_id)
-    # Add the standup dictionary to the list of standups
-    current_data['standups'].append(standup_dict)
-    # Save the data
-    with open(get_file_directory('standups'), 'w') as f:
-        json.dump(current_data, f, sort_keys=True,
-                  indent=4, separators=(',', ': '), cls=DateTimeEncoder)
+    # Save the standup
+    standups.put(standup_dict)
     # Return the new standup_id
     return new_standup_id
 
 
+@synchronised
 def get_standup(standup_id: int):
     '''
     Gets a standup with the given standup_id.
     Returns None if a matching standup is not found.
     '''
-    # Load the data
-    with open(get_file_directory('standups'), 'r') as f:
-        current_data = json.load(f, object_hook=decode_datetime)
-    # Check to see if a standup exists with that id
-    if int(standup_id) not in current_data['standup_ids']:
-        return None
-    for standup in current_data['standups']:
-        if standup['standup_id'] == int(standup_id):
-            return standup
+    return get_record('standups', standup_id)
 
 
+@synchronised
 def update_standup(standup_id: int, standup_data: dict):
     '''
     Updates a standup with the given standup_id.
     This will replace all stored standup data for that standup.
     Returns None if a matching standup is not found.
     '''
-    # Verify that the standup_id is not being updated.
-    if int(standup_id) != standup_data["standup_id"]:
-        raise DataError
-        return
-    # Load the data
-    with open(get_file_directory('standups'), 'r') as f:
-        current_data = json.load(f, object_hook=decode_datetime)
-    # Check to see if a standup exists with that id
-    if int(standup_id) not in current_data['standup_ids']:
-        return None
+    return update_record('standups', standup_id, standup_data)
 
-    # Iterate through the standups
-    for standup_index in range(len(current_data['standups'])):
-        # Check for a match
-        if current_data['standups'][standup_index]['standup_id'] == standup_data['standup_id']:
-            # Replace the current data with the new data
-            current_data['standups'][standup_index] = standup_data
-            break
 
-    # Save the data
-    with open(get_file_directory('standups'), 'w') as f:
-        json.dump(current_data, f, sort_keys=True,
-                  indent=4, separators=(',', ': '), cls=DateTimeEncoder)
+@synchronised
+def patch_standup(standup_id: int, fields: dict):
+    '''
+    Updates only the given fields of a standup with the given standup_id.
+    Returns None if a matching standup is not found.
+    '''
+    return patch_record('standups', standup_id, fields)
 
 
+@synchronised
 def delete_standup(standup_id: int):
     '''
     Deletes a standup with given standup_id.
     Returns None if the standup was not found.
     '''
-    # Load the data
-    with open(get_file_directory('standups'), 'r') as f:
-        current_data = json.load(f, object_hook=decode_datetime)
-    # Check to see if a standup exists with that id
-    if int(standup_id) not in current_data['standup_ids']:
-        return None
-
-    # Typecast standup_id to be an int
-    standup_id = int(standup_id)
-
-    # Remove the standup_id from the list of standup ids
-    standup_ids = current_data['standup_ids']
-    standup_ids.remove(standup_id)
-    # Iterate through the standups and find the standup
-    for standup in current_data['standups']:
-        # Check for a match
-        if standup['standup_id'] == standup_id:
-            # Remove the standup
-            current_data['standups'].remove(standup)
-            break
-    # Save the data
-    with open(get_file_directory('standups'), 'w') as f:
-        json.dump(current_data, f, sort_keys=True,
-                  indent=4, separators=(',', ': '), cls=DateTimeEncoder)
-    return True
+    return delete_record('standups', standup_id)
 
 
+@synchronised
 def create_hangman(word: str, creator_id: int, channel_id: int, topic: str = None):
     '''
     Creates a hangman game with a given word belonging to a certain topic.
@@ -626,14 +955,9 @@ def create_hangman(word: str, creator_id: int, channel_id: int, topic: str = Non
     with channel_id == channel_id.
     Returns the hangman_id of the newly created hangman.
     '''
-    # Load the data
-    with open(get_file_directory('hangman'), 'r') as f:
-        current_data = json.load(f, object_hook=decode_datetime)
-    # Get the current maximum hangman id
-    latest_hangman_id = current_data['latest_hangman_id']
+    hangmen = get_collection('hangman')
     # Get the new maximum hangman id
-    new_hangman_id = latest_hangman_id + 1
-    # Check if the hangman is in progress
+    new_hangman_id = hangmen.next_id()
     # Create the hangman dictionary
     hangman_dict = {
         "hangman_id": new_hangman_id,
@@ -645,185 +969,113 @@ def create_hangman(word: str, creator_id: int, channel_id: int, topic: str = Non
         "creator_id": int(creator_id),
         "channel_id": int(channel_id),
         "finished": False,
+        "version": 1,
     }
-    # Increment the maximum hangman id
-    current_data['latest_hangman_id'] = new_hangman_id
-    # Add the new hangman ID to the list of hangman_ids
-    current_data['hangman_ids'].append(new_hangman_id)
-    # Add the hangman dictionary to the list of hangmans
-    current_data['hangmen'].append(hangman_dict)
-    # Save the data
-    with open(get_file_directory('hangman'), 'w') as f:
-        json.dump(current_data, f, sort_keys=True,
-                  indent=4, separators=(',', ': '), cls=DateTimeEncoder)
+    # Save the hangman
+    hangmen.put(hangman_dict)
     # Return the new hangman_id
     return new_hangman_id
 
 
+@synchronised
 def get_hangman(hangman_id: int):
     '''
     Gets a hangman with the given hangman_id.
     Returns None if a matching hangman is not found.
     '''
-    # Load the data
-    with open(get_file_directory('hangman'), 'r') as f:
-        current_data = json.load(f, object_hook=decode_datetime)
-    # Check to see if a hangman exists with that id
-    if int(hangman_id) not in current_data['hangman_ids']:
-        return None
-    for hangman in current_data['hangmen']:
-        if hangman['hangman_id'] == int(hangman_id):
-            return hangman
+    return get_record('hangman', hangman_id)
 
 
+@synchronised
 def update_hangman(hangman_id: int, hangman_data: dict):
     '''
     Updates a hangman with the given hangman_id.
     This will replace all stored hangman data for that hangman.
     Returns None if a matching hangman is not found.
     '''
-    # Verify that the hangman_id is not being updated.
-    if int(hangman_id) != hangman_data["hangman_id"]:
-        raise DataError
-        return
-    # Load the data
-    with open(get_file_directory('hangman'), 'r') as f:
-        current_data = json.load(f, object_hook=decode_datetime)
-    # Check to see if a hangman exists with that id
-    if int(hangman_id) not in current_data['hangman_ids']:
-        return None
+    return update_record('hangman', hangman_id, hangman_data)
 
-    # Iterate through the hangmans
-    for hangman_index in range(len(current_data['hangmen'])):
-        # Check for a match
-        if current_data['hangmen'][hangman_index]['hangman_id'] == hangman_data['hangman_id']:
-            # Replace the current data with the new data
-            current_data['hangmen'][hangman_index] = hangman_data
-            break
 
-    # Save the data
-    with open(get_file_directory('hangman'), 'w') as f:
-        json.dump(current_data, f, sort_keys=True,
-                  indent=4, separators=(',', ': '), cls=DateTimeEncoder)
+@synchronised
+def patch_hangman(hangman_id: int, fields: dict):
+    '''
+    Updates only the given fields of a hangman with the given hangman_id.
+    Returns None if a matching hangman is not found.
+    '''
+    return patch_record('hangman', hangman_id, fields)
 
 
+@synchronised
 def delete_hangman(hangman_id: int):
     '''
     Deletes a hangman with given hangman_id.
     Returns None if the hangman was not found.
     '''
-    # Load the data
-    with open(get_file_directory('hangman'), 'r') as f:
-        current_data = json.load(f, object_hook=decode_datetime)
-    # Check to see if a hangman exists with that id
-    if int(hangman_id) not in current_data['hangman_ids']:
-        return None
-
-    # Typecast hangman_id to be an int
-    hangman_id = int(hangman_id)
-
-    # Remove the hangman_id from the list of hangman ids
-    hangman_ids = current_data['hangman_ids']
-    hangman_ids.remove(hangman_id)
-    # Iterate through the hangmans and find the hangman
-    for hangman in current_data['hangmen']:
-        # Check for a match
-        if hangman['hangman_id'] == hangman_id:
-            # Remove the hangman
-            current_data['hangmen'].remove(hangman)
-            break
-    # Save the data
-    with open(get_file_directory('hangman'), 'w') as f:
-        json.dump(current_data, f, sort_keys=True,
-                  indent=4, separators=(',', ': '), cls=DateTimeEncoder)
-    return True
+    return delete_record('hangman', hangman_id)
 
 
 # Functions to get lists of all the data id's
 
 
+@synchronised
 def get_all_channel_ids():
     '''
     Get all channel ids into a list
     '''
-    # Load the data
-    with open(get_file_directory('channels'), 'r') as f:
-        current_data = json.load(f)
-    return current_data['channel_ids']
+    return get_collection('channels').ids()
+
+
+@synchronised
+def get_member_channel_ids(user_id: int):
+    '''
+    Get the ids of the channels the user is a member of into a list
+    '''
+    return get_collection('channels').find('user_member_ids', int(user_id))
 
 
+@synchronised
+def get_owner_channel_ids(user_id: int):
+    '''
+    Get the ids of the channels the user is an owner of into a list
+    '''
+    return get_collection('channels').find('owner_member_ids', int(user_id))
+
+
+@synchronised
 def get_all_user_ids():
     '''
     Get all user ids into a list
     '''
-    # Load the data
-    with open(get_file_directory('users'), 'r') as f:
-        current_data = json.load(f)
-    return current_data['user_ids']
+    return get_collection('users').ids()
 
 
+@synchronised
 def get_all_message_ids():
     '''
     Get all message ids into a list
     '''
-    # Load the data
-    with open(get_file_directory('messages'), 'r') as f:
-        current_data = json.load(f, object_hook=decode_datetime)
-    return current_data['message_ids']
+    return get_collection('messages').ids()
 
 
+@synchronised
 def get_all_standup_ids():
     '''
     Get all standup ids into a list
     '''
-    # Load the data
-    with open(get_file_directory('standups'), 'r') as f:
-        current_data = json.load(f, object_hook=decode_datetime)
-    return current_data['standup_ids']
+    return get_collection('standups').ids()
 
 
+@synchronised
 def get_all_unsent_message_ids():
     '''
     Get all unsent message ids into a list
     '''
-    # Load the data
-    with open(get_file_directory('messages'), 'r') as f:
-        current_data = json.load(f, object_hook=decode_datetime)
-    return current_data['unsent_message_ids']
+    return list(get_collection('messages').get_meta('unsent_message_ids', []))
 
 
+@synchronised
 def get_all_hangman_ids():
     '''
     Get all hangman ids into a list
     '''
-    # Load the data
-    with open(get_file_directory('hangman'), 'r') as file:
-        current_data = json.load(file, object_hook=decode_datetime)
-    return current_data['hangman_ids']
-
-# Encoders to help with converting datetimes
-
-
-class DateTimeEncoder(json.JSONEncoder):
-    '''
-    Encoders to help with coverting datetimes
-    '''
-    def default(self, obj):                         # pylint: disable=E0202
-        if isinstance(obj, (datetime.date, datetime.datetime)):
-            return obj.isoformat()
-
-
-def decode_datetime(emp_dict):
-    '''
-    Serialize datetime into json
-    '''
-    # Credit: https://pynative.com/python-serialize-datetime-into-json/
-    if 'time' in emp_dict:
-        emp_dict['time'] = datetime.datetime.fromisoformat(emp_dict['time'])
-    if 'time_started' in emp_dict:
-        emp_dict['time_started'] = datetime.datetime.fromisoformat(
-            emp_dict['time_started'])
-    if 'time_finished' in emp_dict:
-        emp_dict['time_finished'] = datetime.datetime.fromisoformat(
-            emp_dict['time_finished'])
-    return emp_dict
+    return get_collection('hangman').ids()
@@ -0,0 +1,638 @@
+'''
+Tests for the storage layer in abstractions.py
+'''
+import datetime
+import json
+import multiprocessing
+import os
+import random
+import threading
+import pytest
+import requests
+import abstractions
+import config
+import text_index
+from error import ConflictError, DataError
+
+# pylint: disable=C0116
+
+BASE_URL = "http://localhost:8080/"
+# The format the server was started with
+SERVER_FORMAT = config.STORAGE_FORMAT
+
+
+# Function to wipe datafiles before each test
+@pytest.fixture(autouse=True)
+def wipe_datafiles():
+    # Wipe before each run
+    requests.post(BASE_URL + "workplace/reset")
+    yield
+    # Wipe after each run
+    requests.post(BASE_URL + "workplace/reset")
+
+
+# These tests check the JSON data files, so use that backend and format
+# whatever is configured
+@pytest.fixture(autouse=True)
+def json_backend(monkeypatch):
+    monkeypatch.setattr(config, "STORAGE_FORMAT", "json")
+    monkeypatch.setattr(abstractions, "STORE", abstractions.create_store("json"))
+    abstractions.setup_channels_json()
+    abstractions.setup_users_json()
+    abstractions.setup_messages_json()
+
+
+def test_reads_are_copies():
+    '''
+    Changing a record that was read should not change the stored record
+    '''
+    user_id = abstractions.create_user("Hayden", "Jacobs", "a@b.com", "pass123")
+    user = abstractions.get_user(user_id)
+    user['firstname'] = "Changed"
+    assert abstractions.get_user(user_id)['firstname'] == "Hayden"
+
+
+def test_writes_reach_disk():
+    '''
+    Writes should be persisted straight through to the data file
+    '''
+    user_id = abstractions.create_user("Hayden", "Jacobs", "a@b.com", "pass123")
+    with open(abstractions.get_file_directory('users'), 'r') as f:
+        on_disk = json.load(f)
+    assert str(user_id) in on_disk['users']
+
+
+def test_failed_write_leaves_file_intact(monkeypatch):
+    '''
+    A write that fails part way should leave the old data file in place
+    '''
+    user_id = abstractions.create_user("Hayden", "Jacobs", "a@b.com", "pass123")
+
+    def crash(*_):
+        raise OSError("crashed before the rename")
+    with monkeypatch.context() as patch, pytest.raises(OSError):
+        patch.setattr(os, "replace", crash)
+        abstractions.create_user("Lost", "User", "c@d.com", "pass123")
+    with open(abstractions.get_file_directory('users'), 'r') as f:
+        on_disk = json.load(f)
+    assert list(on_disk['users']) == [str(user_id)]
+    assert not [name for name in os.listdir(abstractions.get_path())
+                if name.endswith(".tmp")]
+
+
+def test_concurrent_writes_share_a_commit(monkeypatch):
+    '''
+    Threads writing at the same time should have their changes written
+    together rather than each rewriting the file
+    '''
+    store = abstractions.get_store()
+    monkeypatch.setattr(store.group, "window", 0.5)
+    users = store.collection('users')
+    writes = []
+    write = users._write_prepared                       # pylint: disable=W0212
+
+    def counting_write(*args):
+        writes.append(args)
+        write(*args)
+    monkeypatch.setattr(users, "_write_prepared", counting_write)
+    barrier = threading.Barrier(8)
+
+    def create(number):
+        barrier.wait()
+        abstractions.create_user("Busy", "User", f"{number}@b.com", "pass123")
+    threads = [threading.Thread(target=create, args=(number,)) for number in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(writes) < 8
+    with open(abstractions.get_file_directory('users'), 'r') as f:
+        assert len(json.load(f)['users']) == 8
+
+
+def create_channels(count):
+    for _ in range(count):
+        abstractions.create_channel("Shared", False, 1)
+
+
+def test_processes_do_not_lose_writes():
+    '''
+    Several processes creating channels at once should each get their own
+    ids and none of the channels should be lost
+    '''
+    context = multiprocessing.get_context("fork")
+    processes = [context.Process(target=create_channels, args=(10,)) for _ in range(4)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    assert abstractions.get_all_channel_ids() == list(range(1, 41))
+
+
+def test_changes_from_other_processes_are_seen(monkeypatch):
+    '''
+    The server runs in another process, so its writes must be picked up
+    '''
+    # Use whichever backend and format the server is using
+    monkeypatch.setattr(config, "STORAGE_FORMAT", SERVER_FORMAT)
+    monkeypatch.setattr(abstractions, "STORE", None)
+    abstractions.get_all_user_ids()
+    data = {
+        "email": "test@test.com",
+        "password": "ilovetrimesters",
+        "name_first": "Hayden",
+        "name_last": "Smith"
+    }
+    response = requests.post(BASE_URL + "auth/register", json=data).json()
+    assert response['u_id'] in abstractions.get_all_user_ids()
+
+
+def test_legacy_layout_is_migrated():
+    '''
+    Data files in the old list layout should be upgraded when loaded
+    '''
+    legacy = {
+        "latest_channel_id": 2,
+        "channel_ids": [2],
+        "channels": [{"channel_id": 2, "channel_name": "Old"}]
+    }
+    with open(abstractions.get_file_directory('channels'), 'w') as f:
+        json.dump(legacy, f)
+    assert abstractions.get_channel(2)['channel_name'] == "Old"
+    assert abstractions.get_all_channel_ids() == [2]
+    with open(abstractions.get_file_directory('channels'), 'r') as f:
+        on_disk = json.load(f)
+    assert on_disk['channels'] == {"2": {"channel_id": 2, "channel_name": "Old"}}
+
+
+def fresh_messages_collection():
+    '''
+    A messages collection with nothing loaded, like after a restart
+    '''
+    return abstractions.create_store("json").collection('messages')
+
+
+def test_messages_are_journaled():
+    '''
+    Sending a message appends to the journal rather than the snapshot,
+    and a restart recovers it by replaying the journal
+    '''
+    message_id = abstractions.create_message(1, "hello", 1)
+    messages = abstractions.get_collection('messages')
+    with open(abstractions.get_file_directory('messages'), 'r') as f:
+        assert str(message_id) not in json.load(f)['shard_index']
+    assert not os.path.exists(messages.shard_path(1))
+    recovered = fresh_messages_collection()
+    assert recovered.get(message_id)['content'] == "hello"
+    assert recovered.data()['latest_message_id'] == message_id
+
+
+def test_checkpoint_folds_journal_into_snapshot():
+    message_id = abstractions.create_message(1, "hello", 1)
+    abstractions.get_collection('messages').checkpoint()
+    with open(abstractions.get_file_directory('messages'), 'r') as f:
+        assert json.load(f)['shard_index'] == {str(message_id): 1}
+    with open(abstractions.get_collection('messages').shard_path(1), 'r') as f:
+        assert str(message_id) in json.load(f)
+    messages = fresh_messages_collection()
+    assert messages.journal.size() == 0
+    assert messages.get(message_id)['content'] == "hello"
+
+
+def test_torn_journal_entry_is_ignored():
+    '''
+    A half written entry from a crash should not stop recovery
+    '''
+    message_id = abstractions.create_message(1, "hello", 1)
+    with open(fresh_messages_collection().journal.path, 'a') as f:
+        f.write('{"op":"put","rec')
+    recovered = fresh_messages_collection()
+    assert recovered.ids() == [message_id]
+    recovered.put({"message_id": 7, "channel_id": 1, "content": "after crash"})
+    assert fresh_messages_collection().ids() == [message_id, 7]
+
+
+def test_messages_are_sharded_by_channel():
+    '''
+    Each channel's messages live in their own file, and only the shard
+    for the channel being used is read
+    '''
+    first = abstractions.create_message(1, "in one", 1)
+    second = abstractions.create_message(1, "in two", 2)
+    abstractions.get_collection('messages').checkpoint()
+    messages = fresh_messages_collection()
+    assert messages.get(second)['content'] == "in two"
+    assert list(messages._shards) == [2]              # pylint: disable=W0212
+    assert messages.find('channel_id', 1) == [first]
+    assert messages.ids() == [first, second]
+
+
+def test_deletes_survive_a_restart():
+    '''
+    A delete journaled for a shard that hasn't been read is applied to
+    it once it is, and isn't written back at the next checkpoint
+    '''
+    removed = abstractions.create_message(1, "apple", 1)
+    abstractions.get_collection('messages').checkpoint()
+    messages = fresh_messages_collection()
+    messages.delete(removed)
+    kept = abstractions.create_message(1, "apple", 1)
+
+    messages = fresh_messages_collection()
+    assert messages.find('channel_id', 1) == [kept]
+    assert messages.candidates('content', "apple") == [kept]
+    messages.checkpoint()
+    messages = fresh_messages_collection()
+    assert messages.ids() == [kept]
+    assert messages.find('channel_id', 1) == [kept]
+    assert messages.candidates('content', "apple") == [kept]
+
+
+def test_channel_pages():
+    channel_id = abstractions.create_channel("Test", False, 1)
+    # The first two are from before positions were kept
+    abstractions.patch_channel(channel_id, {"message_ids": [1, 2, 3, 4],
+                                            "message_seqs": [5, 8]})
+    assert abstractions.get_channel_page(channel_id, None, 3) == [[8, 4], [5, 3], [-1, 2]]
+    assert abstractions.get_channel_page(channel_id, 8, 2) == [[5, 3], [-1, 2]]
+    assert abstractions.get_channel_page(channel_id, 7, 9) == [[5, 3], [-1, 2], [-2, 1]]
+    assert abstractions.get_channel_page(channel_id, -1, 9) == [[-2, 1]]
+    assert abstractions.get_channel_message_position(channel_id, 3) == 5
+    assert abstractions.get_channel_message_position(channel_id, 1) == -2
+    assert abstractions.get_channel_message_position(channel_id, 9) is None
+    assert abstractions.get_channel_page(channel_id + 1, None, 3) is None
+
+
+def test_select_channel_message_ids():
+    first = abstractions.create_message(1, "in one", 1)
+    second = abstractions.create_message(1, "in two", 2)
+    third = abstractions.create_message(1, "in three", 3)
+    found = abstractions.select_channel_message_ids([third, first + 100, second, first], {1, 3})
+    assert found == [third, first]
+    assert abstractions.select_channel_message_ids([first], []) == []
+
+
+def test_search_index_is_saved_with_the_shards():
+    '''
+    After a restart, the index is loaded from what was saved at the last
+    checkpoint, and only the shards changed since are read
+    '''
+    first = abstractions.create_message(1, "hello one", 1)
+    second = abstractions.create_message(1, "hello two", 2)
+    third = abstractions.create_message(1, "goodbye", 3)
+    abstractions.get_collection('messages').checkpoint()
+    abstractions.patch_message(third, {"content": "hello again"})
+    abstractions.delete_message(second)
+
+    messages = fresh_messages_collection()
+    assert messages.candidates('content', "hello") == [first, third]
+    assert sorted(messages._shards) == [3]            # pylint: disable=W0212
+    # The shards it was loaded for are kept up to date from then on
+    messages.put({"message_id": 9, "channel_id": 1, "content": "hello nine"})
+    assert messages.candidates('content', "hello") == [first, third, 9]
+
+    # An index saved for another version of its shard isn't used
+    messages.checkpoint()
+    with open(messages.text_index_path(1, 'content'), 'wb') as f:
+        f.write(text_index.encode(0, {"hel": {first}}))
+    assert fresh_messages_collection().candidates('content', "hello") == [first, third, 9]
+
+
+def test_unsharded_messages_are_split():
+    legacy = {
+        "latest_message_id": 2,
+        "message_ids": [1, 2],
+        "messages": [
+            {"message_id": 1, "channel_id": 1, "content": "a"},
+            {"message_id": 2, "channel_id": 2, "content": "b"},
+        ],
+        "unsent_message_ids": []
+    }
+    with open(abstractions.get_file_directory('messages'), 'w') as f:
+        json.dump(legacy, f)
+    messages = fresh_messages_collection()
+    assert messages.get(2)['content'] == "b"
+    assert os.path.exists(messages.shard_path(1))
+    assert fresh_messages_collection().find('channel_id', 1) == [1]
+
+
+def test_updates_check_the_version():
+    '''
+    Updating with a record read before someone else's update should fail
+    rather than overwrite their change
+    '''
+    channel_id = abstractions.create_channel("Test", False, 1)
+    first = abstractions.get_channel(channel_id)
+    second = abstractions.get_channel(channel_id)
+    first['user_member_ids'].append(2)
+    assert abstractions.update_channel(channel_id, first) is True
+    assert abstractions.get_channel(channel_id)['version'] == 2
+    second['message_ids'].append(1)
+    with pytest.raises(ConflictError):
+        abstractions.update_channel(channel_id, second)
+    assert abstractions.get_channel(channel_id)['user_member_ids'] == [1, 2]
+
+
+def test_retry_on_conflict_runs_again():
+    channel_id = abstractions.create_channel("Test", False, 1)
+    attempts = []
+
+    @abstractions.retry_on_conflict
+    def add_member(user_id):
+        channel = abstractions.get_channel(channel_id)
+        if not attempts:
+            # Someone else gets in first
+            abstractions.update_channel(channel_id, abstractions.get_channel(channel_id))
+        attempts.append(user_id)
+        channel['user_member_ids'].append(user_id)
+        abstractions.update_channel(channel_id, channel)
+    add_member(2)
+    assert len(attempts) == 2
+    assert abstractions.get_channel(channel_id)['user_member_ids'] == [1, 2]
+
+
+def test_field_changes():
+    channel_id = abstractions.create_channel("Test", False, 1)
+    assert abstractions.append_to('channels', channel_id, 'user_member_ids', 2) is True
+    assert abstractions.remove_from('channels', channel_id, 'user_member_ids', 1) is True
+    assert abstractions.increment('channels', channel_id, 'message_count', 3) is True
+    assert abstractions.patch_channel(channel_id, {"channel_name": "Renamed"}) is True
+    channel = abstractions.get_channel(channel_id)
+    assert channel['user_member_ids'] == [2]
+    assert channel['message_count'] == 3
+    assert channel['channel_name'] == "Renamed"
+    assert channel['version'] == 5
+    assert abstractions.patch_channel(channel_id + 1, {"channel_name": "Missing"}) is None
+    with pytest.raises(DataError):
+        abstractions.patch_channel(channel_id, {"channel_id": 5})
+
+
+def test_field_changes_are_journaled_on_their_own():
+    '''
+    Only the change is appended to the journal, and replaying it after a
+    restart gives the same record
+    '''
+    message_id = abstractions.create_message(1, "hello", 1)
+    messages = abstractions.get_collection('messages')
+    before = messages.journal.size()
+    abstractions.patch_message(message_id, {"pinned": True, "time": datetime.datetime(2020, 1, 1)})
+    with open(messages.journal.path, 'r') as f:
+        entry = json.loads(f.read()[before:])
+    assert entry == {"op": "patch", "id": message_id,
+                     "fields": {"pinned": True, "time": "2020-01-01T00:00:00"}}
+    recovered = fresh_messages_collection().get(message_id)
+    assert recovered['pinned'] is True
+    assert recovered['time'] == datetime.datetime(2020, 1, 1)
+
+
+def count_writes(monkeypatch, collection):
+    writes = []
+    write = collection._write_prepared                  # pylint: disable=W0212
+
+    def counting_write(*args):
+        writes.append(args)
+        write(*args)
+    monkeypatch.setattr(collection, "_write_prepared", counting_write)
+    return writes
+
+
+def test_transaction_writes_each_file_once(monkeypatch):
+    channel_id = abstractions.create_channel("Test", False, 1)
+    message_writes = count_writes(monkeypatch, abstractions.get_collection('messages'))
+    channel_writes = count_writes(monkeypatch, abstractions.get_collection('channels'))
+    with abstractions.transaction():
+        message_id = abstractions.create_message(1, "hello", channel_id)
+        abstractions.append_to('channels', channel_id, 'message_ids', message_id)
+        abstractions.increment('channels', channel_id, 'message_count')
+        assert not message_writes and not channel_writes
+    assert len(message_writes) == 1
+    assert len(channel_writes) == 1
+    restarted = abstractions.create_store("json")
+    assert restarted.collection('messages').get(message_id)['content'] == "hello"
+    assert restarted.collection('channels').get(channel_id)['message_ids'] == [message_id]
+    assert not os.path.exists(restarted.intent.path)
+
+
+def test_transaction_takes_file_locks_under_thread_locks(monkeypatch):
+    '''
+    The file locks are shared by every thread, so they are only taken
+    while holding the collection's lock
+    '''
+    channel_id = abstractions.create_channel("Test", False, 1)
+    unguarded = []
+    for name in ('messages', 'channels'):
+        collection = abstractions.get_collection(name)
+
+        def acquire(exclusive=False, collection=collection,
+                    acquire=collection.file_lock.acquire):
+            if not collection.lock._is_owned():    # pylint: disable=W0212
+                unguarded.append(collection.name)
+            acquire(exclusive)
+        monkeypatch.setattr(collection.file_lock, "acquire", acquire)
+    with abstractions.transaction():
+        message_id = abstractions.create_message(1, "hello", channel_id)
+        abstractions.append_to('channels', channel_id, 'message_ids', message_id)
+    assert not unguarded
+
+
+def test_interrupted_transaction_is_finished(monkeypatch):
+    '''
+    If only some of the files were written when a commit crashed, the
+    rest are written when the store is next created
+    '''
+    channel_id = abstractions.create_channel("Test", False, 1)
+    store = abstractions.get_store()
+    channels = store.collection('channels')
+
+    def crash(*_):
+        raise OSError("crashed part way through the commit")
+    with monkeypatch.context() as patch, pytest.raises(OSError):
+        patch.setattr(channels, "_write_prepared", crash)
+        patch.setattr(store.intent, "clear", lambda: None)
+        with abstractions.transaction():
+            message_id = abstractions.create_message(1, "hello", channel_id)
+            abstractions.append_to('channels', channel_id, 'message_ids', message_id)
+    assert store.intent.read()
+    assert channels.get(channel_id)['message_ids'] == []
+    restarted = abstractions.create_store("json")
+    assert restarted.collection('messages').get(message_id)['content'] == "hello"
+    assert restarted.collection('channels').get(channel_id)['message_ids'] == [message_id]
+    assert not os.path.exists(restarted.intent.path)
+
+
+def test_transaction_is_thrown_away_on_error():
+    channel_id = abstractions.create_channel("Test", False, 1)
+    with pytest.raises(ValueError), abstractions.transaction():
+        message_id = abstractions.create_message(1, "lost", channel_id)
+        abstractions.append_to('channels', channel_id, 'message_ids', message_id)
+        raise ValueError("gave up")
+    assert abstractions.get_channel(channel_id)['message_ids'] == []
+    assert abstractions.get_all_message_ids() == []
+    restarted = abstractions.create_store("json")
+    assert restarted.collection('channels').get(channel_id)['message_ids'] == []
+    assert restarted.collection('messages').get(message_id) is None
+
+
+def test_failed_transaction_keeps_other_threads_changes():
+    '''
+    Changes another thread made just before, which are still waiting for
+    the group commit, are written even though the transaction is not
+    '''
+    first = abstractions.create_channel("First", False, 1)
+    second = abstractions.create_channel("Second", False, 1)
+    store = abstractions.get_store()
+    changed = threading.Event()
+    carry_on = threading.Event()
+
+    def change():
+        with store.group_commit():
+            with store.lock:
+                abstractions.append_to('channels', first, 'message_ids', 1)
+            changed.set()
+            carry_on.wait()
+    thread = threading.Thread(target=change)
+    thread.start()
+    changed.wait()
+    with pytest.raises(ValueError), abstractions.transaction():
+        abstractions.append_to('channels', second, 'message_ids', 2)
+        raise ValueError("gave up")
+    carry_on.set()
+    thread.join()
+    assert abstractions.get_channel(first)['message_ids'] == [1]
+    assert abstractions.get_channel(second)['message_ids'] == []
+    restarted = abstractions.create_store("json")
+    assert restarted.collection('channels').get(first)['message_ids'] == [1]
+    assert restarted.collection('channels').get(second)['message_ids'] == []
+
+
+def test_users_are_indexed_by_email_and_handle():
+    user_id = abstractions.create_user("Hayden", "Jacobs", "a@b.com", "pass123")
+    other_id = abstractions.create_user("Other", "User", "c@d.com", "pass123")
+    abstractions.patch_user(user_id, {"handle": "hayden"})
+    assert abstractions.get_user_by_handle("hayden")['user_id'] == user_id
+    user = abstractions.get_user(user_id)
+    user['email'] = "new@b.com"
+    abstractions.update_user(user_id, user)
+    assert abstractions.get_user_by_email("a@b.com") is None
+    assert abstractions.get_user_by_email("new@b.com")['user_id'] == user_id
+    assert abstractions.get_collection('users').find('handle', "") == [other_id]
+    with pytest.raises(DataError):
+        abstractions.patch_user(other_id, {"handle": "hayden"})
+    with pytest.raises(DataError):
+        abstractions.create_user("Same", "Email", "c@d.com", "pass123")
+    abstractions.delete_user(user_id)
+    assert abstractions.get_user_by_handle("hayden") is None
+    assert abstractions.count_users() == 1
+    restarted = abstractions.create_store("json").collection('users')
+    assert restarted.find('email', "c@d.com") == [other_id]
+
+
+def test_channels_are_indexed_by_member():
+    first = abstractions.create_channel("First", False, 1)
+    second = abstractions.create_channel("Second", False, 2)
+    abstractions.append_to('channels', second, 'user_member_ids', 1)
+    assert abstractions.get_member_channel_ids(1) == [first, second]
+    assert abstractions.get_owner_channel_ids(1) == [first]
+    abstractions.remove_from('channels', first, 'user_member_ids', 1)
+    abstractions.delete_channel(second)
+    assert abstractions.get_member_channel_ids(1) == []
+    assert abstractions.get_owner_channel_ids(1) == [first]
+    restarted = abstractions.create_store("json").collection('channels')
+    assert restarted.find('owner_member_ids', 1) == [first]
+
+
+def test_request_identity_map():
+    user_id = abstractions.create_user("Hayden", "Jacobs", "a@b.com", "pass123")
+    abstractions.start_request()
+    try:
+        user = abstractions.get_user(user_id)
+        assert abstractions.get_user(user_id) is user
+        assert abstractions.get_user_by_email("a@b.com") is user
+        user['firstname'] = "Changed"
+        abstractions.update_user(user_id, user)
+        # The copy that was written is handed back, so it can be updated again
+        again = abstractions.get_user(user_id)
+        assert again['version'] == user['version'] + 1
+        again['lastname'] = "Again"
+        abstractions.update_user(user_id, again)
+        abstractions.patch_user(user_id, {"handle": "hayden"})
+        assert abstractions.get_user(user_id)['handle'] == "hayden"
+        assert abstractions.reads_saved() == 3
+    finally:
+        assert abstractions.end_request() == 3
+    assert abstractions.get_user(user_id) is not abstractions.get_user(user_id)
+
+
+def test_get_messages_reads_once():
+    first = abstractions.create_message(1, "in one", 1)
+    second = abstractions.create_message(1, "in two", 2)
+    messages = abstractions.get_collection('messages')
+    reads = []
+    real_data = messages.data
+
+    def data():
+        reads.append(1)
+        return real_data()
+    messages.data = data
+    try:
+        found = abstractions.get_messages([second, first + 100, first])
+    finally:
+        del messages.data
+    assert [message and message['content'] for message in found] == ["in two", None, "in one"]
+    assert len(reads) == 1
+
+
+def search_messages(query_str):
+    '''
+    The ids of the messages that contain query_str (ignoring case), read
+    from the search candidates the way other.search does
+    '''
+    candidates = abstractions.get_search_candidates(query_str)
+    return [
+        message['message_id'] for message in abstractions.get_messages(candidates)
+        if query_str.lower() in message['content'].lower()
+    ]
+
+
+def test_messages_are_indexed_for_search():
+    first = abstractions.create_message(1, "Hello World", 1)
+    second = abstractions.create_message(1, "well, hello there", 2)
+    assert search_messages("hello") == [first, second]
+    assert search_messages("LO W") == [first]
+    # The index is kept up to date as messages change
+    abstractions.patch_message(first, {"content": "Goodbye"})
+    third = abstractions.create_message(1, "Othello", 3)
+    assert search_messages("hello") == [second, third]
+    abstractions.delete_message(second)
+    assert search_messages("hello") == [third]
+    assert search_messages("bye") == [first]
+    # Shorter text is found through the trigrams it is part of
+    assert search_messages("o") == [first, third]
+    assert search_messages("") == [first, third]
+
+
+def test_search_matches_substrings():
+    '''
+    The search candidates include every message that contains each query
+    (ignoring case), whatever its length
+    '''
+    generator = random.Random(1531)
+    contents = ["", "a", "Ab", "ABC"] + [
+        "".join(generator.choice("abAB c") for _ in range(generator.randrange(12)))
+        for _ in range(40)
+    ]
+    message_ids = [
+        abstractions.create_message(1, content, generator.randrange(1, 4))
+        for content in contents
+    ]
+    queries = {"", "x", "abcd"} | {
+        content[start:start + length]
+        for content in contents for start in range(len(content)) for length in range(1, 5)
+    }
+    for query in queries:
+        expected = [
+            message_id for message_id, content in zip(message_ids, contents)
+            if query.lower() in content.lower()
+        ]
+        assert search_messages(query) == expected, query
+        assert search_messages(query.swapcase()) == expected, query
@@ -35,28 +35,19 @@ def auth_login(email, password):
         - Function, which authorises the login for a user
         - returns the users token and user_id
     """
-    all_user_ids = abstractions.get_all_user_ids()
     # Check if email entered is valid
     if email_check(email) is False:
         raise InputError(description="Please input a valid email address")
 
-    email_registered = False
     # Check if email matches with a registered user
-    for user_id in all_user_ids:
-        user = abstractions.get_user(user_id)
-        if user['email'] == email:
-            email_registered = True
-            break
+    user = abstractions.get_user_by_email(email)
 
-    if email_registered is False:
+    if user is None:
         # Doesnt match with any registered email
         raise InputError(
             description="Email entered has not been registered. Please register email and try again.")
 
     # Check if password matches
-    if user is None:
-        raise InputError(description="No registered user")
-
     if user['password'] != password:
         # Password doesn't match with user
         raise InputError(description="Incorrect Password. Please try again")
@@ -115,13 +106,10 @@ def auth_register(email, password, name_first, name_last):
         raise InputError(description="Please input a valid email address")
 
     # Check if email entered does not belong to another user
-    all_user_ids = abstractions.get_all_user_ids()
-    for user_id in all_user_ids:
-        user = abstractions.get_user(user_id)
-        if user['email'] == email:
-            # Email has been registered
-            raise InputError(
-                description="An account with this email address already exists. Please login")
+    if abstractions.get_user_by_email(email) is not None:
+        # Email has been registered
+        raise InputError(
+            description="An account with this email address already exists. Please login")
 
     # Check if the password is valid
     if len(password) < 6:
@@ -129,12 +117,13 @@ def auth_register(email, password, name_first, name_last):
             description="Password is less then 6 characters. Please try again")
 
     # All tests passed create user
+    first_user = abstractions.count_users() == 0
     user_id = abstractions.create_user(name_first, name_last, email, password)
     token = auth_login(email, password)
 
     user = abstractions.get_user(user_id)
     # If it is the first user created, give owner permissions
-    if not all_user_ids:
+    if first_user:
         user['permission_level'] = 1
 
     user['handle'] = create_handle(name_first, name_last)
@@ -196,12 +185,7 @@ def check_unique_handle(handle):
     """
         - Function, checks if the handle is unique and not used by anyone else in the program
     """
-    all_user_ids = abstractions.get_all_user_ids()
-    for user_id in all_user_ids:
-        user = abstractions.get_user(user_id)
-        if user['handle'] == handle:
-            return False
-    return True
+    return abstractions.get_user_by_handle(handle) is None
 
 
 def auth_password_reset_request(email):
@@ -211,15 +195,11 @@ def auth_password_reset_request(email):
         - Code will be used in password_reset
     """
     # First check if email matches with a user
-    all_user_ids = abstractions.get_all_user_ids()
-    registered_email = False
-    for user_id in all_user_ids:
-        user = abstractions.get_user(user_id)
-        if user['email'] == email:
-            registered_email = True
-            reset_code = jwt.encode({'u_id': user['user_id']},
-                                    RESET_SECRET, algorithm='HS256').decode('utf-8')
-            break
+    user = abstractions.get_user_by_email(email)
+    registered_email = user is not None
+    if registered_email:
+        reset_code = jwt.encode({'u_id': user['user_id']},
+                                RESET_SECRET, algorithm='HS256').decode('utf-8')
 
     # Code that will send the email
     if registered_email is True:
@@ -2,6 +2,8 @@
 Module to do backend work with all channel requests
 '''
 import abstractions
+import config
+import events
 import message as message_file
 from auth import check_valid_token, get_user_from_token
 from error import AccessError, InputError
@@ -29,10 +31,7 @@ def channel_invite(token: str, channel_id: int, u_id: int):
         raise InputError(description="Target user does not exist.")
 
     # Add the users ID to the channels list of its members
-    channel['user_member_ids'].append(int(u_id))
-
-    # Update the channel in the persistence layer
-    abstractions.update_channel(channel_id, channel)
+    abstractions.append_to('channels', channel_id, 'user_member_ids', int(u_id))
 
     return {}
 
@@ -77,6 +76,8 @@ def channel_messages(token: str, channel_id: int, start: int):
     # Check the tokens validity
     if not check_valid_token(token):
         raise AccessError(description="Invalid Token")
+    # Send any messages that were due before the messages are collected
+    message_file.send_due_messages()
     # Check if the channel_id is valid
     channel = abstractions.get_channel(channel_id)
     if channel is None:
@@ -92,13 +93,6 @@ def channel_messages(token: str, channel_id: int, start: int):
         raise AccessError(
             description="Authorised user is not part of this channel.")
 
-    # Check if there are any unsent messages we need to send before the messages are collected
-    message_file.check_unsent_messages()
-    # Get updated channel list in case there are new messages
-    channel = abstractions.get_channel(channel_id)
-
-    # Get the messages
-    message_list = []
     # Slice the message
     if channel['message_count'] < start + 50:
         not_enough = True
@@ -110,14 +104,138 @@ def channel_messages(token: str, channel_id: int, start: int):
 
     # Reverse the message_list so the most recent message is first
     selected_message_ids.reverse()
-    for message_id in selected_message_ids:
-        message = abstractions.get_message(message_id)
+    messages = abstractions.get_messages(selected_message_ids)
+    message_list = format_messages(messages, authed_user_id)
+
+    if not_enough is True:
+        end_to_return = -1
+    else:
+        end_to_return = finish_bound
+    return {
+        "messages": message_list,
+        "start": start,
+        "end": end_to_return
+    }
+
+
+def channel_messages_before(token: str, channel_id: int, cursor: int = None):
+    # Check the tokens validity
+    if not check_valid_token(token):
+        raise AccessError(description="Invalid Token")
+    # Send any messages that were due before the messages are collected
+    message_file.send_due_messages()
+    # Check if the channel_id is valid (without copying all of its messages)
+    member_ids = abstractions.get_field('channels', channel_id, 'user_member_ids', [])
+    if member_ids is None:
+        raise InputError(description="This channel does not exist.")
+    # Check that the user is a part of the channel
+    authed_user_id = get_user_from_token(token)
+    if authed_user_id not in member_ids:
+        raise AccessError(
+            description="Authorised user is not part of this channel.")
+
+    # Get the 50 messages before the cursor (or the most recent 50). The
+    # cursor is the position the last message of a page was added at, which
+    # marks the same place once newer messages are sent or it is removed,
+    # so "next" can be passed back in to get the page after this one.
+    try:
+        before = None if cursor is None or cursor == "" else int(cursor)
+    except ValueError as error:
+        raise InputError(description="Invalid cursor.") from error
+    # One more than the page is read, to tell whether there is another
+    page = abstractions.get_channel_page(channel_id, before, 51) or []
+    messages = abstractions.get_messages([message_id for _, message_id in page[:50]])
+    # A message removed since the page was read is left out
+    messages = [message for message in messages if message is not None]
+    return {
+        "messages": format_messages(messages, authed_user_id),
+        "before": before,
+        "next": page[49][0] if len(page) > 50 else None
+    }
+
+
+def channel_messages_since(token: str, channel_id: int, cursor: int = 0):
+    # Check the tokens validity
+    if not check_valid_token(token):
+        raise AccessError(description="Invalid Token")
+    # Send any messages that were due before the messages are collected
+    message_file.send_due_messages()
+    # Check if the channel_id is valid (only what is needed of it is read,
+    # as it is polled)
+    change_seq = abstractions.get_field('channels', channel_id, 'change_seq', 0)
+    if change_seq is None:
+        raise InputError(description="This channel does not exist.")
+    # Check that the user is a part of the channel
+    authed_user_id = get_user_from_token(token)
+    if not abstractions.in_list('channels', channel_id, 'user_member_ids', authed_user_id):
+        raise AccessError(
+            description="Authorised user is not part of this channel.")
+
+    # Every message sent, changed or removed gets the channel's next change
+    # sequence number, so nothing has happened if it is still at cursor
+    cursor = int(cursor)
+    if cursor > change_seq:
+        # The cursor is from before the data was reset, so start again
+        cursor = 0
+    if cursor == change_seq:
+        return {"messages": [], "removed_message_ids": [], "cursor": change_seq}
+
+    # Get the messages that have changed, most recently changed first.
+    # The channel logs them in change order, so only the changes after the
+    # cursor are read (unless it is from before the log was kept).
+    changes = abstractions.get_entries_since('channels', channel_id, 'changed_messages', cursor)
+    if changes is None:
+        message_ids = abstractions.get_field('channels', channel_id, 'message_ids', [])
+    else:
+        message_ids = [message_id for _, message_id in changes]
+    messages = [
+        message for message in abstractions.get_messages(message_ids)
+        if message is not None and message.get('change_seq', 0) > cursor
+    ]
+    messages.reverse()
+    removed = abstractions.get_entries_since('channels', channel_id, 'removed_messages', cursor)
+    return {
+        "messages": format_messages(messages, authed_user_id),
+        "removed_message_ids": [message_id for _, message_id in removed or []],
+        "cursor": change_seq
+    }
+
+
+def channel_events(token: str, channel_ids: list):
+    # Check the tokens validity
+    if not check_valid_token(token):
+        raise AccessError(description="Invalid Token")
+    authed_user_id = get_user_from_token(token)
+    # Check that every channel is valid and the user is a part of it
+    for channel_id in channel_ids:
+        channel = abstractions.get_channel(channel_id)
+        if channel is None:
+            raise InputError(description="This channel does not exist.")
+        if authed_user_id not in channel['user_member_ids']:
+            raise AccessError(
+                description="Authorised user is not part of this channel.")
+
+    # Events are published in the process that handles the change, so
+    # they can't reach a stream when each request gets a process of its own
+    if config.SERVER_PROCESSES > 1:
+        raise InputError(description="Live events are not available when the "
+                         "server runs more than one process. Poll "
+                         "/channel/messages/since instead.")
+    return events.stream(channel_ids)
+
+
+def format_messages(messages: list, authed_user_id: int):
+    '''
+    Helper function to put messages in the form channel_messages returns them
+    '''
+    message_list = []
+    for message in messages:
         reactions = message["reactions"]
         for reaction in reactions:
             user_reacted = authed_user_id in reaction['u_ids']
             reaction.update({"is_this_user_reacted": user_reacted})
         message_dict = {
-            "message_id": message_id,
+            "message_id": message['message_id'],
             "u_id":  message['author_id'],
             "message": message['content'],
             "time_created": message["time"].replace().timestamp(),
@@ -125,16 +243,7 @@ def channel_messages(token: str, channel_id: int, start: int):
             "is_pinned": message["pinned"]
         }
         message_list.append(message_dict)
-
-    if not_enough is True:
-        end_to_return = -1
-    else:
-        end_to_return = finish_bound
-    return {
-        "messages": message_list,
-        "start": start,
-        "end": end_to_return
-    }
+    return message_list
 
 
 def channel_leave(token: str, channel_id: int):
@@ -152,9 +261,7 @@ def channel_leave(token: str, channel_id: int):
             description="Authorised user is not part of this channel.")
 
     # Remove the user from the channel
-    channel['user_member_ids'].remove(authed_user_id)
-    # Update the channel in the persistence layer
-    abstractions.update_channel(channel_id, channel)
+    abstractions.remove_from('channels', channel_id, 'user_member_ids', authed_user_id)
 
     return {}
 
@@ -179,9 +286,7 @@ def channel_join(token: str, channel_id: int):
                 description="User not authorised to view this channel.")
 
     # Add the user to the channel
-    channel['user_member_ids'].append(authed_user_id)
-    # Update the channel in the persistence layer
-    abstractions.update_channel(channel_id, channel)
+    abstractions.append_to('channels', channel_id, 'user_member_ids', authed_user_id)
     return {}
 
 
@@ -207,9 +312,7 @@ def channel_addowner(token: str, channel_id: int, u_id: int):
             description="Authorised user does not have permission to add an owner in this channel.")
 
     # Add the user as an owner of the channel
-    channel['owner_member_ids'].append(u_id)
-    # Update the channel in the persistence layer
-    abstractions.update_channel(channel_id, channel)
+    abstractions.append_to('channels', channel_id, 'owner_member_ids', u_id)
 
     return {}
 
@@ -237,8 +340,6 @@ def channel_removeowner(token: str, channel_id: int, u_id: int):
         )
 
     # Remove the user as an owner of the channel
-    channel['owner_member_ids'].remove(u_id)
-    # Update the channel in the persistence layer
-    abstractions.update_channel(channel_id, channel)
+    abstractions.remove_from('channels', channel_id, 'owner_member_ids', u_id)
 
     return {}
@@ -1,9 +1,12 @@
 '''
 File containing integration and system tests
 '''
+import json
 import pytest
 import requests
+import abstractions
 import channel
+import config
 import message as message_file
 from channels import channels_create
 from auth import auth_register
@@ -439,6 +442,174 @@ def test_channel_messages_failure_3():
         channel.channel_messages(invited_user_results['token'], channel_id, 0)
 
 
+@pytest.mark.integrationtest
+def test_channel_messages_before_success():
+    '''
+        Expectations:
+            - Pages carry on from the same place after more messages are sent
+    '''
+    user_token = setup_test_user()
+    channel_id = setup_test_channel(user_token)
+    message_ids = [
+        message_file.message_send(user_token, channel_id, f"Test message: {number}")['message_id']
+        for number in range(1, 121)
+    ]
+
+    first_page = channel.channel_messages_before(user_token, channel_id)
+    assert [message['message_id'] for message in first_page['messages']] == message_ids[:69:-1]
+    assert first_page['before'] is None
+
+    # Newer messages don't move the next page along
+    message_file.message_send(user_token, channel_id, "Newer message")
+    second_page = channel.channel_messages_before(user_token, channel_id, first_page['next'])
+    assert [message['message_id'] for message in second_page['messages']] == message_ids[69:19:-1]
+    third_page = channel.channel_messages_before(user_token, channel_id, second_page['next'])
+    assert [message['message_id'] for message in third_page['messages']] == message_ids[19::-1]
+    assert third_page['next'] is None
+    assert third_page['messages'][-1]['message'] == "Test message: 1"
+
+
+@pytest.mark.integrationtest
+def test_channel_messages_before_removed_cursor():
+    '''
+        Expectations:
+            - The cursor still marks the same place once the last message
+              on the page it came from has been removed
+    '''
+    user_token = setup_test_user()
+    channel_id = setup_test_channel(user_token)
+    message_ids = [
+        message_file.message_send(user_token, channel_id, f"Test message: {number}")['message_id']
+        for number in range(1, 61)
+    ]
+
+    first_page = channel.channel_messages_before(user_token, channel_id)
+    assert first_page['messages'][-1]['message_id'] == message_ids[10]
+    message_file.message_remove(user_token, message_ids[10])
+    message_file.message_remove(user_token, message_ids[9])
+    second_page = channel.channel_messages_before(user_token, channel_id, first_page['next'])
+    assert [message['message_id'] for message in second_page['messages']] == (
+        message_ids[8::-1])
+    assert second_page['next'] is None
+
+
+@pytest.mark.integrationtest
+def test_channel_messages_before_reads_only_the_page(monkeypatch):
+    user_token = setup_test_user()
+    channel_id = setup_test_channel(user_token)
+    for number in range(60):
+        message_file.message_send(user_token, channel_id, f"Test message: {number}")
+    # Only the page is copied, not the channel's list of messages
+    monkeypatch.setattr(abstractions, "get_channel", None)
+    read = []
+    get_messages = abstractions.get_messages
+
+    def reading(ids):
+        read.extend(ids)
+        return get_messages(ids)
+    monkeypatch.setattr(abstractions, "get_messages", reading)
+    channel.channel_messages_before(user_token, channel_id)
+    assert len(read) == 50
+
+
+@pytest.mark.integrationtest
+def test_channel_messages_before_failure():
+    user_token = setup_test_user()
+    channel_id = setup_test_channel(user_token)
+
+    with pytest.raises(InputError):
+        channel.channel_messages_before(user_token, -1)
+    with pytest.raises(InputError):
+        channel.channel_messages_before(user_token, channel_id, "not a cursor")
+    other_user = auth_register("test2@test2.com", "ireallylovetrimesters", "John", "Smith")
+    with pytest.raises(AccessError):
+        channel.channel_messages_before(other_user['token'], channel_id)
+
+
+@pytest.mark.integrationtest
+def test_channel_messages_since_success():
+    '''
+        Expectations:
+            - Only what was sent, changed or removed after the cursor is returned
+    '''
+    register_results = auth_register(
+        "test@test.com", "ilovetrimesters", "Hayden", "Jacobs")
+    user_token = register_results['token']
+    channel_id = setup_test_channel(user_token)
+    first = message_file.message_send(user_token, channel_id, "First")['message_id']
+    second = message_file.message_send(user_token, channel_id, "Second")['message_id']
+
+    everything = channel.channel_messages_since(user_token, channel_id)
+    assert [message['message_id'] for message in everything['messages']] == [second, first]
+    cursor = everything['cursor']
+
+    # Nothing has changed since
+    assert channel.channel_messages_since(user_token, channel_id, cursor) == {
+        "messages": [], "removed_message_ids": [], "cursor": cursor
+    }
+
+    message_file.message_edit(user_token, first, "First, edited")
+    message_file.message_react(user_token, first, 1)
+    third = message_file.message_send(user_token, channel_id, "Third")['message_id']
+    message_file.message_remove(user_token, second)
+    changes = channel.channel_messages_since(user_token, channel_id, cursor)
+    assert [message['message_id'] for message in changes['messages']] == [third, first]
+    assert changes['messages'][1]['message'] == "First, edited"
+    assert changes['messages'][1]['reacts'][0]['is_this_user_reacted']
+    assert changes['removed_message_ids'] == [second]
+    assert changes['cursor'] > cursor
+
+
+@pytest.mark.integrationtest
+def test_channel_messages_since_reads_only_changes(monkeypatch):
+    user_token = setup_test_user()
+    channel_id = setup_test_channel(user_token)
+    message_ids = [
+        message_file.message_send(user_token, channel_id, f"Message {number}")['message_id']
+        for number in range(30)
+    ]
+    cursor = channel.channel_messages_since(user_token, channel_id)['cursor']
+    message_file.message_edit(user_token, message_ids[3], "Edited")
+    message_file.message_pin(user_token, message_ids[3])
+    message_file.message_remove(user_token, message_ids[4])
+
+    read = []
+    get_messages = abstractions.get_messages
+
+    def reading(ids):
+        read.extend(ids)
+        return get_messages(ids)
+    monkeypatch.setattr(abstractions, "get_messages", reading)
+    changes = channel.channel_messages_since(user_token, channel_id, cursor)
+    assert [message['message_id'] for message in changes['messages']] == [message_ids[3]]
+    assert changes['removed_message_ids'] == [message_ids[4]]
+    assert read == [message_ids[3]]
+    # Each message is logged once, with its last change
+    changed = abstractions.get_channel(channel_id)['changed_messages']
+    assert len(changed) == 29 and changed[-1][1] == message_ids[3]
+
+
+@pytest.mark.integrationtest
+def test_channel_events_needs_one_process(monkeypatch):
+    user_token = setup_test_user()
+    channel_id = setup_test_channel(user_token)
+    monkeypatch.setattr(config, "SERVER_PROCESSES", 4)
+    with pytest.raises(InputError):
+        channel.channel_events(user_token, [channel_id])
+
+
+@pytest.mark.integrationtest
+def test_channel_messages_since_failure():
+    user_token = setup_test_user()
+    channel_id = setup_test_channel(user_token)
+
+    with pytest.raises(InputError):
+        channel.channel_messages_since(user_token, -1)
+    other_user = auth_register("test2@test2.com", "ireallylovetrimesters", "John", "Smith")
+    with pytest.raises(AccessError):
+        channel.channel_messages_since(other_user['token'], channel_id)
+
+
 @pytest.mark.integrationtest
 def test_channel_leave_success():
     '''
@@ -836,6 +1007,69 @@ def test_channel_messages_http():
         assert channel_message['message'] == stored_message['message']
 
 
+@pytest.mark.systemtest
+def test_channel_messages_before_http():
+    user_data = setup_test_user_http("test@test.com")
+    channel_data = setup_test_channel_http(user_data['token'], True)
+    message_ids = []
+    for num in range(2):
+        response = requests.post(BASE_URL + "message/send", json={
+            "token": user_data['token'],
+            "channel_id": channel_data['channel_id'],
+            "message": f"Message number {num + 1}"
+        })
+        message_ids.append(response.json()['message_id'])
+
+    response = requests.get(BASE_URL + "channel/messages/before", params={
+        "token": user_data['token'],
+        "channel_id": channel_data['channel_id']
+    })
+    page = response.json()
+    assert [message['message_id'] for message in page['messages']] == message_ids[::-1]
+    assert page['next'] is None
+
+
+@pytest.mark.systemtest
+def test_channel_messages_since_http():
+    user_data = setup_test_user_http("test@test.com")
+    channel_data = setup_test_channel_http(user_data['token'], True)
+    params = {"token": user_data['token'], "channel_id": channel_data['channel_id']}
+    cursor = requests.get(BASE_URL + "channel/messages/since", params=params).json()['cursor']
+
+    response = requests.post(BASE_URL + "message/send", json={
+        **params, "message": "Hello"
+    })
+    message_id = response.json()['message_id']
+
+    response = requests.get(BASE_URL + "channel/messages/since",
+                            params={**params, "cursor": cursor})
+    changes = response.json()
+    assert [message['message_id'] for message in changes['messages']] == [message_id]
+    response = requests.get(BASE_URL + "channel/messages/since",
+                            params={**params, "cursor": changes['cursor']})
+    assert response.json()['messages'] == []
+
+
+@pytest.mark.systemtest
+def test_channel_events_http():
+    user_data = setup_test_user_http("test@test.com")
+    channel_data = setup_test_channel_http(user_data['token'], True)
+    params = {"token": user_data['token'], "channel_id": channel_data['channel_id']}
+    if config.SERVER_PROCESSES > 1:
+        # The server can't stream events with more than one process
+        assert requests.get(BASE_URL + "events", params=params, timeout=10).status_code == 400
+        return
+    with requests.get(BASE_URL + "events", params=params, stream=True, timeout=10) as stream:
+        assert stream.headers['Content-Type'].startswith("text/event-stream")
+        lines = stream.iter_lines(decode_unicode=True)
+        assert next(lines) == ": connected"
+        response = requests.post(BASE_URL + "message/send", json={**params, "message": "Hi"})
+        message_id = response.json()['message_id']
+        assert next(line for line in lines if line.startswith("event:")) == "event: message"
+        data = json.loads(next(lines)[len("data: "):])
+    assert data['message_id'] == message_id and data['message'] == "Hi"
+
+
 @pytest.mark.systemtest
 def test_channel_leave_http():
     # Create a user
@@ -12,33 +12,21 @@ def channels_list(token: str):
     if not check_valid_token(token):
         raise InputError(description="Invalid Token")
 
-    # get the list of all channel ids
-    channel_ids = abstractions.get_all_channel_ids()
-
     channels = []
 
     # get the user id from token
     user_id = get_user_from_token(token)
-    # look at all channels and
-    # see if the user is in the channel
+    # get the channels the user owns or is a member of
+    channel_ids = sorted(set(abstractions.get_owner_channel_ids(user_id))
+                         | set(abstractions.get_member_channel_ids(user_id)))
     for channel_id in channel_ids:
         channel_dict = abstractions.get_channel(channel_id)
-        if user_id in channel_dict['owner_member_ids']:
-
-            channels.append(
-                {
-                    'channel_id': channel_id,
-                    'name': channel_dict['channel_name']
-                }
-            )
-        elif user_id in channel_dict['user_member_ids']:
-
-            channels.append(
-                {
-                    'channel_id': channel_id,
-                    'name': channel_dict['channel_name']
-                }
-            )
+        channels.append(
+            {
+                'channel_id': channel_id,
+                'name': channel_dict['channel_name']
+            }
+        )
 
     return {
         "channels": channels,
@@ -0,0 +1,29 @@
+'''
+    Settings for the backend.
+    Each one can be changed with an environment variable.
+'''
+import os
+
+# Where abstractions.py keeps its data: "json" files or an "sqlite" database
+STORAGE_BACKEND = os.environ.get("SLACKR_STORAGE", "json")
+
+# How the JSON backend writes its data files: "json" (indented), "minified"
+# or "binary". Use serializers.py to convert existing files when changing it.
+STORAGE_FORMAT = os.environ.get("SLACKR_FORMAT", "json")
+
+# How many processes server.py handles requests with. More than one needs
+# fcntl (ie. not Windows) so that the processes can lock the data files.
+# Each request then gets a process of its own, so the in-memory search
+# cache is turned off, and /events is not supported (it answers with an
+# error, as events can't reach the process streaming them): clients poll
+# /channel/messages/since instead.
+SERVER_PROCESSES = int(os.environ.get("SLACKR_PROCESSES", "1"))
+
+# How many processes a relevance search that could match many messages is
+# split across: the candidate message ids are split into SEARCH_WORKERS * 2
+# ranges of ids, which the workers read and score. Searches in newest order
+# stop as soon as they have a page, so they don't use the workers. 0
+# searches in the process handling the request. The workers belong to the
+# server's main process, so they are only used when it handles requests
+# itself (ie. SERVER_PROCESSES is 1).
+SEARCH_WORKERS = int(os.environ.get("SLACKR_SEARCH_WORKERS", "0"))
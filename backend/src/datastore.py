@@ -0,0 +1,1243 @@
+'''
+    This file contains the in-memory store that sits behind abstractions.py.
+    Each JSON data file is parsed once and then served from memory.
+'''
+import contextlib
+import os
+import threading
+import journal
+import locks
+import serializers
+import text_index
+
+# How long (in seconds) a commit waits for other threads that are still
+# making changes, so that they can share the same write
+GROUP_COMMIT_WINDOW = 0.005
+# How many failed group commits to remember for the threads waiting on them
+GROUP_COMMIT_FAILURES = 16
+
+
+def upgrade_legacy_layout(data: dict, records_key: str, id_key: str):
+    '''
+    Convert data from the old list layout
+        {"<x>_ids": [1, 2], "<records>": [{...}, {...}]}
+    to the keyed layout
+        {"<records>": {"1": {...}, "2": {...}}}
+    Returns True if the data had to be changed.
+    '''
+    if not isinstance(data.get(records_key), list):
+        return False
+    data[records_key] = {
+        record[id_key]: record for record in data[records_key]
+    }
+    data.pop(f"{id_key}s", None)
+    return True
+
+
+def apply_change(record: dict, change: dict):
+    '''
+    Apply a field level change to a record in place, where change is one of
+        {"op": "patch", "fields": {<field>: <value>, ...}}
+        {"op": "append", "field": <field>, "value": <value>}
+        {"op": "remove", "field": <field>, "value": <value>}
+        {"op": "increment", "field": <field>, "amount": <number>}
+    The record's version goes up by one, as it would for an update.
+    A field that records from before it was added don't have is appended
+    to as an empty list and incremented from 0.
+    '''
+    if change['op'] == 'patch':
+        record.update(change['fields'])
+    elif change['op'] == 'append':
+        record.setdefault(change['field'], []).append(change['value'])
+    elif change['op'] == 'remove':
+        if change['value'] in record.get(change['field'], []):
+            record[change['field']].remove(change['value'])
+    elif change['op'] == 'increment':
+        record[change['field']] = record.get(change['field'], 0) + change['amount']
+    record['version'] = record.get('version', 0) + 1
+
+
+# The journal entries that change a single record with apply_change
+CHANGE_OPS = ('patch', 'append', 'remove', 'increment')
+
+
+def trigrams(text: str):
+    '''
+    Return the set of three character pieces of text (lower cased) that a
+    text field is indexed by. Any text that contains another contains all
+    of its trigrams, so they narrow a search down to the records that
+    could contain it. Text too short to have any is its own piece.
+    '''
+    text = (text or "").lower()
+    if len(text) < 3:
+        return {text} if text else set()
+    return {text[index:index + 3] for index in range(len(text) - 2)}
+
+
+class GroupCommit:
+    '''
+    Coalesces the saves of threads that finish changing the store at
+    about the same time into a single write of each changed file.
+
+    While a thread is inside batch(), saves are only recorded. When the
+    outermost batch() ends, the thread waits until its changes are on
+    disk. The first thread to wait becomes the leader: it gives any
+    other threads still inside batch() a short window to finish, then
+    writes every changed collection once for all of them. If a write
+    fails, every thread whose changes were part of it gets the error.
+    A commit that writes to more than one file records them all in the
+    intent first, so that it can be finished off after a crash.
+    '''
+
+    def __init__(self, lock, intent: journal.Intent = None,
+                 window: float = GROUP_COMMIT_WINDOW):
+        # The lock writers hold while changing the store
+        self.lock = lock
+        self.intent = intent
+        self.window = window
+        self._condition = threading.Condition()
+        self._local = threading.local()
+        self._pending = set()
+        self._writers = 0
+        self._requested = 0
+        self._committed = 0
+        self._leading = False
+        # (first change, last change, error) for recent failed commits
+        self._failures = []
+
+    def active(self):
+        '''
+        Return True if the calling thread is inside batch()
+        '''
+        return getattr(self._local, 'depth', 0) > 0
+
+    @contextlib.contextmanager
+    def batch(self):
+        '''
+        Defer saves made by this thread until the outermost batch() ends,
+        then wait for them to be committed
+        '''
+        if self.active():
+            self._local.depth += 1
+            try:
+                yield
+            finally:
+                self._local.depth -= 1
+            return
+        self._local.depth = 1
+        self._local.requested = 0
+        with self._condition:
+            self._writers += 1
+        try:
+            yield
+        finally:
+            self._local.depth = 0
+            with self._condition:
+                self._writers -= 1
+                self._condition.notify_all()
+            # Changes made before an exception are kept, so they still
+            # have to be written (and the file locks let go)
+            self.wait(self._local.requested)
+
+    @contextlib.contextmanager
+    def transaction(self):
+        '''
+        Like batch(), but holding self.lock throughout. If an exception is
+        raised, the changes made inside it are thrown away instead of
+        being committed.
+        '''
+        if self.active():
+            # Part of a larger set of changes (eg. a synchronised function),
+            # which are committed when it ends
+            with self.batch(), self.lock:
+                yield
+            return
+        while True:
+            self.lock.acquire()
+            with self._condition:
+                pending = set(self._pending)
+            # Other threads' changes waiting to be committed are kept, which
+            # can't be done for a file that is only ever written whole
+            marks = {collection: collection.mark() for collection in pending}
+            if None not in marks.values():
+                break
+            self.lock.release()
+            self._flush()
+        self._local.depth = 1
+        self._local.requested = 0
+        with self._condition:
+            self._writers += 1
+        try:
+            yield
+        except BaseException:
+            with self._condition:
+                pending = set(self._pending)
+                # Only collections that were already waiting have anything
+                # left to commit
+                self._pending &= set(marks)
+            for collection in pending:
+                collection.discard(marks.get(collection, 0))
+            raise
+        finally:
+            self._local.depth = 0
+            self.lock.release()
+            with self._condition:
+                self._writers -= 1
+                self._condition.notify_all()
+        self.wait(self._local.requested)
+
+    def _flush(self):
+        '''
+        Wait until every change so far has been committed
+        '''
+        with self._condition:
+            requested = self._requested
+        try:
+            self.wait(requested)
+        except Exception:  # pylint: disable=W0703
+            # That was another thread's commit, and that thread gets the error
+            pass
+
+    def defer(self, collection):
+        '''
+        Record that collection has changes to be committed
+        '''
+        with self._condition:
+            self._pending.add(collection)
+            self._requested += 1
+            self._local.requested = self._requested
+
+    def wait(self, requested: int):
+        '''
+        Wait until every change up to requested has been committed,
+        committing them (and any others) if no other thread is
+        '''
+        with self._condition:
+            while self._committed < requested:
+                if not self._leading:
+                    self._leading = True
+                    break
+                self._condition.wait()
+            else:
+                self._raise_failure(requested)
+                return
+            # Give threads that are still making changes a chance to join in
+            self._condition.wait_for(lambda: self._writers == 0, self.window)
+        self._commit()
+        with self._condition:
+            self._raise_failure(requested)
+
+    def _raise_failure(self, requested: int):
+        for first, last, error in self._failures:
+            if first < requested <= last:
+                raise error
+
+    def _commit(self):
+        try:
+            with self.lock:
+                with self._condition:
+                    pending, self._pending = self._pending, set()
+                    first, last = self._committed, self._requested
+                prepared = {collection: collection.prepare_commit() for collection in pending}
+                error = None
+                with contextlib.ExitStack() as stack:
+                    writes = [
+                        (collection.name, part[0], part[1])
+                        for collection, part in prepared.items() if part is not None
+                    ]
+                    if self.intent is not None and len(writes) > 1:
+                        stack.enter_context(self.intent.lock.locked(exclusive=True))
+                        for collection in prepared:
+                            # Keep other processes out until the intent is
+                            # cleared (and other threads, which share the file
+                            # lock, out while taking it)
+                            stack.enter_context(collection.lock)
+                            stack.enter_context(collection.file_lock.locked(exclusive=True))
+                        self.intent.write(writes)
+                        stack.callback(self.intent.clear)
+                    for collection, part in prepared.items():
+                        try:
+                            collection.commit(part)
+                        except Exception as exception:  # pylint: disable=W0703
+                            # That collection has dropped its changes, but the
+                            # others can still be written
+                            error = error or exception
+            with self._condition:
+                if error is not None:
+                    self._failures.append((first, last, error))
+                    del self._failures[:-GROUP_COMMIT_FAILURES]
+                self._committed = last
+        finally:
+            with self._condition:
+                self._leading = False
+                self._condition.notify_all()
+
+
+class Collection:
+    '''
+    A single JSON data file held in memory, with its records keyed by id.
+    The file is only parsed again if it has been changed on disk by
+    something else (eg. another process), and every change is written
+    straight through to disk, or by the group commit if there is one.
+    A lock file next to it is held shared while reading and exclusive
+    while changing it, so that other processes never see (or overwrite)
+    changes that have not been written yet.
+    The records are indexed by each of indexed_fields (value -> ids), so
+    that find() doesn't have to look through all of them. A list field
+    is indexed by its items, so find() returns the records whose list
+    holds the value. Each of text_fields is indexed by its trigrams, for
+    candidates().
+    '''
+
+    def __init__(self, path: str, records_key: str, id_key: str, serializer,
+                 group: GroupCommit = None, indexed_fields=(), text_fields=()):
+        self.path = path
+        self.name = os.path.splitext(os.path.basename(path))[0]
+        self.records_key = records_key
+        self.id_key = id_key
+        self.latest_key = f"latest_{id_key}"
+        self.serializer = serializer
+        self.group = group
+        self.lock = threading.RLock()
+        self.file_lock = locks.FileLock(f"{os.path.splitext(path)[0]}.lock")
+        self._data = None
+        self._signature = None
+        self._unsaved = False
+        self._pinned = False
+        self.indexed_fields = tuple(indexed_fields)
+        self.text_fields = tuple(text_fields)
+        # field -> value -> ids, built from the data the first time it is needed
+        self._index = None
+
+    def _disk_signature(self):
+        '''
+        Return something that changes whenever the file on disk changes.
+        '''
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+    def _load(self):
+        try:
+            data = self._read(self.path, self.records_key)
+        except FileNotFoundError:
+            # Nothing has been saved yet
+            data = {self.latest_key: 0, self.records_key: {}}
+        upgraded = upgrade_legacy_layout(data, self.records_key, self.id_key)
+        # JSON object keys are always strings, so turn them back into ids
+        # and keep them in id order (sort_keys sorts "10" before "2")
+        data[self.records_key] = {
+            int(record_id): record
+            for record_id, record in sorted(data[self.records_key].items(),
+                                            key=lambda item: int(item[0]))
+        }
+        self._data = data
+        self._index = None
+        self._signature = self._disk_signature()
+        if upgraded:
+            self.save()
+
+    def data(self):
+        '''
+        Return the live data for this collection.
+        Callers must hold self.lock while reading or changing it.
+        '''
+        with self.lock, self.file_lock.locked():
+            if self._data is None or (not self._unsaved
+                                      and self._disk_signature() != self._signature):
+                self._load()
+            return self._data
+
+    def records(self):
+        '''
+        Return the live id -> record mapping
+        '''
+        return self.data()[self.records_key]
+
+    def _build_index(self):
+        '''
+        Return the index, building it if the data has been (re)loaded
+        '''
+        records = self.records()
+        if self._index is None:
+            self._index = {
+                field: {} for field in self.indexed_fields + self.text_fields
+            }
+            for record in records.values():
+                self._add_to_index(record)
+        return self._index
+
+    def _index_keys(self, field: str, value):
+        '''
+        A list field is indexed by each of its items, and a text field by
+        its trigrams
+        '''
+        if field in self.text_fields:
+            return trigrams(value)
+        return value if isinstance(value, list) else (value,)
+
+    def _add_to_index(self, record: dict):
+        if self._index is None or record is None:
+            return
+        record_id = int(record[self.id_key])
+        for field, values in self._index.items():
+            for key in self._index_keys(field, record.get(field)):
+                values.setdefault(key, set()).add(record_id)
+
+    def _remove_from_index(self, record: dict):
+        if self._index is None or record is None:
+            return
+        record_id = int(record[self.id_key])
+        for field, values in self._index.items():
+            for key in self._index_keys(field, record.get(field)):
+                ids = values.get(key)
+                if ids is not None:
+                    ids.discard(record_id)
+                    if not ids:
+                        del values[key]
+
+    def _write(self, path: str, data: dict, records_key: str = None):
+        '''
+        Write data to a file
+        '''
+        self.serializer.dump(path, data, records_key)
+
+    def _read(self, path: str, records_key: str = None):
+        '''
+        Read data from a file
+        '''
+        return self.serializer.load(path, records_key)
+
+    def save(self):
+        '''
+        Write the collection back to disk, or leave it to the group
+        commit if this thread is in the middle of one.
+        '''
+        with self.lock:
+            self._unsaved = True
+            self._commit_later()
+
+    def _commit_later(self):
+        '''
+        Leave the changes to the group commit if this thread is in the
+        middle of one, otherwise write them now
+        '''
+        if self.group is not None and self.group.active():
+            if not self._pinned:
+                # Keep other processes out until the changes are written
+                self.file_lock.acquire(exclusive=True)
+                self._pinned = True
+            self.group.defer(self)
+        else:
+            self.commit()
+
+    def prepare_commit(self):
+        '''
+        Return what commit() would write, as (offset, data), or None if
+        there is nothing to write
+        '''
+        with self.lock:
+            if not self._unsaved:
+                return None
+            return None, self.serializer.dumps_document(self._data, self.records_key)
+
+    def commit(self, prepared: tuple = None):
+        '''
+        Write any saved changes that have not reached disk yet.
+        prepared is what prepare_commit() returned, if it has been called.
+        '''
+        with self.lock:
+            if prepared is None:
+                prepared = self.prepare_commit()
+            try:
+                if prepared is not None:
+                    with self.file_lock.locked(exclusive=True):
+                        self._write_prepared(*prepared)
+            except BaseException:
+                # Drop the changes (they are read again from disk) rather
+                # than keep other processes locked out
+                self._data = None
+                raise
+            finally:
+                self._clear_prepared()
+                if self._pinned:
+                    self._pinned = False
+                    self.file_lock.release()
+
+    def mark(self):
+        '''
+        Return a point that discard() can go back to, or None if there
+        are changes waiting to be committed that can't be kept apart from
+        any made after it
+        '''
+        with self.lock:
+            return None if self._unsaved else 0
+
+    def discard(self, mark: int = 0):
+        '''
+        Throw away the changes made since mark() returned mark that have
+        not been committed yet (the data is read again from disk)
+        '''
+        with self.lock:
+            if not self._unsaved:
+                return
+            self._data = None
+            self._clear_prepared()
+            if self._pinned:
+                self._pinned = False
+                self.file_lock.release()
+
+    def _write_prepared(self, _offset, data: bytes):
+        serializers.write_atomically(self.path, data)
+        self._signature = self._disk_signature()
+
+    def _clear_prepared(self):
+        self._unsaved = False
+
+    def redo(self, _offset, data: bytes):
+        '''
+        Write this collection's part of a commit that was interrupted
+        (see journal.Intent)
+        '''
+        with self.lock, self.file_lock.locked(exclusive=True):
+            serializers.write_atomically(self.path, data)
+            self._data = None
+
+    def reset(self, structure: dict):
+        '''
+        Replace everything in the collection with structure
+        '''
+        with self.lock, self.file_lock.locked(exclusive=True):
+            self._data = structure
+            self._data[self.records_key] = dict(structure[self.records_key])
+            self._index = None
+            self.save()
+
+    def next_id(self):
+        '''
+        Reserve and return the next unused id
+        '''
+        with self.lock, self.file_lock.locked(exclusive=True):
+            data = self.data()
+            data[self.latest_key] += 1
+            self.save()
+            return data[self.latest_key]
+
+    def get(self, record_id: int):
+        '''
+        Return the live record with the given id, or None
+        '''
+        with self.lock:
+            return self.records().get(int(record_id))
+
+    def get_many(self, record_ids: list):
+        '''
+        Return the live records with the given ids (None for any that
+        don't exist), in the same order, checking the data file only once
+        '''
+        with self.lock:
+            records = self.records()
+            return [records.get(int(record_id)) for record_id in record_ids]
+
+    def put(self, record: dict):
+        '''
+        Insert or replace a record and save
+        '''
+        with self.lock, self.file_lock.locked(exclusive=True):
+            records = self.records()
+            self._remove_from_index(records.get(int(record[self.id_key])))
+            records[int(record[self.id_key])] = record
+            self._add_to_index(record)
+            self.save()
+
+    def swap(self, record: dict, version: int):
+        '''
+        Replace a record and save, but only if the stored record is still
+        at version (records from before versions were added are at 0).
+        Returns None if there was no such record and False if it has
+        been changed since.
+        '''
+        with self.lock, self.file_lock.locked(exclusive=True):
+            current = self.get(record[self.id_key])
+            if current is None:
+                return None
+            if current.get('version', 0) != version:
+                return False
+            self.put(record)
+            return True
+
+    def change(self, record_id: int, change: dict):
+        '''
+        Apply a field level change (see apply_change) to a record and save.
+        Returns None if there was no such record.
+        '''
+        with self.lock, self.file_lock.locked(exclusive=True):
+            record = self.get(record_id)
+            if record is None:
+                return None
+            self._remove_from_index(record)
+            apply_change(record, change)
+            self._add_to_index(record)
+            self.save()
+            return True
+
+    def delete(self, record_id: int):
+        '''
+        Remove a record and save.
+        Returns None if there was no such record.
+        '''
+        with self.lock, self.file_lock.locked(exclusive=True):
+            record = self.records().pop(int(record_id), None)
+            if record is None:
+                return None
+            self._remove_from_index(record)
+            self.save()
+            return True
+
+    def get_meta(self, key: str, default=None):
+        '''
+        Get one of the values stored alongside the records
+        '''
+        with self.lock:
+            return self.data().get(key, default)
+
+    def set_meta(self, key: str, value):
+        '''
+        Set one of the values stored alongside the records and save
+        '''
+        with self.lock, self.file_lock.locked(exclusive=True):
+            self.data()[key] = value
+            self.save()
+
+    def add_to_meta(self, key: str, value):
+        '''
+        Append value to the list stored alongside the records under key
+        and save. Returns None if it was already there.
+        '''
+        with self.lock, self.file_lock.locked(exclusive=True):
+            values = self.get_meta(key, [])
+            if value in values:
+                return None
+            self.set_meta(key, values + [value])
+            return True
+
+    def remove_from_meta(self, key: str, value):
+        '''
+        Remove value from the list stored alongside the records under key
+        and save. Returns None if it wasn't there.
+        '''
+        with self.lock, self.file_lock.locked(exclusive=True):
+            values = self.get_meta(key, [])
+            if value not in values:
+                return None
+            self.set_meta(key, [item for item in values if item != value])
+            return True
+
+    def ids(self):
+        '''
+        Return a list of all record ids, oldest first
+        '''
+        with self.lock:
+            # Another process may have added them out of order
+            return sorted(self.records())
+
+    def count(self):
+        '''
+        Return how many records there are
+        '''
+        with self.lock:
+            return len(self.records())
+
+    def find(self, field: str, value):
+        '''
+        Return the ids of the records where record[field] == value (or,
+        for an indexed list field, where value is in record[field])
+        '''
+        with self.lock:
+            if field in self.indexed_fields:
+                return sorted(self._build_index()[field].get(value, ()))
+            return [
+                record_id for record_id, record in self.records().items()
+                if record.get(field) == value
+            ]
+
+    def select(self, record_ids: list, field: str, values):
+        '''
+        Return those of record_ids (in the same order) whose record[field]
+        is one of values, using the index if field is indexed rather than
+        reading the records
+        '''
+        values = set(values)
+        with self.lock:
+            if field in self.indexed_fields:
+                index = self._build_index()[field]
+                wanted = set().union(*(index.get(value, ()) for value in values))
+                return [record_id for record_id in record_ids if int(record_id) in wanted]
+            return [
+                record_id for record_id, record in zip(record_ids, self.get_many(record_ids))
+                if record is not None and record.get(field) in values
+            ]
+
+    def candidates(self, field: str, text: str):
+        '''
+        Return the ids of the records that could have text in
+        record[field] (ignoring case), in id order: those that have all of
+        the trigrams of text. Shorter text is in a record if it is in one
+        of the record's trigrams, so those are found by looking through the
+        trigrams that have been indexed (rather than the records).
+        '''
+        text = text.lower()
+        with self.lock:
+            index = self._build_index()[field]
+            if len(text) >= 3:
+                postings = [index.get(key, set()) for key in trigrams(text)]
+                # Start from the rarest trigram
+                postings.sort(key=len)
+                return sorted(postings[0].intersection(*postings[1:]))
+            if text:
+                return sorted(set().union(
+                    *(ids for key, ids in index.items() if text in key)))
+            return self.ids()
+
+
+class JournaledCollection(Collection):
+    '''
+    A collection whose changes are appended to a journal instead of
+    rewriting the whole data file every time.
+    The data file is a snapshot; loading it and replaying the journal
+    gives the current data. checkpoint() folds the journal back into
+    the snapshot.
+    '''
+
+    def __init__(self, path: str, records_key: str, id_key: str, serializer,
+                 group: GroupCommit = None, indexed_fields=(), text_fields=()):
+        super().__init__(path, records_key, id_key, serializer, group, indexed_fields,
+                         text_fields)
+        base_path = os.path.splitext(path)[0]
+        self.journal = journal.Journal(f"{base_path}.journal", serializer)
+        self._journal_offset = 0
+        # Entries waiting for the group commit to append them
+        self._staged = []
+
+    def data(self):
+        with self.lock, self.file_lock.locked():
+            if self._data is None or self._disk_signature() != self._signature:
+                # Load the snapshot and replay the whole journal
+                self._load()
+                self._journal_offset = 0
+                self.journal.entries = 0
+            if self.journal.size() > self._journal_offset:
+                # Catch up on anything appended since we last looked
+                entries, self._journal_offset = self.journal.read_from(
+                    self._journal_offset)
+                for entry in entries:
+                    self._apply(entry)
+            return self._data
+
+    def _apply(self, entry: dict):
+        '''
+        Apply one journal entry to the in-memory data
+        '''
+        if entry['op'] == 'put':
+            record = entry['record']
+            record_id = int(record[self.id_key])
+            self._remove_from_index(self._data[self.records_key].get(record_id))
+            self._data[self.records_key][record_id] = record
+            self._add_to_index(record)
+            self._data[self.latest_key] = max(
+                self._data[self.latest_key], record_id)
+        elif entry['op'] == 'delete':
+            self._remove_from_index(
+                self._data[self.records_key].pop(int(entry['id']), None))
+        elif entry['op'] == 'meta':
+            self._data[entry['key']] = entry['value']
+        elif entry['op'] in CHANGE_OPS:
+            record = self._data[self.records_key].get(int(entry['id']))
+            if record is not None:
+                self._remove_from_index(record)
+                apply_change(record, entry)
+                self._add_to_index(record)
+
+    def _log(self, entry: dict):
+        '''
+        Apply an entry in memory and append it to the journal.
+        The caller must hold the exclusive file lock.
+        '''
+        self.data()
+        self._apply(entry)
+        self._staged.append(entry)
+        self._commit_later()
+
+    def save(self):
+        # The snapshot is only written just before the journal is emptied,
+        # so it can't wait for the group commit
+        with self.lock, self.file_lock.locked(exclusive=True):
+            self._write(self.path, self._data, self.records_key)
+            self._signature = self._disk_signature()
+
+    def prepare_commit(self):
+        with self.lock:
+            if not self._staged:
+                return None
+            return self._journal_offset, self.journal.encode(self._staged)
+
+    def mark(self):
+        with self.lock:
+            return len(self._staged)
+
+    def discard(self, mark: int = 0):
+        with self.lock:
+            if len(self._staged) <= mark:
+                return
+            kept = self._staged[:mark]
+            # Read the committed data again and replay the changes that
+            # are kept on top of it
+            self._data = None
+            self._staged = []
+            self.data()
+            for entry in kept:
+                self._apply(entry)
+            self._staged = kept
+            if not kept and self._pinned:
+                self._pinned = False
+                self.file_lock.release()
+
+    def _write_prepared(self, offset: int, data: bytes):
+        self._journal_offset = self.journal.append(data, offset)
+
+    def _clear_prepared(self):
+        self._staged = []
+
+    def redo(self, offset: int, data: bytes):
+        with self.lock, self.file_lock.locked(exclusive=True):
+            size = self.journal.size()
+            if size < offset:
+                # It has been checkpointed into the snapshot since
+                return
+            written = self.journal.read_bytes(offset, len(data))
+            if written == data:
+                return
+            if data.startswith(written) and size == offset + len(written):
+                # The append was cut short
+                self.journal.append(data, offset)
+            else:
+                # Other changes have been appended since
+                self.journal.append(data, size)
+            self._data = None
+
+    def put(self, record: dict):
+        with self.lock, self.file_lock.locked(exclusive=True):
+            self._log({"op": "put", "record": record})
+
+    def next_id(self):
+        with self.lock, self.file_lock.locked(exclusive=True):
+            latest = self.data()[self.latest_key] + 1
+            self._log({"op": "meta", "key": self.latest_key, "value": latest})
+            return latest
+
+    def change(self, record_id: int, change: dict):
+        # Only the change is journaled, not the whole record
+        with self.lock, self.file_lock.locked(exclusive=True):
+            if self.get(record_id) is None:
+                return None
+            self._log(dict(change, id=int(record_id)))
+            return True
+
+    def delete(self, record_id: int):
+        with self.lock, self.file_lock.locked(exclusive=True):
+            if self.get(record_id) is None:
+                return None
+            self._log({"op": "delete", "id": int(record_id)})
+            return True
+
+    def set_meta(self, key: str, value):
+        with self.lock, self.file_lock.locked(exclusive=True):
+            self._log({"op": "meta", "key": key, "value": value})
+
+    def reset(self, structure: dict):
+        with self.lock, self.file_lock.locked(exclusive=True):
+            super().reset(structure)
+            self.journal.truncate()
+            self._journal_offset = 0
+            self._staged = []
+
+    def checkpoint(self):
+        '''
+        Write the current data as the new snapshot and empty the journal
+        '''
+        with self.lock, self.file_lock.locked(exclusive=True):
+            if self._staged:
+                # A group commit is about to append to the journal
+                return
+            self.data()
+            self.save()
+            self.journal.truncate()
+            self._journal_offset = 0
+
+
+class ShardedCollection(JournaledCollection):
+    '''
+    A journaled collection whose records are split into one file per
+    value of shard_key (eg. one file of messages per channel), kept in
+    <name>/<shard_key>_<value>.json (or .bin).
+    The main data file only holds the values stored alongside the records
+    and which shard each id lives in. A shard is only read from disk the
+    first time one of its records is used, so only text_fields are
+    indexed. Each shard's part of the index is saved next to it whenever
+    it is written (see text_index.py), so building the index the first
+    time candidates() is used only reads the shards changed since the last
+    checkpoint.
+    '''
+
+    def __init__(self, path: str, records_key: str, id_key: str, shard_key: str,
+                 serializer, group: GroupCommit = None, text_fields=()):
+        super().__init__(path, records_key, id_key, serializer, group,
+                         text_fields=text_fields)
+        self.shard_key = shard_key
+        self.shard_directory = os.path.splitext(path)[0]
+        # Shards that have been read: shard -> {id: record}
+        self._shards = {}
+        # Journal entries for shards that have not been read yet
+        self._pending = {}
+        # Shards changed since the last checkpoint
+        self._dirty = set()
+
+    def shard_path(self, shard):
+        '''
+        Return the file a shard is kept in
+        '''
+        file_name = f"{self.shard_key}_{shard}{self.serializer.extension}"
+        return os.path.join(self.shard_directory, file_name)
+
+    def text_index_path(self, shard, field: str):
+        '''
+        Return the file a shard's part of the index of a text field is kept in
+        '''
+        file_name = f"{self.shard_key}_{shard}.{field}{text_index.EXTENSION}"
+        return os.path.join(self.shard_directory, file_name)
+
+    def _load(self):
+        try:
+            data = self._read(self.path, self.records_key)
+        except FileNotFoundError:
+            # Nothing has been saved yet
+            data = {self.latest_key: 0, self.records_key: {}}
+        self._shards = {}
+        self._pending = {}
+        self._dirty = set()
+        self._index = None
+        records = data.pop(self.records_key, None)
+        data.pop(f"{self.id_key}s", None)
+        data['shard_index'] = {
+            int(record_id): shard
+            for record_id, shard in sorted(data.get('shard_index', {}).items(),
+                                           key=lambda item: int(item[0]))
+        }
+        # How many times each shard has been written, which its saved
+        # text indexes are checked against
+        data['shard_versions'] = {
+            int(shard) if isinstance(shard, str) and shard.isdigit() else shard: version
+            for shard, version in data.get('shard_versions', {}).items()
+        }
+        self._data = data
+        self._signature = self._disk_signature()
+        if records:
+            # This file is from before sharding, so split it up
+            if isinstance(records, dict):
+                records = records.values()
+            for record in records:
+                self._apply({"op": "put", "record": record})
+            self._write_shards()
+            self.save()
+
+    def _shard(self, shard):
+        '''
+        Return the live records in a shard, reading it if needed
+        '''
+        if shard not in self._shards:
+            try:
+                records = self._read(self.shard_path(shard))
+            except FileNotFoundError:
+                records = {}
+            self._shards[shard] = {
+                int(record_id): record
+                for record_id, record in sorted(records.items(),
+                                                key=lambda item: int(item[0]))
+            }
+            # A shard whose saved index was used (or that is new since the
+            # index was built) needs its records in the index from now on
+            for record in self._shards[shard].values():
+                self._add_to_index(record)
+            # These were found in the shard index when they were applied,
+            # which deletes have since taken out of it
+            for entry in self._pending.pop(shard, []):
+                self._apply_to_shard(shard, entry)
+        return self._shards[shard]
+
+    def _apply(self, entry: dict):
+        if entry['op'] == 'meta':
+            super()._apply(entry)
+            return
+        shard_index = self._data['shard_index']
+        if entry['op'] == 'put':
+            record = entry['record']
+            record_id = int(record[self.id_key])
+            shard = record[self.shard_key]
+            shard_index[record_id] = shard
+            self._data[self.latest_key] = max(
+                self._data[self.latest_key], record_id)
+        elif entry['op'] == 'delete':
+            record_id = int(entry['id'])
+            shard = shard_index.pop(record_id, None)
+        else:
+            record_id = int(entry['id'])
+            shard = shard_index.get(record_id)
+        if shard is None:
+            return
+        self._dirty.add(shard)
+        if shard not in self._shards and self._index is not None:
+            # The index has to see it, so read the shard now
+            self._shard(shard)
+        if shard not in self._shards:
+            # Apply it when the shard gets read
+            self._pending.setdefault(shard, []).append(entry)
+        else:
+            self._apply_to_shard(shard, entry)
+
+    def _apply_to_shard(self, shard, entry: dict):
+        '''
+        Apply a journal entry to the records of a shard that has been read
+        '''
+        records = self._shards[shard]
+        if entry['op'] == 'put':
+            record = entry['record']
+            record_id = int(record[self.id_key])
+            self._remove_from_index(records.get(record_id))
+            records[record_id] = record
+            self._add_to_index(record)
+            return
+        record_id = int(entry['id'])
+        if entry['op'] == 'delete':
+            self._remove_from_index(records.pop(record_id, None))
+        elif record_id in records:
+            self._remove_from_index(records[record_id])
+            apply_change(records[record_id], entry)
+            self._add_to_index(records[record_id])
+
+    def _write_shards(self):
+        '''
+        Write every shard that has changed since the last checkpoint
+        '''
+        os.makedirs(self.shard_directory, exist_ok=True)
+        versions = self._data.setdefault('shard_versions', {})
+        for shard in self._dirty:
+            records = self._shard(shard)
+            version = versions.get(shard, 0) + 1
+            # The index is written first, so that if there is a crash
+            # before the main data file has the new version, neither the
+            # old nor the new index is used
+            for field in self.text_fields:
+                postings = {}
+                for record in records.values():
+                    for key in trigrams(record.get(field)):
+                        postings.setdefault(key, set()).add(int(record[self.id_key]))
+                text_index.write(self.text_index_path(shard, field), version, postings)
+            self._write(self.shard_path(shard), records)
+            versions[shard] = version
+        self._dirty = set()
+
+    def _build_index(self):
+        data = self.data()
+        if self._index is None:
+            index = {field: {} for field in self.text_fields}
+            versions = data.get('shard_versions', {})
+            for shard in sorted(set(data['shard_index'].values())):
+                if shard not in self._shards and shard not in self._dirty:
+                    saved = [
+                        text_index.read(self.text_index_path(shard, field),
+                                        versions.get(shard, 0))
+                        for field in self.text_fields
+                    ]
+                    if None not in saved:
+                        for field, postings in zip(self.text_fields, saved):
+                            for key, ids in postings.items():
+                                index[field].setdefault(key, set()).update(ids)
+                        continue
+                # It has changed since it was saved, so index its records
+                for record in self._shard(shard).values():
+                    record_id = int(record[self.id_key])
+                    for field in self.text_fields:
+                        for key in trigrams(record.get(field)):
+                            index[field].setdefault(key, set()).add(record_id)
+            self._index = index
+        return self._index
+
+    def records(self):
+        with self.lock, self.file_lock.locked():
+            records = {}
+            for shard in set(self.data()['shard_index'].values()):
+                records.update(self._shard(shard))
+            return dict(sorted(records.items()))
+
+    def get(self, record_id: int):
+        with self.lock, self.file_lock.locked():
+            shard = self.data()['shard_index'].get(int(record_id))
+            if shard is None:
+                return None
+            return self._shard(shard).get(int(record_id))
+
+    def get_many(self, record_ids: list):
+        with self.lock, self.file_lock.locked():
+            shard_index = self.data()['shard_index']
+            records = []
+            for record_id in record_ids:
+                shard = shard_index.get(int(record_id))
+                records.append(None if shard is None
+                               else self._shard(shard).get(int(record_id)))
+            return records
+
+    def select(self, record_ids: list, field: str, values):
+        if field != self.shard_key:
+            return super().select(record_ids, field, values)
+        values = set(values)
+        with self.lock, self.file_lock.locked():
+            shard_index = self.data()['shard_index']
+            return [
+                record_id for record_id in record_ids
+                if shard_index.get(int(record_id)) in values
+            ]
+
+    def ids(self):
+        with self.lock, self.file_lock.locked():
+            return sorted(self.data()['shard_index'])
+
+    def count(self):
+        with self.lock, self.file_lock.locked():
+            return len(self.data()['shard_index'])
+
+    def find(self, field: str, value):
+        if field != self.shard_key:
+            return super().find(field, value)
+        with self.lock, self.file_lock.locked():
+            self.data()
+            return list(self._shard(value))
+
+    def reset(self, structure: dict):
+        with self.lock, self.file_lock.locked(exclusive=True):
+            if os.path.isdir(self.shard_directory):
+                for file_name in os.listdir(self.shard_directory):
+                    if file_name.endswith((self.serializer.extension, text_index.EXTENSION)):
+                        os.remove(os.path.join(self.shard_directory, file_name))
+            self._shards = {}
+            self._pending = {}
+            self._dirty = set()
+            self._index = None
+            self._data = {
+                key: value for key, value in structure.items()
+                if key != self.records_key
+            }
+            self._data['shard_index'] = {}
+            for record in structure[self.records_key].values():
+                self._apply({"op": "put", "record": record})
+            self._write_shards()
+            self.save()
+            self.journal.truncate()
+            self._journal_offset = 0
+            self._staged = []
+
+    def checkpoint(self):
+        with self.lock, self.file_lock.locked(exclusive=True):
+            if self._staged:
+                # A group commit is about to append to the journal
+                return
+            self.data()
+            self._write_shards()
+            self.save()
+            self.journal.truncate()
+            self._journal_offset = 0
+
+
+class Store:
+    '''
+    All of the collections used by the program, created on first use.
+    '''
+
+    def __init__(self, directory: str, layouts: dict, serializer,
+                 journaled=(), sharded=None, indexes=None, list_indexes=None,
+                 text_indexes=None):
+        self.directory = directory
+        self.layouts = layouts
+        self.serializer = serializer
+        self.journaled = journaled
+        self.sharded = sharded or {}
+        self.indexes = indexes or {}
+        self.list_indexes = list_indexes or {}
+        self.text_indexes = text_indexes or {}
+        self.lock = threading.RLock()
+        self.intent = journal.Intent(os.path.join(directory, "commit.intent"))
+        self.group = GroupCommit(self.lock, self.intent)
+        self._collections = {}
+
+    def group_commit(self):
+        '''
+        Context manager for a set of changes that can share a commit with
+        changes made by other threads at the same time
+        '''
+        return self.group.batch()
+
+    def transaction(self):
+        '''
+        Context manager for a set of changes that are written together,
+        or thrown away if an exception is raised
+        '''
+        return self.group.transaction()
+
+    def recover(self):
+        '''
+        Finish off a commit that a crashed process was part way through
+        writing
+        '''
+        with self.lock:
+            with self.intent.lock.locked(exclusive=True):
+                # This waits for a commit that is still being written
+                parts = self.intent.read()
+            if not parts:
+                return
+            for name, offset, data in parts:
+                self.collection(name).redo(offset, data)
+            with self.intent.lock.locked(exclusive=True):
+                if self.intent.read() == parts:
+                    self.intent.clear()
+
+    def collection(self, name: str):
+        '''
+        Get the collection stored in <directory>/<name>.json (or .bin)
+        '''
+        with self.lock:
+            if name not in self._collections:
+                records_key, id_key = self.layouts[name]
+                path = os.path.join(self.directory, name + self.serializer.extension)
+                indexed_fields = self.indexes.get(name, ()) + self.list_indexes.get(name, ())
+                text_fields = self.text_indexes.get(name, ())
+                if name in self.sharded:
+                    self._collections[name] = ShardedCollection(
+                        path, records_key, id_key, self.sharded[name], self.serializer,
+                        self.group, text_fields)
+                elif name in self.journaled:
+                    self._collections[name] = JournaledCollection(
+                        path, records_key, id_key, self.serializer, self.group,
+                        indexed_fields, text_fields)
+                else:
+                    self._collections[name] = Collection(
+                        path, records_key, id_key, self.serializer, self.group,
+                        indexed_fields, text_fields)
+            return self._collections[name]
+
+    def journaled_collections(self):
+        '''
+        Return the journaled (and sharded) collections
+        '''
+        names = set(self.journaled) | set(self.sharded)
+        return [self.collection(name) for name in sorted(names)]
@@ -27,3 +27,10 @@ class DataError(Exception):
     Raised when attempting to change protected data
     '''
     pass
+
+
+class ConflictError(Exception):
+    '''
+    Raised when updating a record that has been changed since it was read
+    '''
+    pass
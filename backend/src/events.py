@@ -0,0 +1,148 @@
+'''
+    This file contains an in-process publish/subscribe hub, which pushes
+    what happens in channels (new messages, edits, reactions, standups
+    and hangman games) to the clients listening on /events.
+'''
+import collections
+import json
+import threading
+import time
+
+# How often (in seconds) a comment is sent down an idle stream, so that
+# proxies keep it open and a client that has gone away is noticed
+HEARTBEAT_INTERVAL = 15
+# How many events can wait for a slow client before they are dropped
+# (and it is told to catch up with /channel/messages/since instead)
+SUBSCRIBER_QUEUE = 100
+
+
+class Subscription:
+    '''
+    The events for one client, from the channels it is listening to.
+    Only a bounded number are kept: if the client falls that far behind,
+    they are dropped and it gets a single "overflow" event instead.
+    '''
+
+    def __init__(self, channel_ids, limit: int = SUBSCRIBER_QUEUE):
+        self.channel_ids = frozenset(channel_ids)
+        self.limit = limit
+        self._events = collections.deque()
+        self._overflowed = False
+        self._condition = threading.Condition()
+
+    def put(self, event: str, data: dict):
+        '''
+        Queue an event, without ever blocking the publisher
+        '''
+        with self._condition:
+            if self._overflowed:
+                return
+            if len(self._events) >= self.limit:
+                self._events.clear()
+                self._overflowed = True
+            else:
+                self._events.append((event, data))
+            self._condition.notify()
+
+    def get(self, timeout: float):
+        '''
+        Wait up to timeout seconds for events and return all of them,
+        oldest first ([] if there weren't any)
+        '''
+        with self._condition:
+            if not self._events and not self._overflowed:
+                self._condition.wait(timeout)
+            if self._overflowed:
+                self._overflowed = False
+                return [("overflow", {"channel_ids": sorted(self.channel_ids)})]
+            events = list(self._events)
+            self._events.clear()
+            return events
+
+
+class Hub:
+    '''
+    Passes the events published for a channel to everyone subscribed to it
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # channel_id -> the subscriptions listening to it
+        self._subscriptions = collections.defaultdict(set)
+
+    def subscribe(self, channel_ids, limit: int = SUBSCRIBER_QUEUE):
+        '''
+        Start listening to the given channels
+        '''
+        subscription = Subscription(channel_ids, limit)
+        with self._lock:
+            for channel_id in subscription.channel_ids:
+                self._subscriptions[channel_id].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        '''
+        Stop listening
+        '''
+        with self._lock:
+            for channel_id in subscription.channel_ids:
+                self._subscriptions[channel_id].discard(subscription)
+                if not self._subscriptions[channel_id]:
+                    del self._subscriptions[channel_id]
+
+    def publish(self, channel_id: int, event: str, data: dict):
+        '''
+        Send an event to everyone listening to the channel
+        '''
+        with self._lock:
+            subscriptions = list(self._subscriptions.get(int(channel_id), ()))
+        for subscription in subscriptions:
+            subscription.put(event, dict(data, channel_id=int(channel_id)))
+
+    def listening(self, channel_id: int):
+        '''
+        Return whether anyone is listening to the channel
+        '''
+        with self._lock:
+            return int(channel_id) in self._subscriptions
+
+
+HUB = Hub()
+
+
+def publish(channel_id: int, event: str, data: dict):
+    '''
+    Send an event to everyone listening to the channel (see Hub)
+    '''
+    HUB.publish(channel_id, event, data)
+
+
+def format_event(event: str, data: dict):
+    '''
+    Return an event in the text/event-stream format
+    '''
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def stream(channel_ids, heartbeat: float = HEARTBEAT_INTERVAL):
+    '''
+    Generator of the text/event-stream for the given channels, which
+    stops listening once the client goes away.
+    Only events published by this process reach it.
+    '''
+    subscription = HUB.subscribe(channel_ids)
+    try:
+        # Let the client know it is listening before anything happens
+        yield ": connected\n\n"
+        last_sent = time.monotonic()
+        while True:
+            events = subscription.get(heartbeat)
+            now = time.monotonic()
+            if events:
+                yield "".join(format_event(event, data) for event, data in events)
+                last_sent = now
+            elif now - last_sent >= heartbeat:
+                yield ": heartbeat\n\n"
+                last_sent = now
+    finally:
+        HUB.unsubscribe(subscription)
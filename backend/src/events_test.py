@@ -0,0 +1,46 @@
+'''
+Tests for the publish/subscribe hub in events.py
+'''
+import events
+
+# pylint: disable=C0116
+
+
+def test_events_only_reach_their_channel():
+    first = events.HUB.subscribe([1])
+    both = events.HUB.subscribe([1, 2])
+    try:
+        events.publish(2, "message", {"message_id": 5})
+        assert first.get(0) == []
+        assert both.get(0) == [("message", {"message_id": 5, "channel_id": 2})]
+        assert events.HUB.listening(1) and not events.HUB.listening(3)
+    finally:
+        events.HUB.unsubscribe(first)
+        events.HUB.unsubscribe(both)
+    assert not events.HUB.listening(1)
+
+
+def test_slow_subscribers_are_told_to_catch_up():
+    subscription = events.HUB.subscribe([1], limit=3)
+    try:
+        for message_id in range(10):
+            events.publish(1, "message", {"message_id": message_id})
+        assert subscription.get(0) == [("overflow", {"channel_ids": [1]})]
+        # It starts again from there
+        events.publish(1, "message", {"message_id": 10})
+        assert subscription.get(0) == [("message", {"message_id": 10, "channel_id": 1})]
+    finally:
+        events.HUB.unsubscribe(subscription)
+
+
+def test_stream():
+    stream = events.stream([1], heartbeat=0.05)
+    assert next(stream) == ": connected\n\n"
+    assert events.HUB.listening(1)
+    # Nothing happens, so the connection is kept alive
+    assert next(stream) == ": heartbeat\n\n"
+    events.publish(1, "hangman", {"lives": 9})
+    assert next(stream) == 'event: hangman\ndata: {"lives": 9, "channel_id": 1}\n\n'
+    # The client going away closes the stream
+    stream.close()
+    assert not events.HUB.listening(1)
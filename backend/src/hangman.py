@@ -4,6 +4,7 @@ Backend functionality for hangman
 from random_word import RandomWords
 from random_words import RandomWords as alternateRandomWords
 import abstractions
+import events
 from auth import get_user_from_token, check_valid_token
 from error import InputError, AccessError
 
@@ -32,14 +33,14 @@ def hangman_start(token: str, channel_id: int):
     if channel['hangman_id'] is not None:
         raise InputError(description="Hangman game already in progress")
     hangman_id = create_game(authed_user_id, channel_id)
-    channel['hangman_id'] = hangman_id
-    abstractions.update_channel(channel_id, channel)
+    abstractions.patch_channel(channel_id, {"hangman_id": hangman_id})
     hangman_game = abstractions.get_hangman(hangman_id)
     return_dict = {
         "guesses": hangman_game['guesses'],
         "lives": hangman_game['lives'],
         "incorrect_guesses": hangman_game['incorrect_guesses'],
     }
+    events.publish(channel_id, "hangman", dict(return_dict, finished=False))
     return return_dict
 
 
@@ -86,8 +87,7 @@ def hangman_details(token: str, channel_id: int):
     hangman = abstractions.get_hangman(channel['hangman_id'])
     # Check if the game has finished and if so update it
     if hangman['finished'] is True:
-        channel['hangman_id'] = None
-        abstractions.update_channel(channel_id, channel)
+        abstractions.patch_channel(channel_id, {"hangman_id": None})
     return_dict = {
         "guesses": hangman['guesses'],
         "lives": hangman['lives'],
@@ -132,8 +132,13 @@ def hangman_guess(token: str, channel_id: int, guess: str):
 
     # check if the game is finished
     if hangman['finished'] is True:
-        channel['hangman_id'] = None
-        abstractions.update_channel(channel_id, channel)
+        abstractions.patch_channel(channel_id, {"hangman_id": None})
+    events.publish(channel_id, "hangman", {
+        "guesses": guesses,
+        "incorrect_guesses": incorrect_guesses,
+        "lives": lives,
+        "finished": hangman['finished'],
+    })
     return {
         "guesses": guesses,
         "incorrect_guesses": incorrect_guesses,
@@ -0,0 +1,188 @@
+'''
+    This file contains an append-only journal (write-ahead log) for a
+    collection, and a background thread that folds journals back into
+    their snapshot files.
+'''
+import json
+import os
+import struct
+import threading
+import locks
+import serializers
+
+# How often the checkpointer wakes up, in seconds
+CHECKPOINT_INTERVAL = 5
+# How many journal entries there need to be before a checkpoint happens
+CHECKPOINT_ENTRIES = 500
+
+
+class Journal:
+    '''
+    One entry per line, appended to <path>.
+    The collection's lock must be held while using it, so that another
+    process can't checkpoint while this one is reading or appending.
+    '''
+
+    def __init__(self, path: str, serializer):
+        self.path = path
+        self.serializer = serializer
+        self.entries = 0
+        if not os.path.exists(self.path):
+            open(self.path, 'a').close()
+
+    def size(self):
+        '''
+        Return the size of the journal in bytes
+        '''
+        try:
+            return os.path.getsize(self.path)
+        except FileNotFoundError:
+            return 0
+
+    def encode(self, entries: list):
+        '''
+        Return the bytes to append for a list of entries
+        '''
+        return "".join(
+            self.serializer.dumps_entry(entry) + "\n" for entry in entries
+        ).encode()
+
+    def append(self, data: bytes, offset: int):
+        '''
+        Append encoded entries after offset (the end of the last complete
+        entry), flush them to disk and return the offset of the end of
+        the journal.
+        '''
+        if self.size() > offset:
+            # Drop a partly written entry left behind by a crash
+            os.truncate(self.path, offset)
+        with open(self.path, 'ab') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+            self.entries += data.count(b"\n")
+            return f.tell()
+
+    def read_bytes(self, offset: int, length: int):
+        '''
+        Return up to length bytes of the journal from offset
+        '''
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            return f.read(length)
+
+    def read_from(self, offset: int):
+        '''
+        Read all complete entries after offset.
+        Returns the entries and the offset just after the last one.
+        A partly written last line (eg. from a crash) is left alone.
+        '''
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            tail = f.read()
+        end = tail.rfind(b"\n") + 1
+        entries = [
+            self.serializer.loads_entry(line)
+            for line in tail[:end].splitlines() if line
+        ]
+        self.entries += len(entries)
+        return entries, offset + end
+
+    def truncate(self):
+        '''
+        Empty the journal
+        '''
+        open(self.path, 'w').close()
+        self.entries = 0
+
+
+class Intent:
+    '''
+    A redo record for a commit that writes to several files.
+    It is written (atomically) before any of the files, and removed once
+    they have all been written, so if a crash happens in between the
+    commit can be finished off rather than leaving only some of the
+    files changed. The lock stops another process finishing off a
+    commit that is still being written.
+    '''
+    frame_header = struct.Struct('>I')
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = locks.FileLock(f"{os.path.splitext(path)[0]}.lock")
+
+    def _frame(self, data: bytes):
+        return self.frame_header.pack(len(data)) + data
+
+    def write(self, parts: list):
+        '''
+        Record the commit, given as a list of (collection name, offset, data)
+        '''
+        header = json.dumps([[name, offset] for name, offset, _ in parts]).encode()
+        frames = [self._frame(header)] + [self._frame(data) for _, _, data in parts]
+        serializers.write_atomically(self.path, b"".join(frames))
+
+    def read(self):
+        '''
+        Return the parts of an unfinished commit, or [] if there isn't one
+        '''
+        try:
+            with open(self.path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return []
+        frames = []
+        offset = 0
+        while offset < len(data):
+            (length,) = self.frame_header.unpack_from(data, offset)
+            offset += self.frame_header.size
+            frames.append(data[offset:offset + length])
+            offset += length
+        header = json.loads(frames[0])
+        return [(name, position, part) for (name, position), part in zip(header, frames[1:])]
+
+    def clear(self):
+        '''
+        Remove the record once the commit is finished
+        '''
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class Checkpointer(threading.Thread):
+    '''
+    Background thread that checkpoints journaled collections once their
+    journals have grown long enough.
+    '''
+
+    def __init__(self, collections, interval: float = CHECKPOINT_INTERVAL,
+                 entries: int = CHECKPOINT_ENTRIES):
+        super().__init__(daemon=True)
+        self.collections = collections
+        self.interval = interval
+        self.min_entries = entries
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            for collection in self.collections():
+                # Catch up on entries appended by other processes
+                collection.data()
+                if collection.journal.entries >= self.min_entries:
+                    collection.checkpoint()
+
+    def stop(self):
+        '''
+        Stop the thread after its current pass
+        '''
+        self.stopped.set()
+
+
+def start_checkpointer(collections, interval: float = CHECKPOINT_INTERVAL,
+                       entries: int = CHECKPOINT_ENTRIES):
+    '''
+    Start a checkpointer for the collections returned by collections()
+    '''
+    checkpointer = Checkpointer(collections, interval, entries)
+    checkpointer.start()
+    return checkpointer
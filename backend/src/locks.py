@@ -0,0 +1,79 @@
+'''
+    This file contains a lock that works across processes, so that several
+    server processes can share the data files.
+    Readers take it shared and writers take it exclusive.
+'''
+import contextlib
+import os
+
+try:
+    import fcntl
+except ImportError:                                 # pragma: no cover
+    # Not available on Windows, where only one process can be used
+    fcntl = None
+
+
+class FileLock:
+    '''
+    An flock on a lock file, held by the whole process.
+    Threads must already be kept apart by a thread lock (eg. a
+    collection's lock) while taking or letting go of it.
+    Taking it again while it is held just counts, so the lock can be
+    held past the end of the call that took it (eg. until a group
+    commit has written the changes made under it).
+    '''
+
+    def __init__(self, path: str):
+        self.path = path
+        self.exclusive = False
+        self._file = None
+        self._pid = None
+        self._depth = 0
+
+    def _lock_file(self):
+        if self._pid != os.getpid():
+            # A forked process shares its parent's open files (and so its
+            # flocks), so it needs a file of its own
+            self._file = open(self.path, 'a')
+            self._pid = os.getpid()
+            self._depth = 0
+        return self._file
+
+    def _flock(self, mode: str):
+        if fcntl is not None:
+            fcntl.flock(self._lock_file().fileno(), getattr(fcntl, mode))
+
+    def acquire(self, exclusive: bool = False):
+        '''
+        Take the lock, waiting for other processes to let it go.
+        Asking for an exclusive lock while holding a shared one upgrades
+        it, which lets other processes in between.
+        '''
+        self._lock_file()
+        if self._depth == 0:
+            self._flock('LOCK_EX' if exclusive else 'LOCK_SH')
+            self.exclusive = exclusive
+        elif exclusive and not self.exclusive:
+            self._flock('LOCK_EX')
+            self.exclusive = True
+        self._depth += 1
+
+    def release(self):
+        '''
+        Let go of the lock taken by the matching acquire()
+        '''
+        self._depth -= 1
+        if self._depth == 0:
+            self._flock('LOCK_UN')
+            self.exclusive = False
+
+    @contextlib.contextmanager
+    def locked(self, exclusive: bool = False):
+        '''
+        Hold the lock for the duration of a with block
+        '''
+        self.acquire(exclusive)
+        try:
+            yield
+        finally:
+            self.release()
@@ -2,12 +2,22 @@
     Python program that has all functions about message of slackr
 '''
 import datetime
+import os
 import abstractions
 import auth
+import events
+import scheduler
 from error import AccessError, InputError
 
 # pylint: disable=R1719
 
+# Delivers the messages that are sent later, started the first time one
+# is scheduled (or by the server)
+SCHEDULER = None
+# Whether this process delivers them (the server turns it off when a
+# process of its own does instead)
+DELIVERS_MESSAGES = True
+
 
 def message_send(token: str, channel_id: int, message: str):
     '''
@@ -24,8 +34,8 @@ def message_send(token: str, channel_id: int, message: str):
     # check if the messaage string length exceeds 1000 characters
     if len(message) > 1000:
         raise InputError(description="Message is more than 1000 characters.")
-    # Check for unsent messages
-    check_unsent_messages()
+    # Send any messages that were due first
+    send_due_messages()
     # get the authorised user"s id
     auth_user_id = auth.get_user_from_token(token)
     # get the channel detail (dictionary)
@@ -33,12 +43,12 @@ def message_send(token: str, channel_id: int, message: str):
     # check if the authorised user is in the channel_data (dict)
     if auth_user_id not in channel_data["user_member_ids"]:
         raise AccessError(description="The user is not in the channel.")
-    message_id = abstractions.create_message(auth_user_id, message, channel_id)
-    # append the message id to channel["message_ids"] (list)
-    channel_data["message_ids"].append(message_id)
-    channel_data['message_count'] += 1
-    # update this channel since new message is created
-    abstractions.update_channel(channel_id, channel_data)
+    # the message and the channel's list of messages are written together
+    with abstractions.transaction():
+        message_id = abstractions.create_message(auth_user_id, message, channel_id)
+        # update this channel since new message is created
+        add_channel_message(channel_id, message_id)
+    publish_message(message_id)
     return {
         "message_id": message_id
     }
@@ -69,16 +79,18 @@ def message_sendlater(token: str, channel_id: int, message: str, time_sent: int)
     # check if the authorised user is in the channel_data (dict)
     if auth_user_id not in channel_data["user_member_ids"]:
         raise AccessError(description="The user is not in the channel.")
-    message_id = abstractions.create_message(auth_user_id, message, channel_id)
-    message_data = abstractions.get_message(message_id)
-    message_data["time"] = datetime.datetime.fromtimestamp(time_sent)
-    abstractions.create_unsent_message_id(message_id)
-    abstractions.update_message(message_id, message_data)
+    time_to_send = datetime.datetime.fromtimestamp(time_sent)
+    with abstractions.transaction():
+        message_id = abstractions.create_message(auth_user_id, message, channel_id)
+        abstractions.create_unsent_message_id(message_id)
+        abstractions.patch_message(message_id, {"time": time_to_send})
+    schedule_message(message_id, time_to_send)
     return {
         "message_id": message_id
     }
 
 
+@abstractions.retry_on_conflict
 def message_react(token: str, message_id: int, react_id: int):
     '''
     Given a message within a channel the authorised user is part of,
@@ -118,11 +130,15 @@ def message_react(token: str, message_id: int, react_id: int):
             "u_ids": [auth_user_id],
         }
         message_data["reactions"].append(new_reaction_data)
-    abstractions.update_message(message_id, message_data)
+    with abstractions.transaction():
+        abstractions.update_message(message_id, message_data)
+        record_message_change(message_data["channel_id"], message_id)
+    publish_message(message_id)
 
     return {}
 
 
+@abstractions.retry_on_conflict
 def message_unreact(token: str, message_id: int, react_id: int):
     '''
     Given a message within a channel the authorised user is part of,
@@ -151,7 +167,10 @@ def message_unreact(token: str, message_id: int, react_id: int):
     for dictionary in message_data["reactions"]:
         if dictionary["react_id"] == react_id:
             dictionary["u_ids"].remove(auth_user_id)
-    abstractions.update_message(message_id, message_data)
+    with abstractions.transaction():
+        abstractions.update_message(message_id, message_data)
+        record_message_change(message_data["channel_id"], message_id)
+    publish_message(message_id)
 
     return {}
 
@@ -184,8 +203,10 @@ def message_pin(token: str, message_id: int):
     if auth_user_id not in channel_data["user_member_ids"]:
         raise AccessError(
             description="User is not a member of the channel where the message is.")
-    message_data["pinned"] = True
-    abstractions.update_message(message_id, message_data)
+    with abstractions.transaction():
+        abstractions.patch_message(message_id, {"pinned": True})
+        record_message_change(message_data["channel_id"], message_id)
+    publish_message(message_id)
 
     return {}
 
@@ -217,8 +238,10 @@ def message_unpin(token: str, message_id: int):
     if auth_user_id not in channel_data["user_member_ids"]:
         raise AccessError(
             description="User is not a member of the channel that the message is within.")
-    message_data["pinned"] = False
-    abstractions.update_message(message_id, message_data)
+    with abstractions.transaction():
+        abstractions.patch_message(message_id, {"pinned": False})
+        record_message_change(message_data["channel_id"], message_id)
+    publish_message(message_id)
     return {}
 
 
@@ -246,11 +269,14 @@ def message_remove(token: str, message_id: int):
         raise AccessError(
             description="The authorised user is not the author of this message.")
     # Input error: if the message (base on message_id) no longer exists
-    if abstractions.delete_message(message_id) is None:
-        raise InputError(description="Message (based on ID) no longer exists.")
-    channel_data['message_count'] -= 1
-    channel_data['message_ids'].remove(message_id)
-    abstractions.update_channel(channel_data['channel_id'], channel_data)
+    with abstractions.transaction():
+        # A message waiting to be sent later isn't in its channel yet.
+        # Otherwise it is taken out while its last change can be looked up.
+        if abstractions.delete_unsent_message_id(message_id) is None:
+            remove_channel_message(channel_data['channel_id'], message_id)
+        if abstractions.delete_message(message_id) is None:
+            raise InputError(description="Message (based on ID) no longer exists.")
+    events.publish(channel_data['channel_id'], "message_removed", {"message_id": message_id})
     return {}
 
 
@@ -275,63 +301,172 @@ def message_edit(token: str, message_id: int, message: str):
     if not (global_owner or channel_owner or original_author):
         raise AccessError(
             description="The authorised user is not the author of this message.")
-    # replace the current message string in the message_data with the new message string
-    message_data["content"] = message
-    # update the boolean under "edited" key
-    message_data["edited"] = True
-    # update the message.json
-    abstractions.update_message(message_id, message_data)
+    # replace the current message string with the new message string,
+    # and update the boolean under "edited" key
+    with abstractions.transaction():
+        abstractions.patch_message(message_id, {"content": message, "edited": True})
+        record_message_change(message_data["channel_id"], message_id)
+    publish_message(message_id)
     return {}
 
 
-def check_unsent_messages():
+def get_scheduler():
+    '''
+    Helper function to get the scheduler that delivers unsent messages,
+    starting it if this is the first call. Returns None in a process
+    that doesn't deliver them (see DELIVERS_MESSAGES), or that was forked
+    from the one running it, as the process that does will find the
+    message in the data files.
+    '''
+    global SCHEDULER                                # pylint: disable=W0603
+    if not DELIVERS_MESSAGES:
+        return None
+    if SCHEDULER is None:
+        SCHEDULER = scheduler.start_scheduler(
+            send_unsent_message, abstractions.get_all_unsent_message_ids, unsent_message_time)
+    if SCHEDULER.pid != os.getpid():
+        return None
+    return SCHEDULER
+
+
+def schedule_message(message_id: int, time_to_send: datetime.datetime):
+    '''
+    Helper function to have an unsent message delivered at time_to_send
+    '''
+    message_scheduler = get_scheduler()
+    if message_scheduler is not None:
+        message_scheduler.schedule(message_id, time_to_send)
+
+
+def send_due_messages():
+    '''
+    Helper function to send any unsent messages that are due right away,
+    rather than leave them to the scheduler's thread
+    '''
+    message_scheduler = get_scheduler()
+    if message_scheduler is not None:
+        message_scheduler.run_due()
+
+
+def unsent_message_time(message_id: int):
+    '''
+    Helper function to get when an unsent message should be sent
+    '''
+    message_data = abstractions.get_message(message_id)
+    # A message that has been removed is taken off the queue straight away
+    return datetime.datetime.min if message_data is None else message_data['time']
+
+
+def send_unsent_message(message_id: int):
+    '''
+    Helper function to send an unsent message once its time has come,
+    used by the scheduler
+    '''
+    message_data = abstractions.get_message(message_id)
+    if message_data is not None and message_data['time'] > datetime.datetime.now():
+        # It has been changed to a later time since it was scheduled
+        return
+    with abstractions.transaction():
+        # remove id from queue, unless someone else has already sent it
+        if abstractions.delete_unsent_message_id(message_id) is None:
+            return
+        if message_data is None:
+            return
+        # This could be a standup message
+        finished_standup = complete_standup(message_data)
+        # update channel
+        add_channel_message(message_data['channel_id'], message_id)
+    publish_message(message_id)
+    if finished_standup:
+        events.publish(message_data['channel_id'], "standup_finished",
+                       {"message_id": message_id})
+
+
+def add_channel_message(channel_id: int, message_id: int):
+    '''
+    Helper function to add a sent message to its channel
+    '''
+    change_seq = record_message_change(channel_id, message_id)
+    # append the message id to channel["message_ids"] (list), and where it
+    # was added (see abstractions.message_positions) to channel["message_seqs"]
+    abstractions.append_to('channels', channel_id, 'message_ids', message_id)
+    abstractions.append_to('channels', channel_id, 'message_seqs', change_seq)
+    abstractions.increment('channels', channel_id, 'message_count')
+
+
+def remove_channel_message(channel_id: int, message_id: int):
     '''
-    Helper function to check unsent messages,
-    used in message_sendlater function
+    Helper function to remove a deleted message from its channel
     '''
-    unsent_message_ids = abstractions.get_all_unsent_message_ids()
-    for unsent_message_id in unsent_message_ids:
-        # get the message
-        message_data = abstractions.get_message(unsent_message_id)
-        # check the datetime to see if it should have sent
-        if message_data['time'] <= datetime.datetime.now():
-            # The message should have sent
-            send_unsent_message(unsent_message_id)
+    position = abstractions.get_channel_message_position(channel_id, message_id)
+    if position is None:
+        return
+    abstractions.remove_from('channels', channel_id, 'message_ids', message_id)
+    if position > 0:
+        abstractions.remove_from('channels', channel_id, 'message_seqs', position)
+    abstractions.increment('channels', channel_id, 'message_count', -1)
+    record_message_change(channel_id, message_id, removed=True)
 
 
-def send_unsent_message(message_id):
+def record_message_change(channel_id: int, message_id: int, removed: bool = False):
+    '''
+    Helper function to give a message the channel's next change sequence
+    number as it is sent or changed (or, as it is removed, to note it
+    with that number), so that channel_messages_since can find it.
+    The channel logs each message once, with the number of its last
+    change, so the log is in order and only as long as the channel.
+    Returns the number.
     '''
-    Helper function to send unsent message,
-    after checking there is unsent messages in the channel
+    change_seq = abstractions.next_change_seq(channel_id)
+    previous_seq = abstractions.get_field('messages', message_id, 'change_seq', 0)
+    if previous_seq:
+        abstractions.remove_from('channels', channel_id, 'changed_messages',
+                                 [previous_seq, message_id])
+    if removed:
+        abstractions.append_to('channels', channel_id, 'removed_messages',
+                               [change_seq, message_id])
+    else:
+        abstractions.patch_message(message_id, {"change_seq": change_seq})
+        abstractions.append_to('channels', channel_id, 'changed_messages',
+                               [change_seq, message_id])
+    return change_seq
+
+
+def publish_message(message_id: int):
+    '''
+    Helper function to tell the clients listening to a message's channel
+    that it has been sent or changed
     '''
-    # This could be a standup message... check to remove standups
-    mark_standups_as_completed()
     message_data = abstractions.get_message(message_id)
-    # get channel
+    if message_data is None or not events.HUB.listening(message_data['channel_id']):
+        return
+    events.publish(message_data['channel_id'], "message", {
+        "message_id": message_id,
+        "u_id": message_data['author_id'],
+        "message": message_data['content'],
+        "time_created": message_data['time'].replace().timestamp(),
+        "reacts": message_data['reactions'],
+        "is_pinned": message_data['pinned'],
+        "change_seq": message_data.get('change_seq', 0),
+    })
+
+
+def complete_standup(message_data: dict):
+    '''
+    Helper function to finish the standup a message belongs to, as the
+    message is sent, writing what was sent to the standup into it.
+    Returns whether it was a standup message.
+    '''
     channel_data = abstractions.get_channel(message_data['channel_id'])
-    channel_data['message_ids'].append(message_id)
-    channel_data['message_count'] += 1
-    # remove id from queue
-    abstractions.delete_unsent_message_id(message_id)
-    # update channel
-    abstractions.update_channel(message_data['channel_id'], channel_data)
-
-
-def mark_standups_as_completed():
-    '''
-    Helper function to change boolean value when calling standup
-    '''
-    channel_ids = abstractions.get_all_channel_ids()
-    now = datetime.datetime.now()
-    for channel_id in channel_ids:
-        channel_data = abstractions.get_channel(channel_id)
-        if channel_data['standup_in_progress']:
-            # Get the standup
-            standup = abstractions.get_standup(channel_data['standup_id'])
-            if standup['time_finished'] <= now:
-                # This standup has finished
-                standup['in_progress'] = False
-                abstractions.update_standup(standup['standup_id'], standup)
-                channel_data['standup_id'] = None
-                channel_data['standup_in_progress'] = False
-                abstractions.update_channel(channel_id, channel_data)
+    if channel_data is None or not channel_data['standup_in_progress']:
+        return False
+    standup = abstractions.get_standup(channel_data['standup_id'])
+    if standup['message_id'] != message_data['message_id']:
+        return False
+    abstractions.patch_message(message_data['message_id'], {
+        "content": message_data['content'] + "".join(standup.get('lines', []))
+    })
+    abstractions.patch_standup(standup['standup_id'], {"in_progress": False})
+    abstractions.patch_channel(
+        channel_data['channel_id'], {"standup_id": None, "standup_in_progress": False})
+    return True
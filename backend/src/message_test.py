@@ -6,6 +6,8 @@ import time
 import requests
 import pytest
 import other
+import abstractions
+import message as message_file
 from error import InputError, AccessError
 from message import message_send
 from message import message_edit
@@ -14,6 +16,7 @@ from message import message_unreact
 from message import message_pin
 from message import message_unpin
 from message import message_remove
+from message import message_sendlater
 from channels import channels_create
 from channel import channel_messages, channel_join, channel_addowner
 from auth import auth_register
@@ -159,6 +162,37 @@ def test_message_remove_successful_other_owner():
     assert len(message_data['messages']) == 0
 
 
+@pytest.mark.integrationtest
+def test_message_remove_unsent():
+    '''
+    Removing a message before it is sent later leaves its channel alone
+    '''
+    user1 = auth_register('z5261846@unsw.edu.au', '123456789', 'Yizhou', 'Cao')
+    channel_id = channels_create(user1['token'], 'new_channel', True)['channel_id']
+    later = message_sendlater(user1['token'], channel_id, 'Hello later',
+                              datetime.datetime.now().timestamp() + 60)
+    message_remove(user1['token'], later['message_id'])
+    assert abstractions.get_all_unsent_message_ids() == []
+    channel_data = abstractions.get_channel(channel_id)
+    assert (channel_data['message_ids'], channel_data['message_count']) == ([], 0)
+
+    message = message_send(user1['token'], channel_id, 'Hello now')
+    message_data = channel_messages(user1['token'], channel_id, 0)
+    assert [sent['message_id'] for sent in message_data['messages']] == [message['message_id']]
+    assert message_data['end'] == -1
+
+
+def test_messages_delivered_elsewhere(monkeypatch):
+    '''
+    A process that leaves delivering messages to another never starts a
+    scheduler of its own
+    '''
+    monkeypatch.setattr(message_file, "DELIVERS_MESSAGES", False)
+    monkeypatch.setattr(message_file, "SCHEDULER", None)
+    assert message_file.get_scheduler() is None
+    assert message_file.SCHEDULER is None
+
+
 @pytest.mark.integrationtest
 def test_message_remove_access_error_1():
     '''
@@ -0,0 +1,21 @@
+'''
+    One-off script to move the data files from the old list layout
+    (a list of ids plus a list of records) to records keyed by id.
+    Run it from the src directory: python3 migrate_data.py
+'''
+import abstractions
+
+
+def migrate_data_files():
+    '''
+    Load every data file, upgrading and re-saving any still using
+    the old layout.
+    '''
+    store = abstractions.create_store("json")
+    for file_name in abstractions.LAYOUTS:
+        # Loading a collection upgrades the file on disk if it needs it
+        store.collection(file_name).data()
+
+
+if __name__ == "__main__":
+    migrate_data_files()
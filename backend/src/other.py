@@ -2,57 +2,348 @@
 """
  - other.py ~ T18B - Blue
 """
+import atexit
+import collections
+import concurrent.futures
+import copy
 import datetime
+import heapq
+import itertools
+import multiprocessing
+import os
+import threading
 import abstractions
+import config
 from auth import check_valid_token, get_user_from_token
 from error import InputError, AccessError
 
+# How many search results are returned at once (unless a limit is given)
+# and the most that can be asked for
+SEARCH_LIMIT = 50
+MAX_SEARCH_LIMIT = 500
+# How many messages that could match are read at a time while searching
+SEARCH_BATCH = 100
+# How many searches have their results kept, so that they can be answered
+# again without reading any messages. The cache is kept in memory, so it
+# isn't used when each request gets a process of its own (see
+# config.SERVER_PROCESSES), as nothing would ever be found in it.
+SEARCH_CACHE_SIZE = 256
+# search key -> (the generations of the channels searched, results), the
+# most recently used last
+SEARCH_CACHE = collections.OrderedDict()
+SEARCH_CACHE_LOCK = threading.Lock()
+# Searches by relevance that could match at least this many messages are
+# split across the search workers (see config.SEARCH_WORKERS), if there
+# are any, with each worker given this many ranges of them
+PARALLEL_SEARCH_MIN = 5000
+SEARCH_PARTS_PER_WORKER = 2
+# (the process it was started in, the pool of search workers)
+SEARCH_POOL = None
 
-def search(token: str, query_str: str):
+
+def search(token: str, query_str: str, limit: int = SEARCH_LIMIT, cursor: str = None,
+           channel_id: int = None, author_id: int = None, time_from: float = None,
+           time_to: float = None, order: str = "newest"):
     """
         - When a user searches for a specific message, this function will be called
+        - Returns up to limit matches, newest first (or, if order is
+          "relevance", those with query_str in them the most times first),
+          and a cursor to pass back in for the next page (None at the end)
+        - Only the messages in channel_id, by author_id or sent between
+          time_from and time_to are returned, if they are given
     """
     # Check the tokens validity
     if not check_valid_token(token):
         raise AccessError(description="Invalid Token")
     authed_user_id = get_user_from_token(token)
+    try:
+        limit = int(limit)
+    except (TypeError, ValueError) as error:
+        raise InputError(description="The limit must be a number.") from error
+    if not 1 <= limit <= MAX_SEARCH_LIMIT:
+        raise InputError(description=f"The limit must be from 1 to {MAX_SEARCH_LIMIT}.")
+    if order not in ("newest", "relevance"):
+        raise InputError(description="Results can only be ordered by newest or relevance.")
+    # The cursor is the sort key of the last result (see search_sort_key)
+    after = parse_search_cursor(cursor, 2 if order == "relevance" and query_str else 1)
+    try:
+        channel_id = None if channel_id is None else int(channel_id)
+        author_id = None if author_id is None else int(author_id)
+    except (TypeError, ValueError) as error:
+        raise InputError(description="The channel and user must be ids.") from error
+    try:
+        time_from = None if time_from is None else float(time_from)
+        time_to = None if time_to is None else float(time_to)
+    except (TypeError, ValueError) as error:
+        raise InputError(description="The times must be numbers.") from error
 
     # Find and store all channels the user is a part of.
-    joined_channel_ids = []
-    all_channel_ids = abstractions.get_all_channel_ids()
-    for channel_id in all_channel_ids:
-        channel = abstractions.get_channel(channel_id)
-        if authed_user_id in channel['user_member_ids']:
-            joined_channel_ids.append(channel_id)
-
-    # Find and store all messages in these joinend channels
-    # that contain the query_str
+    joined_channel_ids = set(abstractions.get_member_channel_ids(authed_user_id))
+    if channel_id is not None:
+        if channel_id not in joined_channel_ids:
+            raise AccessError(description="Authorised user is not part of this channel.")
+        joined_channel_ids = {channel_id}
+
+    # Anyone making the same search over the same channels gets the same
+    # results, until a message in one of them is sent, changed or removed.
+    # The generations are read first, so that a change made while
+    # searching leaves the results out of date rather than looking new.
+    if config.SERVER_PROCESSES > 1:
+        return find_search_results(query_str, joined_channel_ids, author_id,
+                                   time_from, time_to, order, limit, after)
+    key = (query_str.lower(), tuple(sorted(joined_channel_ids)), channel_id, author_id,
+           time_from, time_to, order, limit, after)
+    generations = abstractions.get_channel_generations(key[1])
+    results = get_cached_search(key, generations)
+    if results is None:
+        results = find_search_results(query_str, joined_channel_ids, author_id,
+                                      time_from, time_to, order, limit, after)
+        cache_search(key, generations, results)
+    return copy.deepcopy(results)
+
+
+def find_search_results(query_str: str, joined_channel_ids: set, author_id: int,
+                        time_from: float, time_to: float, order: str, limit: int,
+                        after: tuple):
+    """
+        - Does the search for search(), in the given channels
+    """
+    # The messages in the channels that could match, newest first, found
+    # without reading any messages
+    candidate_ids = abstractions.select_channel_message_ids(
+        abstractions.get_search_candidates(query_str), joined_channel_ids)
+    candidate_ids.reverse()
+
+    query = query_str.lower()
+    criteria = {
+        "query": query,
+        "channel_ids": joined_channel_ids,
+        "author_id": author_id,
+        "time_from": time_from,
+        "time_to": time_to,
+        # Otherwise they are newest first
+        "relevance": order == "relevance" and bool(query),
+        "after": after,
+    }
+    # Only the messages after the cursor need to be read
+    if not criteria['relevance'] and after is not None:
+        candidate_ids = [
+            message_id for message_id in candidate_ids if (-message_id,) > after
+        ]
+
+    # One more than the page is found, to tell whether there is another
+    pool = get_search_pool()
+    if criteria['relevance'] and pool is not None and len(candidate_ids) >= PARALLEL_SEARCH_MIN:
+        # Every match has to be looked at, so the workers share that out.
+        # (Newest first stops at the end of the page, which is quicker here.)
+        found = [
+            message for message in abstractions.get_messages(
+                find_in_parallel(pool, candidate_ids, criteria, limit + 1))
+            if message is not None
+        ]
+    else:
+        matches = (
+            message for message in read_search_candidates(candidate_ids)
+            if search_wanted(message, criteria)
+        )
+        if criteria['relevance']:
+            # Every match has to be looked at, but only the page is kept
+            found = heapq.nsmallest(
+                limit + 1, matches, key=lambda message: search_sort_key(message, criteria))
+        else:
+            found = list(itertools.islice(matches, limit + 1))
+    page = found[:limit]
     matched_messages = []
-    all_message_ids = abstractions.get_all_message_ids()
-    for message_id in all_message_ids:
-        message = abstractions.get_message(message_id)
-        if query_str.lower() in message['content'].lower():
-            message_dict = {
-                "message_id": message_id,
-                "u_id":  message['author_id'],
-                "message": message['content'],
-                "time_created": message["time"].replace(tzinfo=datetime.timezone.utc).timestamp(),
-                "reacts": message["reactions"],
-                "is_pinned": message["pinned"]
-            }
-            matched_messages.append(message_dict)
+    for message in page:
+        message_dict = {
+            "message_id": message['message_id'],
+            "u_id":  message['author_id'],
+            "message": message['content'],
+            "time_created": search_time(message),
+            "reacts": message["reactions"],
+            "is_pinned": message["pinned"]
+        }
+        matched_messages.append(message_dict)
 
     return {
-        "messages": matched_messages
+        "messages": matched_messages,
+        "next": (format_search_cursor(search_sort_key(page[-1], criteria))
+                 if len(found) > limit else None)
     }
 
 
+def search_sort_key(message: dict, criteria: dict):
+    """
+        - How search results are ordered (smallest first), and so what the
+          cursor is
+    """
+    if criteria['relevance']:
+        return (-message['content'].lower().count(criteria['query']), -message['message_id'])
+    return (-message['message_id'],)
+
+
+def search_wanted(message: dict, criteria: dict):
+    """
+        - Returns whether a message is one of the results of a search (see
+          find_search_results)
+    """
+    if message is None or criteria['query'] not in message['content'].lower():
+        return False
+    if message['channel_id'] not in criteria['channel_ids']:
+        return False
+    if criteria['author_id'] is not None and message['author_id'] != criteria['author_id']:
+        return False
+    time_created = search_time(message)
+    if criteria['time_from'] is not None and time_created < criteria['time_from']:
+        return False
+    if criteria['time_to'] is not None and time_created > criteria['time_to']:
+        return False
+    return criteria['after'] is None or search_sort_key(message, criteria) > criteria['after']
+
+
+def get_search_pool():
+    """
+        - Returns the pool of config.SEARCH_WORKERS processes that searches
+          over many messages are split across, starting it if this is the
+          first call. Returns None if there are no search workers, or in a
+          process forked from the one running it (eg. by the server), which
+          searches by itself.
+    """
+    global SEARCH_POOL                              # pylint: disable=W0603
+    if config.SEARCH_WORKERS < 1:
+        return None
+    if SEARCH_POOL is None:
+        # The workers are started afresh rather than forked, as the server
+        # has threads running (and its locks may be held) when they start.
+        # Each opens the store for itself.
+        SEARCH_POOL = (os.getpid(), concurrent.futures.ProcessPoolExecutor(
+            config.SEARCH_WORKERS, mp_context=multiprocessing.get_context("spawn"),
+            initializer=start_search_worker,
+            initargs=(config.STORAGE_BACKEND, config.STORAGE_FORMAT)))
+        atexit.register(stop_search_pool)
+    pid, pool = SEARCH_POOL
+    return pool if pid == os.getpid() else None
+
+
+def stop_search_pool():
+    """
+        - Stops the search workers, if they were started by this process
+    """
+    global SEARCH_POOL                              # pylint: disable=W0603
+    if SEARCH_POOL is not None and SEARCH_POOL[0] == os.getpid():
+        SEARCH_POOL[1].shutdown()
+    SEARCH_POOL = None
+
+
+def start_search_worker(backend: str, storage_format: str):
+    """
+        - Opens the store in a search worker, the way the server process
+          that started it has it
+    """
+    config.STORAGE_FORMAT = storage_format
+    abstractions.use_backend(backend)
+
+
+def find_in_parallel(pool, candidate_ids: list, criteria: dict, count: int):
+    """
+        - Returns the ids of the first count of the messages with the given
+          ids that match criteria, in order. The ids are split into a few
+          ranges for each search worker, which reads those messages itself.
+    """
+    size = -(-len(candidate_ids) // (config.SEARCH_WORKERS * SEARCH_PARTS_PER_WORKER))
+    futures = [
+        pool.submit(search_partition, candidate_ids[start:start + size], criteria, count)
+        for start in range(0, len(candidate_ids), size)
+    ]
+    # Each range's first count were found, so the first count of all of
+    # them are among those
+    found = heapq.nsmallest(count, itertools.chain.from_iterable(
+        future.result() for future in futures))
+    return [message_id for _, message_id in found]
+
+
+def search_partition(message_ids: list, criteria: dict, count: int):
+    """
+        - Returns the sort keys and ids of the first count of the messages
+          with the given ids that match criteria, in order. Run by the
+          search workers.
+    """
+    return heapq.nsmallest(count, (
+        (search_sort_key(message, criteria), message['message_id'])
+        for message in read_search_candidates(message_ids)
+        if search_wanted(message, criteria)
+    ))
+
+
+def get_cached_search(key: tuple, generations: tuple):
+    """
+        - Returns the results cached for a search, or None if there aren't
+          any or the channels have changed since
+    """
+    with SEARCH_CACHE_LOCK:
+        cached = SEARCH_CACHE.get(key)
+        if cached is None or cached[0] != generations:
+            return None
+        SEARCH_CACHE.move_to_end(key)
+        return cached[1]
+
+
+def cache_search(key: tuple, generations: tuple, results: dict):
+    """
+        - Keeps the results of a search, forgetting the least recently
+          used search once there are more than SEARCH_CACHE_SIZE
+    """
+    with SEARCH_CACHE_LOCK:
+        SEARCH_CACHE[key] = (generations, results)
+        SEARCH_CACHE.move_to_end(key)
+        while len(SEARCH_CACHE) > SEARCH_CACHE_SIZE:
+            SEARCH_CACHE.popitem(last=False)
+
+
+def read_search_candidates(message_ids: list):
+    """
+        - Generates the messages with the given ids that have been sent,
+          reading SEARCH_BATCH of them at a time, so that no more are read
+          than are needed
+    """
+    # Messages waiting to be sent later aren't in their channels yet
+    unsent_message_ids = set(abstractions.get_all_unsent_message_ids())
+    message_ids = [
+        message_id for message_id in message_ids if message_id not in unsent_message_ids
+    ]
+    for start in range(0, len(message_ids), SEARCH_BATCH):
+        yield from abstractions.get_messages(message_ids[start:start + SEARCH_BATCH])
+
+
+def search_time(message: dict):
+    return message["time"].replace(tzinfo=datetime.timezone.utc).timestamp()
+
+
+def format_search_cursor(sort_key: tuple):
+    # The sort key is made of negative numbers, so that the largest come first
+    return ":".join(str(-part) for part in sort_key)
+
+
+def parse_search_cursor(cursor: str, parts: int):
+    if cursor is None or cursor == "":
+        return None
+    try:
+        after = tuple(-int(part) for part in str(cursor).split(":"))
+    except ValueError as error:
+        raise InputError(description="Invalid cursor.") from error
+    if len(after) != parts:
+        raise InputError(description="Invalid cursor.")
+    return after
+
+
 def workplace_reset():
     """
         - Resets all workplace related setups
     """
     abstractions.setup_channels_json()
     abstractions.setup_messages_json()
+    with SEARCH_CACHE_LOCK:
+        SEARCH_CACHE.clear()
     abstractions.setup_users_json()
     abstractions.setup_standups_json()
     return {}
@@ -117,7 +408,8 @@ def user_remove(token: str, u_id: int):
     chan_data = {}
     # remove the user from the channels
     # of which the user was part of
-    channels = abstractions.get_all_channel_ids()
+    channels = sorted(set(abstractions.get_owner_channel_ids(u_id))
+                      | set(abstractions.get_member_channel_ids(u_id)))
     for chan_id in channels:
         chan_dict = abstractions.get_channel(chan_id)
         if u_id in chan_dict['owner_member_ids']:
@@ -129,19 +421,14 @@ def user_remove(token: str, u_id: int):
             # delete ther channel
             if chan_dict['user_member_ids'] == [] and owner_ids == []:
                 abstractions.delete_channel(chan_id)
-            # else update the channel with the new owner list
+            # else remove the user from the owner and member lists
             else:
-                chan_data = chan_dict
-                chan_data['owner_member_ids'] = owner_ids
-                abstractions.update_channel(chan_id, chan_data)
+                abstractions.remove_from('channels', chan_id, 'owner_member_ids', u_id)
+                abstractions.remove_from('channels', chan_id, 'user_member_ids', u_id)
 
         elif u_id in chan_dict['user_member_ids']:
-            member_ids = chan_dict['user_member_ids']
-            member_ids.remove(u_id)
             # update the channel
-            chan_data = chan_dict
-            chan_data['user_member_ids'] = member_ids
-            abstractions.update_channel(chan_id, chan_data)
+            abstractions.remove_from('channels', chan_id, 'user_member_ids', u_id)
 
     return {}
 
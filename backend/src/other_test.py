@@ -3,16 +3,18 @@
  - other_test.py ~ T18B - Blue
  - Provides test cases for other.py
 """
+import datetime
 import pytest
 import requests
 from error import AccessError, InputError
+import config
 import other
 import abstractions
 import channel
 import users
 from auth import auth_register, auth_login
 from channels import channels_create
-from message import message_send
+from message import message_send, message_sendlater, message_edit, message_remove
 
 
 BASE_URL = "http://localhost:8080/"
@@ -330,6 +332,228 @@ def test_search_success_no_query_str():
     assert len(search_results['messages']) == 1
 
 
+@pytest.mark.integrationtest
+def test_search_only_channels_joined():
+    '''
+        - Only delivered messages in the user's channels are found, by
+          any part of a word
+    '''
+    user_token = setup_test_user()
+    channel_id = setup_test_channel(user_token)
+    message = message_send(user_token, channel_id, "Hello World")
+    message_sendlater(user_token, channel_id, "Hello later",
+                      datetime.datetime.now().timestamp() + 60)
+    other_user = auth_register("other@test.com", "ilovetrimesters", "Other", "User")
+    other_channel = channels_create(other_user['token'], "Other", True)
+    message_send(other_user['token'], other_channel['channel_id'], "Hello there")
+
+    search_results = other.search(user_token, "ELL")
+    assert [message['message_id'] for message in search_results['messages']] == [
+        message['message_id']
+    ]
+
+
+@pytest.mark.integrationtest
+def test_search_pages():
+    '''
+        - Results come newest first, a page at a time
+    '''
+    user_token = setup_test_user()
+    channel_id = setup_test_channel(user_token)
+    message_ids = [
+        message_send(user_token, channel_id, f"Hello number {number}")['message_id']
+        for number in range(5)
+    ]
+
+    first_page = other.search(user_token, "hello", limit=2)
+    assert [message['message_id'] for message in first_page['messages']] == message_ids[:2:-1]
+    # A newer message doesn't change where the next page starts
+    message_send(user_token, channel_id, "Hello again")
+    second_page = other.search(user_token, "hello", limit=2, cursor=first_page['next'])
+    assert [message['message_id'] for message in second_page['messages']] == message_ids[2:0:-1]
+    last_page = other.search(user_token, "hello", limit=2, cursor=second_page['next'])
+    assert [message['message_id'] for message in last_page['messages']] == message_ids[:1]
+    assert last_page['next'] is None
+
+    with pytest.raises(InputError):
+        other.search(user_token, "hello", limit=0)
+    with pytest.raises(InputError):
+        other.search(user_token, "hello", limit="ten")
+    with pytest.raises(InputError):
+        other.search(user_token, "hello", cursor="not a cursor")
+    # A cursor for relevance doesn't fit newest first, or the other way round
+    with pytest.raises(InputError):
+        other.search(user_token, "hello", cursor="1:2:3:4")
+    with pytest.raises(InputError):
+        other.search(user_token, "hello", cursor="1:2")
+    with pytest.raises(InputError):
+        other.search(user_token, "hello", cursor="2", order="relevance")
+
+
+@pytest.mark.integrationtest
+def test_search_by_relevance():
+    user_token = setup_test_user()
+    channel_id = setup_test_channel(user_token)
+    once = message_send(user_token, channel_id, "la")['message_id']
+    three_times = message_send(user_token, channel_id, "la la la")['message_id']
+    twice = message_send(user_token, channel_id, "la la")['message_id']
+    also_once = message_send(user_token, channel_id, "La")['message_id']
+
+    first_page = other.search(user_token, "la", limit=2, order="relevance")
+    assert [message['message_id'] for message in first_page['messages']] == [three_times, twice]
+    second_page = other.search(user_token, "la", limit=2, order="relevance",
+                               cursor=first_page['next'])
+    assert [message['message_id'] for message in second_page['messages']] == [also_once, once]
+    assert second_page['next'] is None
+
+
+@pytest.mark.integrationtest
+def test_search_filters():
+    user_token = setup_test_user()
+    channel_id = setup_test_channel(user_token)
+    other_channel_id = channels_create(user_token, "Smith", True)['channel_id']
+    other_user = auth_register("other@test.com", "ilovetrimesters", "Other", "User")
+    channel.channel_join(other_user['token'], channel_id)
+    mine = message_send(user_token, channel_id, "Hello")['message_id']
+    theirs = message_send(other_user['token'], channel_id, "Hello")['message_id']
+    elsewhere = message_send(user_token, other_channel_id, "Hello")['message_id']
+
+    def found(**filters):
+        return [
+            message['message_id']
+            for message in other.search(user_token, "Hello", **filters)['messages']
+        ]
+    assert found() == [elsewhere, theirs, mine]
+    assert found(channel_id=channel_id) == [theirs, mine]
+    assert found(author_id=other_user['u_id']) == [theirs]
+    sent_at = other.search(user_token, "Hello")['messages'][0]['time_created']
+    assert found(time_from=sent_at + 60) == []
+    assert found(time_to=sent_at + 60) == [elsewhere, theirs, mine]
+    # Only the user's own channels can be searched
+    other_users_channel = channels_create(other_user['token'], "Theirs", True)['channel_id']
+    with pytest.raises(AccessError):
+        found(channel_id=other_users_channel)
+    # Filters that aren't numbers are bad input
+    for filters in ({"channel_id": "general"}, {"author_id": "me"},
+                    {"time_from": "yesterday"}, {"time_to": "now"}):
+        with pytest.raises(InputError):
+            found(**filters)
+
+
+@pytest.mark.integrationtest
+def test_search_only_reads_joined_channels(monkeypatch):
+    user_token = setup_test_user()
+    setup_test_channel(user_token)
+    other_user = auth_register("other@test.com", "ilovetrimesters", "Other", "User")
+    other_channel_id = channels_create(other_user['token'], "Theirs", True)['channel_id']
+    for _ in range(20):
+        message_send(other_user['token'], other_channel_id, "Hello")
+
+    def unread(message_ids):
+        assert not message_ids, "Messages from other channels were read"
+        return []
+    monkeypatch.setattr(abstractions, "get_messages", unread)
+    assert other.search(user_token, "hello")['messages'] == []
+
+
+@pytest.mark.integrationtest
+def test_search_is_cached(monkeypatch):
+    monkeypatch.setattr(config, "SERVER_PROCESSES", 1)
+    user_token = setup_test_user()
+    channel_id = setup_test_channel(user_token)
+    first = message_send(user_token, channel_id, "Hello")['message_id']
+    other_user = auth_register("other@test.com", "ilovetrimesters", "Other", "User")
+    channel.channel_join(other_user['token'], channel_id)
+    results = other.search(user_token, "hello")
+
+    def unread(*_args):
+        raise AssertionError("The messages were read")
+    with monkeypatch.context() as patch:
+        patch.setattr(abstractions, "get_search_candidates", unread)
+        patch.setattr(abstractions, "get_messages", unread)
+        # Anyone in the same channels gets the same results, whatever the case
+        assert other.search(user_token, "hello") == results
+        assert other.search(other_user['token'], "HELLO") == results
+        # What is returned can be changed without changing the cache
+        other.search(user_token, "hello")['messages'].clear()
+        assert other.search(user_token, "hello") == results
+        # It isn't used when each request gets a process of its own
+        patch.setattr(config, "SERVER_PROCESSES", 4)
+        with pytest.raises(AssertionError):
+            other.search(user_token, "hello")
+
+    def found():
+        return [message['message'] for message in other.search(user_token, "hello")['messages']]
+    # Sending, editing or removing a message makes the channel's searches
+    # be done again
+    second = message_send(user_token, channel_id, "Hello again")['message_id']
+    assert found() == ["Hello again", "Hello"]
+    message_edit(user_token, first, "Hello there")
+    assert found() == ["Hello again", "Hello there"]
+    message_remove(user_token, second)
+    assert found() == ["Hello there"]
+
+
+def test_search_cache_forgets_the_least_recently_used(monkeypatch):
+    monkeypatch.setattr(other, "SEARCH_CACHE_SIZE", 2)
+    other.cache_search("first", (), {})
+    other.cache_search("second", (), {})
+    assert other.get_cached_search("first", ()) == {}
+    other.cache_search("third", (), {})
+    assert list(other.SEARCH_CACHE) == ["first", "third"]
+    # Results for channels that have changed since aren't used
+    assert other.get_cached_search("first", ("changed",)) is None
+
+
+@pytest.mark.integrationtest
+def test_search_in_parallel(monkeypatch):
+    user_token = setup_test_user()
+    channel_ids = [setup_test_channel(user_token)] + [
+        channels_create(user_token, f"Channel {number}", True)['channel_id']
+        for number in range(3)
+    ]
+    other_user = auth_register("other@test.com", "ilovetrimesters", "Other", "User")
+    unjoined_channel_id = channels_create(other_user['token'], "Theirs", True)['channel_id']
+    for number in range(40):
+        message_send(user_token, channel_ids[number % 4], "la " * (number % 5) + "Hello")
+    message_send(other_user['token'], unjoined_channel_id, "Hello")
+    message_sendlater(user_token, channel_ids[0], "Hello later",
+                      datetime.datetime.now().timestamp() + 60)
+    searches = [
+        {"query_str": "hello", "limit": 7},
+        {"query_str": "la", "limit": 6, "order": "relevance"},
+        {"query_str": "la la", "order": "relevance", "channel_id": channel_ids[1]},
+        {"query_str": "", "limit": 100},
+    ]
+
+    def all_pages(**search):
+        pages = [other.search(user_token, **search)]
+        while pages[-1]['next'] is not None:
+            pages.append(other.search(user_token, cursor=pages[-1]['next'], **search))
+        return pages
+    monkeypatch.setattr(other, "SEARCH_CACHE_SIZE", 0)
+    expected = [all_pages(**search) for search in searches]
+
+    monkeypatch.setattr(config, "SEARCH_WORKERS", 2)
+    monkeypatch.setattr(other, "PARALLEL_SEARCH_MIN", 1)
+    other.stop_search_pool()
+    pool = other.get_search_pool()
+    submitted = []
+
+    def submit(*args):
+        submitted.append(args)
+        return pool_submit(*args)
+    pool_submit = pool.submit
+    monkeypatch.setattr(pool, "submit", submit)
+    try:
+        assert [all_pages(**search) for search in searches] == expected
+        # Only searches by relevance are split up
+        assert submitted
+        assert all(args[2]['relevance'] for args in submitted)
+    finally:
+        other.stop_search_pool()
+
+
 # HTTP Tests
 @pytest.mark.systemtest
 def test_search_http():
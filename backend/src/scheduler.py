@@ -0,0 +1,142 @@
+'''
+    This file contains a background thread that does things at set times,
+    eg. delivering the messages sent with message_sendlater.
+    Due times are kept in a heap, so only the next one is ever looked at.
+'''
+import datetime
+import heapq
+import logging
+import os
+import threading
+import time
+
+# How often (in seconds) the scheduler looks for things that were
+# scheduled by other processes
+SCHEDULER_POLL = 1
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Scheduler(threading.Thread):
+    '''
+    Calls action(key) once the due time of key has passed.
+    Nothing is kept only in memory: pending() returns the keys still
+    waiting (as stored in the data files) and due_time(key) their due
+    times. They are read at startup and every poll seconds, so nothing is
+    lost on a restart and things scheduled by other processes get done.
+    action() must cope with being called for a key that is no longer
+    pending (eg. because another process did it first).
+    '''
+
+    def __init__(self, action, pending, due_time, poll: float = SCHEDULER_POLL):
+        super().__init__(daemon=True)
+        self.action = action
+        self.pending = pending
+        self.due_time = due_time
+        self.poll = poll
+        # The process that started it (a forked child doesn't get the thread)
+        self.pid = os.getpid()
+        self._heap = []
+        # key -> the due time it is in the heap with, so that an entry
+        # left behind by rescheduling can be told apart
+        self._due = {}
+        self._condition = threading.Condition()
+        # Held while doing keys, so that run_due() waits for keys another
+        # thread has already taken off the heap
+        self._running = threading.Lock()
+        self._stopped = False
+
+    def schedule(self, key, due: datetime.datetime):
+        '''
+        Do key at the given time (instead of any time given before)
+        '''
+        with self._condition:
+            if self._due.get(key) == due:
+                return
+            self._due[key] = due
+            heapq.heappush(self._heap, (due, key))
+            self._condition.notify()
+
+    def _refresh(self):
+        '''
+        Schedule anything pending that isn't in the heap yet
+        '''
+        for key in self.pending():
+            with self._condition:
+                if key in self._due:
+                    continue
+            due = self.due_time(key)
+            if due is not None:
+                self.schedule(key, due)
+
+    def _pop_due(self):
+        '''
+        Take the keys that are due off the heap
+        '''
+        now = datetime.datetime.now()
+        keys = []
+        with self._condition:
+            while self._heap and self._heap[0][0] <= now:
+                due, key = heapq.heappop(self._heap)
+                if self._due.get(key) == due:
+                    del self._due[key]
+                    keys.append(key)
+        return keys
+
+    def run_due(self):
+        '''
+        Do everything that is due now, in the calling thread, and wait
+        for anything due that another thread is doing. Costs next to
+        nothing if nothing is due, so it can be called before anything
+        that needs them done on time (rather than up to the thread).
+        '''
+        with self._running:
+            for key in self._pop_due():
+                try:
+                    self.action(key)
+                except Exception:                   # pylint: disable=W0703
+                    # It is still pending, so it is tried again on a refresh
+                    LOGGER.exception("Scheduled action for %r failed", key)
+
+    def _wait(self, refresh_at: float):
+        '''
+        Sleep until the next key is due, something new is scheduled or it
+        is time to refresh. Returns False once stopped.
+        '''
+        with self._condition:
+            if self._stopped:
+                return False
+            timeout = refresh_at - time.monotonic()
+            if self._heap:
+                until_due = (self._heap[0][0] - datetime.datetime.now()).total_seconds()
+                timeout = min(timeout, until_due)
+            if timeout > 0:
+                self._condition.wait(timeout)
+            return not self._stopped
+
+    def run(self):
+        refresh_at = 0
+        while True:
+            if time.monotonic() >= refresh_at:
+                self._refresh()
+                refresh_at = time.monotonic() + self.poll
+            self.run_due()
+            if not self._wait(refresh_at):
+                return
+
+    def stop(self):
+        '''
+        Stop the thread
+        '''
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+
+
+def start_scheduler(action, pending, due_time, poll: float = SCHEDULER_POLL):
+    '''
+    Start a scheduler (see Scheduler)
+    '''
+    scheduler = Scheduler(action, pending, due_time, poll)
+    scheduler.start()
+    return scheduler
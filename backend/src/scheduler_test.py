@@ -0,0 +1,97 @@
+'''
+Tests for the background scheduler in scheduler.py
+'''
+import datetime
+import threading
+import scheduler
+
+# pylint: disable=C0116
+
+
+def in_seconds(seconds):
+    return datetime.datetime.now() + datetime.timedelta(seconds=seconds)
+
+
+class Queue:
+    '''
+    Pending keys kept the way the data files keep unsent message ids
+    '''
+
+    def __init__(self, due):
+        self.due = dict(due)
+        self.done = []
+        self.finished = threading.Event()
+
+    def action(self, key):
+        if self.due.pop(key, None) is not None:
+            self.done.append(key)
+        if not self.due:
+            self.finished.set()
+
+
+def test_keys_are_done_in_due_order():
+    queue = Queue({})
+    running = scheduler.start_scheduler(queue.action, lambda: list(queue.due),
+                                        queue.due.get, poll=60)
+    try:
+        for key, seconds in ((1, 0.3), (2, 0.1), (3, 0.2)):
+            queue.due[key] = in_seconds(seconds)
+            running.schedule(key, queue.due[key])
+        assert queue.finished.wait(5)
+        assert queue.done == [2, 3, 1]
+    finally:
+        running.stop()
+
+
+def test_pending_keys_are_picked_up():
+    '''
+    Keys left over from before a restart, or added by another process,
+    are found without being scheduled
+    '''
+    queue = Queue({1: in_seconds(-10)})
+    running = scheduler.start_scheduler(queue.action, lambda: list(queue.due),
+                                        queue.due.get, poll=0.05)
+    try:
+        assert queue.finished.wait(5)
+        queue.finished.clear()
+        queue.due[2] = in_seconds(0.1)
+        assert queue.finished.wait(5)
+        assert queue.done == [1, 2]
+    finally:
+        running.stop()
+
+
+def test_rescheduled_keys_are_done_once():
+    queue = Queue({1: in_seconds(0.1)})
+    calls = []
+
+    def action(key):
+        calls.append(key)
+        queue.action(key)
+    running = scheduler.start_scheduler(action, lambda: list(queue.due), queue.due.get, poll=60)
+    try:
+        queue.due[1] = in_seconds(0.3)
+        running.schedule(1, queue.due[1])
+        assert queue.finished.wait(5)
+        assert calls == [1]
+    finally:
+        running.stop()
+
+
+def test_failures_are_tried_again(caplog):
+    queue = Queue({1: in_seconds(-1)})
+    failures = []
+
+    def action(key):
+        if not failures:
+            failures.append(key)
+            raise OSError("disk full")
+        queue.action(key)
+    running = scheduler.start_scheduler(action, lambda: list(queue.due), queue.due.get, poll=0.05)
+    try:
+        assert queue.finished.wait(5)
+        assert failures == [1] and queue.done == [1]
+        assert [record.message for record in caplog.records] == [
+            "Scheduled action for 1 failed"]
+    finally:
+        running.stop()
@@ -0,0 +1,312 @@
+'''
+    This file contains the formats the data files can be written in.
+
+    "json"      indented, sorted JSON (the original, easy to read format)
+    "minified"  the same JSON without any whitespace
+    "binary"    length-prefixed records, with times as integers
+
+    Times are only looked for in the top level fields of a record (see
+    TIME_FIELDS), rather than in every dictionary that gets parsed.
+    To convert the data files from one format to another run:
+        python3 serializers.py <from format> <to format>
+'''
+import datetime
+import json
+import os
+import struct
+import sys
+import threading
+
+# Record fields that hold a datetime
+TIME_FIELDS = ('time', 'time_started', 'time_finished')
+
+EPOCH = datetime.datetime(1970, 1, 1)
+MICROSECOND = datetime.timedelta(microseconds=1)
+
+
+def time_to_int(time: datetime.datetime):
+    '''
+    Microseconds since 1970 (times are stored without a timezone)
+    '''
+    return (time - EPOCH) // MICROSECOND
+
+
+def int_to_time(microseconds: int):
+    '''
+    Undo time_to_int
+    '''
+    return EPOCH + datetime.timedelta(microseconds=microseconds)
+
+
+def write_atomically(path: str, data: bytes):
+    '''
+    Replace the file at path with data, so that a crash (or another
+    process reading it) sees either the old file or the new one, never
+    a partly written file.
+    The data is written to a temporary file next to path, flushed to
+    disk and then renamed over path.
+    '''
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    sync_directory(os.path.dirname(path))
+
+
+def sync_directory(directory: str):
+    '''
+    Flush a directory to disk, so that a rename inside it survives a crash
+    '''
+    if not hasattr(os, 'O_DIRECTORY'):
+        # Windows can't open directories, and doesn't need this
+        return
+    fd = os.open(directory or '.', os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class JsonSerializer:
+    '''
+    Indented JSON with times written as ISO 8601 strings
+    '''
+    name = "json"
+    extension = ".json"
+    dump_options = {"sort_keys": True, "indent": 4, "separators": (',', ': ')}
+
+    def pack_time(self, time: datetime.datetime):
+        '''
+        Return a time in the form it is written in
+        '''
+        return time.isoformat()
+
+    def pack_record(self, record: dict):
+        '''
+        Return a copy of a record that can be written out
+        '''
+        packed = dict(record)
+        for field in TIME_FIELDS:
+            if isinstance(packed.get(field), datetime.datetime):
+                packed[field] = self.pack_time(packed[field])
+        return packed
+
+    @staticmethod
+    def unpack_record(record: dict):
+        '''
+        Turn the times in a record that was read back into datetimes.
+        Both the string and integer forms are understood.
+        '''
+        for field in TIME_FIELDS:
+            value = record.get(field)
+            if isinstance(value, str):
+                record[field] = datetime.datetime.fromisoformat(value)
+            elif isinstance(value, int) and not isinstance(value, bool):
+                record[field] = int_to_time(value)
+        return record
+
+    def dumps_document(self, document: dict, records_key: str = None):
+        '''
+        Encode a document, either a mapping of id -> record or, when
+        records_key is given, a dictionary holding such a mapping
+        '''
+        if records_key is None:
+            document = {
+                record_id: self.pack_record(record)
+                for record_id, record in document.items()
+            }
+        elif records_key in document:
+            document = dict(document)
+            document[records_key] = {
+                record_id: self.pack_record(record)
+                for record_id, record in document[records_key].items()
+            }
+        return json.dumps(document, **self.dump_options).encode()
+
+    def loads_document(self, data: bytes, records_key: str = None):
+        '''
+        Decode a document written by dumps_document
+        '''
+        document = json.loads(data)
+        records = document if records_key is None else document.get(records_key)
+        if isinstance(records, dict):
+            for record in records.values():
+                self.unpack_record(record)
+        elif isinstance(records, list):
+            # Files from before records were keyed by id
+            for record in records:
+                self.unpack_record(record)
+        return document
+
+    def dump(self, path: str, document: dict, records_key: str = None):
+        '''
+        Write a document to path
+        '''
+        write_atomically(path, self.dumps_document(document, records_key))
+
+    def load(self, path: str, records_key: str = None):
+        '''
+        Read a document from path
+        '''
+        with open(path, 'rb') as f:
+            return self.loads_document(f.read(), records_key)
+
+    def dumps_entry(self, entry: dict):
+        '''
+        Encode a journal entry as a single line
+        '''
+        if 'record' in entry:
+            entry = dict(entry, record=self.pack_record(entry['record']))
+        if 'fields' in entry:
+            entry = dict(entry, fields=self.pack_record(entry['fields']))
+        return json.dumps(entry, separators=(',', ':'))
+
+    def loads_entry(self, line):
+        '''
+        Decode a journal entry written by dumps_entry
+        '''
+        entry = json.loads(line)
+        if 'record' in entry:
+            self.unpack_record(entry['record'])
+        if 'fields' in entry:
+            self.unpack_record(entry['fields'])
+        return entry
+
+
+class MinifiedJsonSerializer(JsonSerializer):
+    '''
+    JSON without any indentation or spaces, in insertion order
+    '''
+    name = "minified"
+    dump_options = {"separators": (',', ':')}
+
+
+class BinarySerializer(JsonSerializer):
+    '''
+    A header followed by one length-prefixed frame for the values stored
+    alongside the records, then one frame per [id, record].
+    Times are written as integer microseconds since 1970.
+    '''
+    name = "binary"
+    extension = ".bin"
+    magic = b"SLACKR1\n"
+    frame_header = struct.Struct('>I')
+
+    def pack_time(self, time: datetime.datetime):
+        return time_to_int(time)
+
+    def _frame(self, value):
+        payload = json.dumps(value, separators=(',', ':')).encode()
+        return self.frame_header.pack(len(payload)) + payload
+
+    def dumps_document(self, document: dict, records_key: str = None):
+        if records_key is None:
+            meta = {}
+            records = document
+        else:
+            meta = {key: value for key, value in document.items() if key != records_key}
+            records = document.get(records_key, {})
+        frames = [self.magic, self._frame(meta)]
+        for record_id, record in records.items():
+            frames.append(self._frame([record_id, self.pack_record(record)]))
+        return b"".join(frames)
+
+    def loads_document(self, data: bytes, records_key: str = None):
+        if not data.startswith(self.magic):
+            raise ValueError("Not a binary data file")
+        view = memoryview(data)
+        offset = len(self.magic)
+        frames = []
+        while offset < len(data):
+            (length,) = self.frame_header.unpack_from(view, offset)
+            offset += self.frame_header.size
+            frames.append(json.loads(bytes(view[offset:offset + length])))
+            offset += length
+        records = {
+            record_id: self.unpack_record(record) for record_id, record in frames[1:]
+        }
+        if records_key is None:
+            return records
+        document = frames[0]
+        document[records_key] = records
+        return document
+
+
+SERIALIZERS = {
+    serializer.name: serializer
+    for serializer in (JsonSerializer(), MinifiedJsonSerializer(), BinarySerializer())
+}
+
+
+def get_serializer(name: str):
+    '''
+    Return the serializer for a format name
+    '''
+    if name not in SERIALIZERS:
+        raise ValueError(f"Unknown data format {name}")
+    return SERIALIZERS[name]
+
+
+def convert_file(path: str, source, target, records_key: str = None):
+    '''
+    Rewrite one data file from the source format to the target format.
+    The new file has the target's extension and the old file is removed.
+    Returns the new path.
+    '''
+    document = source.load(path, records_key)
+    new_path = os.path.splitext(path)[0] + target.extension
+    target.dump(new_path, document, records_key)
+    if new_path != path:
+        os.remove(path)
+    return new_path
+
+
+def convert_data_files(directory: str, layouts: dict, source_name: str, target_name: str):
+    '''
+    Convert every data file (including message shards) in directory.
+    Journals should be checkpointed first, as they are not converted.
+    '''
+    source = get_serializer(source_name)
+    target = get_serializer(target_name)
+    for name, (records_key, _) in layouts.items():
+        path = os.path.join(directory, name + source.extension)
+        if os.path.exists(path):
+            convert_file(path, source, target, records_key)
+        shard_directory = os.path.join(directory, name)
+        if os.path.isdir(shard_directory):
+            for file_name in os.listdir(shard_directory):
+                if file_name.endswith(source.extension):
+                    convert_file(os.path.join(shard_directory, file_name),
+                                 source, target)
+
+
+def convert_store(source_name: str, target_name: str):
+    '''
+    Convert the program's data files from the source format to the target
+    format, first folding their journals into them. The journals are read
+    into files of the source format, whatever format is configured (which
+    is often already the target when this is run).
+    '''
+    # These use this file, so they can only be imported once it is loaded
+    import abstractions                             # pylint: disable=C0415
+    import config                                   # pylint: disable=C0415
+    configured = config.STORAGE_FORMAT
+    config.STORAGE_FORMAT = source_name
+    try:
+        for collection in abstractions.create_store("json").journaled_collections():
+            collection.checkpoint()
+        convert_data_files(abstractions.get_path(), abstractions.LAYOUTS,
+                           source_name, target_name)
+    finally:
+        config.STORAGE_FORMAT = configured
+
+
+if __name__ == "__main__":
+    convert_store(sys.argv[1], sys.argv[2])
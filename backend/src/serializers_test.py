@@ -0,0 +1,104 @@
+'''
+Tests for the data file formats in serializers.py
+'''
+import datetime
+import pytest
+import abstractions
+import config
+import serializers
+
+# pylint: disable=C0116
+
+LAYOUTS = {"messages": ("messages", "message_id")}
+
+
+def sample_document():
+    return {
+        "latest_message_id": 2,
+        "unsent_message_ids": [2],
+        "messages": {
+            1: {"message_id": 1, "content": "hi", "reactions": [],
+                "time": datetime.datetime(2020, 4, 1, 12, 30, 15, 123456)},
+            2: {"message_id": 2, "content": "later", "reactions": [],
+                "time": datetime.datetime(2020, 4, 2, 9, 0)},
+        }
+    }
+
+
+@pytest.mark.parametrize("name", ["json", "minified", "binary"])
+def test_round_trip(tmp_path, name):
+    serializer = serializers.get_serializer(name)
+    path = str(tmp_path / f"messages{serializer.extension}")
+    serializer.dump(path, sample_document(), "messages")
+    loaded = serializer.load(path, "messages")
+    messages = {int(key): value for key, value in loaded['messages'].items()}
+    assert messages == sample_document()['messages']
+    assert loaded['unsent_message_ids'] == [2]
+
+
+@pytest.mark.parametrize("name", ["json", "minified", "binary"])
+def test_journal_entries(name):
+    serializer = serializers.get_serializer(name)
+    entry = {"op": "put", "record": sample_document()['messages'][1]}
+    line = serializer.dumps_entry(entry)
+    assert "\n" not in line
+    assert serializer.loads_entry(line) == entry
+
+
+def test_binary_times_are_integers():
+    record = serializers.get_serializer("binary").pack_record(
+        sample_document()['messages'][1])
+    assert isinstance(record['time'], int)
+    assert serializers.int_to_time(record['time']) == sample_document()['messages'][1]['time']
+
+
+def test_minified_is_smaller():
+    document = sample_document()
+    indented = serializers.get_serializer("json").dumps_document(document, "messages")
+    minified = serializers.get_serializer("minified").dumps_document(document, "messages")
+    assert len(minified) < len(indented)
+
+
+def test_convert_data_files(tmp_path):
+    source = serializers.get_serializer("json")
+    source.dump(str(tmp_path / "messages.json"), sample_document(), "messages")
+    (tmp_path / "messages").mkdir()
+    source.dump(str(tmp_path / "messages" / "channel_id_1.json"),
+                sample_document()['messages'])
+    serializers.convert_data_files(str(tmp_path), LAYOUTS, "json", "binary")
+    assert not (tmp_path / "messages.json").exists()
+    binary = serializers.get_serializer("binary")
+    loaded = binary.load(str(tmp_path / "messages.bin"), "messages")
+    assert loaded['messages'] == {
+        str(key): value for key, value in sample_document()['messages'].items()
+    }
+    shard = binary.load(str(tmp_path / "messages" / "channel_id_1.bin"))
+    assert shard == loaded['messages']
+    serializers.convert_data_files(str(tmp_path), LAYOUTS, "binary", "json")
+    assert (tmp_path / "messages.json").exists()
+
+
+def test_convert_store_keeps_journaled_changes(tmp_path, monkeypatch):
+    monkeypatch.setattr(abstractions, "get_path", lambda: str(tmp_path))
+    monkeypatch.setattr(abstractions, "STORE", None)
+    monkeypatch.setattr(config, "STORAGE_FORMAT", "binary")
+    abstractions.use_backend("json")
+    abstractions.setup_channels_json()
+    abstractions.setup_messages_json()
+    channel_id = abstractions.create_channel("Test", False, 1)
+    message_ids = [abstractions.create_message(1, f"hi {n}", channel_id) for n in range(3)]
+    assert abstractions.get_collection('messages').journal.size() > 0
+
+    # The format has already been changed to the one converted to
+    config.STORAGE_FORMAT = "json"
+    serializers.convert_store("binary", "json")
+    assert config.STORAGE_FORMAT == "json"
+    assert not list(tmp_path.glob("*.bin"))
+    abstractions.use_backend("json")
+    assert abstractions.get_all_message_ids() == message_ids
+    assert abstractions.get_all_channel_ids() == [channel_id]
+
+
+def test_unknown_format():
+    with pytest.raises(ValueError):
+        serializers.get_serializer("xml")
@@ -1,24 +1,36 @@
 # pylint: disable = missing-docstring, invalid-name
 import json
+import multiprocessing
+import os
 import sys
+import time
 from json import dumps
-from flask import Flask, request
+from flask import Flask, Response, request
+from flask.logging import default_handler
 from flask_cors import CORS
 
 from error import InputError
 
 
+import abstractions
 import auth
+import config
 import channel
 import channels
 import hangman
 import message
 import other
+import scheduler
 import standup
 import user
 import users
 
 
+# How often (in seconds) the background process checks that the server
+# that started it is still running
+BACKGROUND_POLL = 1
+
+
 def defaultHandler(err):
     response = err.get_response()
     print('response', err, err.get_response())
@@ -37,6 +49,23 @@ CORS(APP)
 APP.config['TRAP_HTTP_EXCEPTIONS'] = True
 APP.register_error_handler(Exception, defaultHandler)
 
+
+# Records read more than once during a request are only read once
+@APP.before_request
+def start_request():
+    abstractions.start_request()
+
+
+@APP.after_request
+def count_reads_saved(response):
+    response.headers['X-Reads-Saved'] = str(abstractions.reads_saved())
+    return response
+
+
+@APP.teardown_request
+def end_request(_error):
+    abstractions.end_request()
+
 # Example
 @APP.route("/echo", methods=['GET'])
 def echo():
@@ -222,6 +251,32 @@ def channel_messages():
     return dumps(result)
 
 
+@APP.route('/channel/messages/before', methods=['GET'])
+def channel_messages_before():
+    data = request.args
+    result = channel.channel_messages_before(
+        data['token'], data['channel_id'], data.get('cursor'))
+    return dumps(result)
+
+
+@APP.route('/channel/messages/since', methods=['GET'])
+def channel_messages_since():
+    data = request.args
+    result = channel.channel_messages_since(
+        data['token'], data['channel_id'], data.get('cursor', 0))
+    return dumps(result)
+
+
+@APP.route('/events', methods=['GET'])
+def channel_events():
+    data = request.args
+    result = channel.channel_events(
+        data['token'], [int(channel_id) for channel_id in data.getlist('channel_id')])
+    # Ask proxies not to buffer the stream
+    return Response(result, mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
 @APP.route('/channel/leave', methods=['POST'])
 def channel_leave():
     data = json.loads(request.data)
@@ -255,7 +310,10 @@ def channel_removeowner():
 @APP.route('/search', methods=['GET'])
 def search():
     data = request.args
-    result = other.search(data['token'], data['query_str'])
+    result = other.search(
+        data['token'], data['query_str'], data.get('limit', other.SEARCH_LIMIT),
+        data.get('cursor'), data.get('channel_id'), data.get('u_id'),
+        data.get('time_from'), data.get('time_to'), data.get('order', "newest"))
     return dumps(result)
 
 
@@ -288,6 +346,13 @@ def standup_send():
     return dumps(result)
 
 
+@APP.route('/standup/summary', methods=['GET'])
+def standup_summary():
+    data = request.args
+    result = standup.standup_summary(data['token'], data['channel_id'])
+    return dumps(result)
+
+
 @APP.route('/admin/userpermission/change', methods=['POST'])
 def userpermission_change():
     data = json.loads(request.data)
@@ -401,5 +466,35 @@ def hangman_answer():
     return dumps(result)
 
 
+def run_background(parent_pid: int):
+    '''
+    Checkpoint the journals and deliver messages sent later for a server
+    whose requests are handled by forked processes, until that server stops
+    '''
+    abstractions.use_backend(config.STORAGE_BACKEND)
+    abstractions.start_checkpointer()
+    scheduler.LOGGER.addHandler(default_handler)
+    message.get_scheduler()
+    while os.getppid() == parent_pid:
+        time.sleep(BACKGROUND_POLL)
+
+
 if __name__ == "__main__":
-    APP.run(port=(int(sys.argv[1]) if len(sys.argv) == 2 else 8080))
+    abstractions.use_backend(config.STORAGE_BACKEND)
+    if config.SERVER_PROCESSES == 1:
+        abstractions.start_checkpointer()
+        # Deliver messages sent later, logging failures with the app's
+        scheduler.LOGGER.addHandler(default_handler)
+        message.get_scheduler()
+    else:
+        # A process forked while a thread holds a lock gets a copy of the
+        # lock that is never let go of, so the process that forks to
+        # handle requests mustn't run any threads. They get a (spawned)
+        # process of their own, which delivers the messages sent later.
+        message.DELIVERS_MESSAGES = False
+        multiprocessing.get_context("spawn").Process(
+            target=run_background, args=(os.getpid(),), daemon=True).start()
+    # Start the search workers (if there are any) before handling requests
+    other.get_search_pool()
+    APP.run(port=(int(sys.argv[1]) if len(sys.argv) == 2 else 8080),
+            threaded=config.SERVER_PROCESSES == 1, processes=config.SERVER_PROCESSES)
@@ -0,0 +1,445 @@
+'''
+    This file contains a store backed by SQLite, which can be used by
+    abstractions.py instead of the JSON data files.
+    Each collection is a table keyed by its id, with columns (and
+    indexes) for the fields that are looked up, and the full record
+    kept as JSON alongside them. Indexed list fields get a table of
+    their own, with a row for each item, and so do indexed text fields,
+    with a row for each trigram (see datastore.trigrams).
+'''
+import contextlib
+import json
+import os
+import sqlite3
+import threading
+from datastore import apply_change, trigrams
+
+# How many ids get_many() and select() look up in one query
+SELECT_BATCH = 500
+
+
+class SqliteCollection:
+    '''
+    One table in the database, with the same interface as
+    datastore.Collection.
+    '''
+
+    def __init__(self, store, name: str, records_key: str, id_key: str,
+                 indexed_fields=(), list_fields=(), text_fields=()):
+        self.store = store
+        self.name = name
+        self.records_key = records_key
+        self.id_key = id_key
+        self.latest_key = f"latest_{id_key}"
+        self.indexed_fields = tuple(indexed_fields)
+        self.list_fields = tuple(list_fields)
+        self.text_fields = tuple(text_fields)
+        # The fields that have a table with a row for each item
+        self.item_fields = self.list_fields + self.text_fields
+        self.lock = store.lock
+        self._create_table()
+
+    def _create_table(self):
+        columns = "".join(f", {field}" for field in self.indexed_fields)
+        with self.store.writing() as db:
+            db.execute(
+                f"CREATE TABLE IF NOT EXISTS {self.name} "
+                f"({self.id_key} INTEGER PRIMARY KEY{columns}, data TEXT NOT NULL)")
+            for field in self.indexed_fields:
+                db.execute(
+                    f"CREATE INDEX IF NOT EXISTS {self.name}_{field} "
+                    f"ON {self.name} ({field})")
+            for field in self.item_fields:
+                exists = db.execute(
+                    "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+                    (f"{self.name}_{field}",)).fetchone()
+                db.execute(
+                    f"CREATE TABLE IF NOT EXISTS {self.name}_{field} "
+                    f"(item, {self.id_key} INTEGER, PRIMARY KEY (item, {self.id_key}))")
+                if not exists:
+                    # Fill it in for records written before it was added
+                    for (data,) in db.execute(f"SELECT data FROM {self.name}").fetchall():
+                        self._write_items(db, self._decode(data))
+            db.execute(
+                "INSERT OR IGNORE INTO meta (collection, key, value) VALUES (?, ?, ?)",
+                (self.name, self.latest_key, "0"))
+
+    def _encode(self, record: dict):
+        return json.dumps(self.store.serializer.pack_record(record))
+
+    def _decode(self, text: str):
+        return self.store.serializer.unpack_record(json.loads(text))
+
+    def get_meta(self, key: str, default=None):
+        '''
+        Get one of the values stored alongside the records
+        '''
+        row = self.store.connection().execute(
+            "SELECT value FROM meta WHERE collection = ? AND key = ?",
+            (self.name, key)).fetchone()
+        return default if row is None else json.loads(row[0])
+
+    def set_meta(self, key: str, value):
+        '''
+        Set one of the values stored alongside the records
+        '''
+        with self.store.writing() as db:
+            db.execute(
+                "INSERT OR REPLACE INTO meta (collection, key, value) VALUES (?, ?, ?)",
+                (self.name, key, json.dumps(value)))
+
+    def add_to_meta(self, key: str, value):
+        '''
+        Append value to the list stored alongside the records under key.
+        Returns None if it was already there.
+        '''
+        return self._change_meta_list(key, value, add=True)
+
+    def remove_from_meta(self, key: str, value):
+        '''
+        Remove value from the list stored alongside the records under key.
+        Returns None if it wasn't there.
+        '''
+        return self._change_meta_list(key, value, add=False)
+
+    def _change_meta_list(self, key: str, value, add: bool):
+        with self.store.writing() as db:
+            if not db.in_transaction:
+                # Stop other connections writing between the read and the write
+                db.execute("BEGIN IMMEDIATE")
+            row = db.execute(
+                "SELECT value FROM meta WHERE collection = ? AND key = ?",
+                (self.name, key)).fetchone()
+            values = [] if row is None else json.loads(row[0])
+            if (value in values) == add:
+                return None
+            values = values + [value] if add else [item for item in values if item != value]
+            db.execute(
+                "INSERT OR REPLACE INTO meta (collection, key, value) VALUES (?, ?, ?)",
+                (self.name, key, json.dumps(values)))
+        return True
+
+    def reset(self, structure: dict):
+        '''
+        Replace everything in the table with structure
+        '''
+        with self.store.writing() as db:
+            db.execute(f"DELETE FROM {self.name}")
+            for field in self.item_fields:
+                db.execute(f"DELETE FROM {self.name}_{field}")
+            db.execute("DELETE FROM meta WHERE collection = ?", (self.name,))
+            for key, value in structure.items():
+                if key != self.records_key:
+                    db.execute(
+                        "INSERT INTO meta (collection, key, value) VALUES (?, ?, ?)",
+                        (self.name, key, json.dumps(value)))
+        for record in structure[self.records_key].values():
+            self.put(record)
+
+    def next_id(self):
+        '''
+        Reserve and return the next unused id
+        '''
+        with self.store.writing() as db:
+            db.execute(
+                "UPDATE meta SET value = value + 1 WHERE collection = ? AND key = ?",
+                (self.name, self.latest_key))
+            row = db.execute(
+                "SELECT value FROM meta WHERE collection = ? AND key = ?",
+                (self.name, self.latest_key)).fetchone()
+        return int(row[0])
+
+    def get(self, record_id: int):
+        '''
+        Return the record with the given id, or None
+        '''
+        row = self.store.connection().execute(
+            f"SELECT data FROM {self.name} WHERE {self.id_key} = ?",
+            (int(record_id),)).fetchone()
+        return None if row is None else self._decode(row[0])
+
+    def get_many(self, record_ids: list):
+        '''
+        Return the records with the given ids (None for any that don't
+        exist), in the same order, with a query for every SELECT_BATCH
+        '''
+        record_ids = [int(record_id) for record_id in record_ids]
+        records = {}
+        # A query can only have so many parameters
+        for start in range(0, len(record_ids), SELECT_BATCH):
+            batch = record_ids[start:start + SELECT_BATCH]
+            placeholders = ", ".join("?" for _ in batch)
+            rows = self.store.connection().execute(
+                f"SELECT {self.id_key}, data FROM {self.name} "
+                f"WHERE {self.id_key} IN ({placeholders})", batch)
+            records.update((record_id, self._decode(data)) for record_id, data in rows)
+        return [records.get(record_id) for record_id in record_ids]
+
+    def select(self, record_ids: list, field: str, values):
+        '''
+        Return those of record_ids (in the same order) whose record[field]
+        is one of values, asking the table rather than reading the records
+        if field is indexed
+        '''
+        values = set(values)
+        if not values:
+            return []
+        if field not in self.indexed_fields:
+            return [
+                record_id for record_id, record in zip(record_ids, self.get_many(record_ids))
+                if record is not None and record.get(field) in values
+            ]
+        wanted = set()
+        value_placeholders = ", ".join("?" for _ in values)
+        # A query can only have so many parameters
+        for start in range(0, len(record_ids), SELECT_BATCH):
+            batch = [int(record_id) for record_id in record_ids[start:start + SELECT_BATCH]]
+            placeholders = ", ".join("?" for _ in batch)
+            rows = self.store.connection().execute(
+                f"SELECT {self.id_key} FROM {self.name} "
+                f"WHERE {self.id_key} IN ({placeholders}) AND {field} IN ({value_placeholders})",
+                batch + list(values))
+            wanted.update(row[0] for row in rows)
+        return [record_id for record_id in record_ids if int(record_id) in wanted]
+
+    def put(self, record: dict):
+        '''
+        Insert or replace a record
+        '''
+        with self.store.writing() as db:
+            self._write_row(db, record)
+
+    def _write_row(self, db, record: dict):
+        fields = (self.id_key,) + self.indexed_fields + ("data",)
+        values = [int(record[self.id_key])]
+        values += [record.get(field) for field in self.indexed_fields]
+        values.append(self._encode(record))
+        placeholders = ", ".join("?" for _ in fields)
+        db.execute(
+            f"INSERT OR REPLACE INTO {self.name} ({', '.join(fields)}) "
+            f"VALUES ({placeholders})", values)
+        self._write_items(db, record)
+
+    def _write_items(self, db, record: dict):
+        '''
+        Replace the rows for the items in each of the record's list (and
+        text) fields
+        '''
+        record_id = int(record[self.id_key])
+        for field in self.item_fields:
+            if field in self.text_fields:
+                items = trigrams(record.get(field))
+            else:
+                items = record.get(field) or ()
+            db.execute(f"DELETE FROM {self.name}_{field} WHERE {self.id_key} = ?",
+                       (record_id,))
+            db.executemany(
+                f"INSERT OR IGNORE INTO {self.name}_{field} (item, {self.id_key}) "
+                f"VALUES (?, ?)",
+                [(item, record_id) for item in items])
+
+    def change(self, record_id: int, change: dict):
+        '''
+        Apply a field level change (see datastore.apply_change) to a record.
+        Returns None if there was no such record.
+        '''
+        with self.store.writing() as db:
+            if not db.in_transaction:
+                # Stop other connections writing between the read and the write
+                db.execute("BEGIN IMMEDIATE")
+            row = db.execute(
+                f"SELECT data FROM {self.name} WHERE {self.id_key} = ?",
+                (int(record_id),)).fetchone()
+            if row is None:
+                return None
+            record = self._decode(row[0])
+            apply_change(record, change)
+            self._write_row(db, record)
+        return True
+
+    def swap(self, record: dict, version: int):
+        '''
+        Replace a record, but only if the stored record is still at
+        version. Returns None if there was no such record and False if it
+        has been changed since.
+        '''
+        assignments = "".join(f", {field} = ?" for field in self.indexed_fields)
+        values = [record.get(field) for field in self.indexed_fields]
+        with self.store.writing() as db:
+            cursor = db.execute(
+                f"UPDATE {self.name} SET data = ?{assignments} "
+                f"WHERE {self.id_key} = ? "
+                f"AND COALESCE(json_extract(data, '$.version'), 0) = ?",
+                [self._encode(record)] + values + [int(record[self.id_key]), version])
+            if cursor.rowcount:
+                self._write_items(db, record)
+        if cursor.rowcount:
+            return True
+        return None if self.get(record[self.id_key]) is None else False
+
+    def delete(self, record_id: int):
+        '''
+        Remove a record.
+        Returns None if there was no such record.
+        '''
+        with self.store.writing() as db:
+            cursor = db.execute(
+                f"DELETE FROM {self.name} WHERE {self.id_key} = ?", (int(record_id),))
+            for field in self.item_fields:
+                db.execute(f"DELETE FROM {self.name}_{field} WHERE {self.id_key} = ?",
+                           (int(record_id),))
+        return True if cursor.rowcount else None
+
+    def ids(self):
+        '''
+        Return a list of all record ids, oldest first
+        '''
+        rows = self.store.connection().execute(
+            f"SELECT {self.id_key} FROM {self.name} ORDER BY {self.id_key}")
+        return [row[0] for row in rows]
+
+    def count(self):
+        '''
+        Return how many records there are
+        '''
+        return self.store.connection().execute(
+            f"SELECT COUNT(*) FROM {self.name}").fetchone()[0]
+
+    def find(self, field: str, value):
+        '''
+        Return the ids of the records where record[field] == value (or,
+        for an indexed list field, where value is in record[field])
+        '''
+        if field in self.list_fields:
+            rows = self.store.connection().execute(
+                f"SELECT {self.id_key} FROM {self.name}_{field} WHERE item = ? "
+                f"ORDER BY {self.id_key}", (value,))
+            return [row[0] for row in rows]
+        if field not in self.indexed_fields:
+            return [
+                record_id for record_id in self.ids()
+                if self.get(record_id).get(field) == value
+            ]
+        rows = self.store.connection().execute(
+            f"SELECT {self.id_key} FROM {self.name} WHERE {field} = ? "
+            f"ORDER BY {self.id_key}", (value,))
+        return [row[0] for row in rows]
+
+    def candidates(self, field: str, text: str):
+        '''
+        Return the ids of the records that could have text in
+        record[field] (ignoring case), in id order: those that have all of
+        its trigrams (or, for shorter text, a trigram it is in)
+        '''
+        text = text.lower()
+        db = self.store.connection()
+        if len(text) >= 3:
+            keys = sorted(trigrams(text))
+            placeholders = ", ".join("?" for _ in keys)
+            rows = db.execute(
+                f"SELECT {self.id_key} FROM {self.name}_{field} "
+                f"WHERE item IN ({placeholders}) GROUP BY {self.id_key} "
+                f"HAVING COUNT(*) = ? ORDER BY {self.id_key}", keys + [len(keys)])
+            return [row[0] for row in rows]
+        if text:
+            rows = db.execute(
+                f"SELECT DISTINCT {self.id_key} FROM {self.name}_{field} "
+                f"WHERE instr(item, ?) > 0 ORDER BY {self.id_key}", (text,))
+            return [row[0] for row in rows]
+        return self.ids()
+
+
+class SqliteStore:
+    '''
+    All of the collections, kept as tables in one SQLite database.
+    Each thread gets its own connection.
+    '''
+
+    def __init__(self, path: str, layouts: dict, serializer, indexes=None,
+                 list_indexes=None, text_indexes=None):
+        self.path = path
+        self.layouts = layouts
+        self.serializer = serializer
+        self.indexes = indexes or {}
+        self.list_indexes = list_indexes or {}
+        self.text_indexes = text_indexes or {}
+        self.lock = threading.RLock()
+        self._local = threading.local()
+        self._collections = {}
+        with self.connection() as db:
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS meta "
+                "(collection TEXT, key TEXT, value TEXT, PRIMARY KEY (collection, key))")
+
+    def connection(self):
+        '''
+        Return this thread's connection to the database
+        '''
+        if getattr(self._local, 'connection', None) is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=10)
+            # Let readers carry on while another process is writing
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return self._local.connection
+
+    @contextlib.contextmanager
+    def writing(self):
+        '''
+        Context manager giving this thread's connection for a write, which
+        is committed at the end unless it is part of a transaction
+        '''
+        db = self.connection()
+        if getattr(self._local, 'depth', 0):
+            yield db
+        else:
+            with db:
+                yield db
+
+    def group_commit(self):
+        '''
+        Each change is committed by SQLite as it is made
+        '''
+        return contextlib.nullcontext()
+
+    @contextlib.contextmanager
+    def transaction(self):
+        '''
+        Context manager for a set of changes that are committed together,
+        or rolled back if an exception is raised
+        '''
+        depth = getattr(self._local, 'depth', 0)
+        self._local.depth = depth + 1
+        try:
+            if depth:
+                yield
+                return
+            db = self.connection()
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                yield
+            except BaseException:
+                db.rollback()
+                raise
+            db.commit()
+        finally:
+            self._local.depth = depth
+
+    def collection(self, name: str):
+        '''
+        Get the table for a collection
+        '''
+        with self.lock:
+            if name not in self._collections:
+                records_key, id_key = self.layouts[name]
+                self._collections[name] = SqliteCollection(
+                    self, name, records_key, id_key, self.indexes.get(name, ()),
+                    self.list_indexes.get(name, ()), self.text_indexes.get(name, ()))
+            return self._collections[name]
+
+    def journaled_collections(self):
+        '''
+        SQLite keeps its own write-ahead log, so there is nothing to checkpoint
+        '''
+        return []
@@ -0,0 +1,195 @@
+'''
+Tests for the SQLite storage backend
+'''
+import datetime
+import random
+import pytest
+import abstractions
+import sqlite_store
+from error import ConflictError
+
+# pylint: disable=C0116, W0621
+
+
+@pytest.fixture
+def sqlite_backend(tmp_path, monkeypatch):
+    '''
+    Point abstractions at a fresh SQLite database for one test
+    '''
+    monkeypatch.setattr(abstractions, "get_path", lambda: str(tmp_path))
+    monkeypatch.setattr(abstractions, "STORE", None)
+    store = abstractions.use_backend("sqlite")
+    for setup in (abstractions.setup_channels_json, abstractions.setup_users_json,
+                  abstractions.setup_messages_json, abstractions.setup_standups_json,
+                  abstractions.setup_hangman_json):
+        setup()
+    yield store
+
+
+def test_users(sqlite_backend):
+    user_id = abstractions.create_user("Hayden", "Jacobs", "a@b.com", "pass123")
+    assert abstractions.get_user(user_id)['firstname'] == "Hayden"
+    assert abstractions.get_user_by_email("a@b.com")['user_id'] == user_id
+    assert abstractions.get_user_by_email("c@d.com") is None
+    user = abstractions.get_user(user_id)
+    user['email'] = "c@d.com"
+    abstractions.update_user(user_id, user)
+    assert abstractions.get_user_by_email("a@b.com") is None
+    assert abstractions.get_user_by_email("c@d.com")['user_id'] == user_id
+    assert abstractions.delete_user(user_id) is True
+    assert abstractions.get_user(user_id) is None
+    assert abstractions.delete_user(user_id) is None
+
+
+def test_stale_updates_conflict(sqlite_backend):
+    channel_id = abstractions.create_channel("Test", False, 1)
+    stale = abstractions.get_channel(channel_id)
+    channel = abstractions.get_channel(channel_id)
+    channel['channel_name'] = "Renamed"
+    abstractions.update_channel(channel_id, channel)
+    with pytest.raises(ConflictError):
+        abstractions.update_channel(channel_id, stale)
+    assert abstractions.get_channel(channel_id)['channel_name'] == "Renamed"
+
+
+def test_field_changes(sqlite_backend):
+    user_id = abstractions.create_user("Hayden", "Jacobs", "a@b.com", "pass123")
+    abstractions.patch_user(user_id, {"email": "c@d.com"})
+    assert abstractions.get_user_by_email("c@d.com")['user_id'] == user_id
+    channel_id = abstractions.create_channel("Test", False, user_id)
+    abstractions.append_to('channels', channel_id, 'message_ids', 4)
+    abstractions.increment('channels', channel_id, 'message_count')
+    channel = abstractions.get_channel(channel_id)
+    assert channel['message_ids'] == [4]
+    assert channel['message_count'] == 1
+    assert abstractions.remove_from('channels', channel_id + 1, 'message_ids', 4) is None
+
+
+def test_transaction_rolls_back(sqlite_backend):
+    channel_id = abstractions.create_channel("Test", False, 1)
+    with abstractions.transaction():
+        message_id = abstractions.create_message(1, "hello", channel_id)
+        abstractions.append_to('channels', channel_id, 'message_ids', message_id)
+    assert abstractions.get_channel(channel_id)['message_ids'] == [message_id]
+    with pytest.raises(ValueError), abstractions.transaction():
+        abstractions.create_message(1, "lost", channel_id)
+        abstractions.append_to('channels', channel_id, 'message_ids', message_id + 1)
+        raise ValueError("gave up")
+    assert abstractions.get_channel(channel_id)['message_ids'] == [message_id]
+    assert abstractions.get_all_message_ids() == [message_id]
+
+
+def test_channels_are_indexed_by_member(sqlite_backend):
+    first = abstractions.create_channel("First", False, 1)
+    second = abstractions.create_channel("Second", False, 2)
+    abstractions.append_to('channels', second, 'user_member_ids', 1)
+    assert abstractions.get_member_channel_ids(1) == [first, second]
+    channel = abstractions.get_channel(first)
+    channel['user_member_ids'] = [2]
+    abstractions.update_channel(first, channel)
+    abstractions.delete_channel(second)
+    assert abstractions.get_member_channel_ids(1) == []
+    assert abstractions.get_member_channel_ids(2) == [first]
+    assert abstractions.get_owner_channel_ids(1) == [first]
+
+
+def test_get_messages(sqlite_backend):
+    first = abstractions.create_message(1, "in one", 1)
+    second = abstractions.create_message(1, "in two", 2)
+    found = abstractions.get_messages([second, first + 100, first])
+    assert [message and message['content'] for message in found] == ["in two", None, "in one"]
+    assert abstractions.get_messages([]) == []
+
+
+def test_select_channel_message_ids(sqlite_backend):
+    first = abstractions.create_message(1, "in one", 1)
+    second = abstractions.create_message(1, "in two", 2)
+    third = abstractions.create_message(1, "in three", 3)
+    found = abstractions.select_channel_message_ids([third, first + 100, second, first], {1, 3})
+    assert found == [third, first]
+    assert abstractions.select_channel_message_ids([first], []) == []
+
+
+def test_get_many_in_batches(sqlite_backend, monkeypatch):
+    monkeypatch.setattr(sqlite_store, "SELECT_BATCH", 2)
+    message_ids = [abstractions.create_message(1, f"m{number}", 1) for number in range(5)]
+    wanted = message_ids[::-1] + [message_ids[-1] + 1]
+    records = abstractions.get_records('messages', wanted)
+    assert [record['content'] for record in records[:-1]] == [
+        "m4", "m3", "m2", "m1", "m0"]
+    assert records[-1] is None
+
+
+def search_messages(query_str):
+    '''
+    The ids of the messages that contain query_str (ignoring case), read
+    from the search candidates the way other.search does
+    '''
+    candidates = abstractions.get_search_candidates(query_str)
+    return [
+        message['message_id'] for message in abstractions.get_messages(candidates)
+        if query_str.lower() in message['content'].lower()
+    ]
+
+
+def test_messages_are_indexed_for_search(sqlite_backend):
+    first = abstractions.create_message(1, "Hello World", 1)
+    second = abstractions.create_message(1, "well, hello there", 2)
+    assert search_messages("hello") == [first, second]
+    abstractions.patch_message(first, {"content": "Goodbye"})
+    abstractions.delete_message(second)
+    third = abstractions.create_message(1, "Othello", 3)
+    assert search_messages("hello") == [third]
+    assert search_messages("bye") == [first]
+    assert search_messages("o") == [first, third]
+
+
+def test_search_matches_substrings(sqlite_backend):
+    generator = random.Random(1531)
+    contents = ["", "a", "Ab", "ABC"] + [
+        "".join(generator.choice("abAB c") for _ in range(generator.randrange(12)))
+        for _ in range(40)
+    ]
+    message_ids = [
+        abstractions.create_message(1, content, generator.randrange(1, 4))
+        for content in contents
+    ]
+    queries = {"", "x", "abcd"} | {
+        content[start:start + length]
+        for content in contents for start in range(len(content)) for length in range(1, 5)
+    }
+    for query in queries:
+        expected = [
+            message_id for message_id, content in zip(message_ids, contents)
+            if query.lower() in content.lower()
+        ]
+        assert search_messages(query.swapcase()) == expected, query
+
+
+def test_ids_are_allocated_in_order(sqlite_backend):
+    first = abstractions.create_channel("One", False, 1)
+    second = abstractions.create_channel("Two", False, 1)
+    assert second == first + 1
+    assert abstractions.get_all_channel_ids() == [first, second]
+
+
+def test_messages_keep_their_times(sqlite_backend):
+    message_id = abstractions.create_message(1, "hello", 1)
+    message = abstractions.get_message(message_id)
+    assert isinstance(message['time'], datetime.datetime)
+    assert abstractions.create_unsent_message_id(message_id) is True
+    assert abstractions.get_all_unsent_message_ids() == [message_id]
+    assert abstractions.delete_unsent_message_id(message_id) is True
+    assert abstractions.get_all_unsent_message_ids() == []
+
+
+def test_reset(sqlite_backend):
+    abstractions.create_channel("One", False, 1)
+    abstractions.setup_channels_json()
+    assert abstractions.get_all_channel_ids() == []
+    assert abstractions.create_channel("Two", False, 1) == 1
+
+
+def test_wal_mode(sqlite_backend):
+    mode = sqlite_backend.connection().execute("PRAGMA journal_mode").fetchone()[0]
+    assert mode == "wal"
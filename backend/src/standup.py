@@ -3,6 +3,8 @@ Code to handle standups
 '''
 import datetime
 import abstractions
+import events
+from message import schedule_message
 from auth import check_valid_token, get_user_from_token
 from error import InputError, AccessError
 
@@ -14,41 +16,44 @@ def standup_start(token: str, channel_id: int, length: int):
     # Check the tokens validity
     if not check_valid_token(token):
         raise AccessError(description="Invalid Token")
-    # Check if the channel is valid
-    channel = abstractions.get_channel(channel_id)
-    if channel is None:
-        raise InputError(description="This channel does not exist.")
-    # Check if there is an active standup in the channel
-    if channel['standup_in_progress']:
-        raise InputError(
-            description="An active standup is currently running in this channel")
-
-    # Create the standup
-    authed_user_id = get_user_from_token(token)
-    now = datetime.datetime.now()
-    delta = datetime.timedelta(seconds=length)
-    finish_time = now + delta
-    standup_id = abstractions.create_standup(
-        now, finish_time, authed_user_id, channel_id)
-    channel['standup_in_progress'] = True
-    channel['standup_id'] = standup_id
-
-    # Create the message that will be sent
-    message_id = abstractions.create_message(
-        authed_user_id, "", channel['channel_id'])
-    message = abstractions.get_message(message_id)
-    message['time'] = finish_time
-    abstractions.update_message(message_id, message)
-    # Update the standup so that it knows which message belongs to it
-    standup = abstractions.get_standup(standup_id)
-    standup['message_id'] = message_id
-    abstractions.update_standup(standup_id, standup)
-
-    # Queue the mesasge to be sent later
-    abstractions.create_unsent_message_id(message_id)
-
-    # Update the channel
-    abstractions.update_channel(channel_id, channel)
+    # Everything from the checks to the channel being updated happens
+    # together, so two standups can't be started at once
+    with abstractions.transaction():
+        # Check if the channel is valid
+        channel = abstractions.get_channel(channel_id)
+        if channel is None:
+            raise InputError(description="This channel does not exist.")
+        # Check if there is an active standup in the channel
+        if channel['standup_in_progress']:
+            raise InputError(
+                description="An active standup is currently running in this channel")
+
+        # Create the standup
+        authed_user_id = get_user_from_token(token)
+        now = datetime.datetime.now()
+        delta = datetime.timedelta(seconds=length)
+        finish_time = now + delta
+        standup_id = abstractions.create_standup(
+            now, finish_time, authed_user_id, channel_id)
+
+        # Create the message that will be sent
+        message_id = abstractions.create_message(
+            authed_user_id, "", channel['channel_id'])
+        abstractions.patch_message(message_id, {"time": finish_time})
+        # Update the standup so that it knows which message belongs to it
+        abstractions.patch_standup(standup_id, {"message_id": message_id})
+
+        # Queue the mesasge to be sent later
+        abstractions.create_unsent_message_id(message_id)
+
+        # Update the channel
+        abstractions.patch_channel(
+            channel_id, {"standup_in_progress": True, "standup_id": standup_id})
+
+    # Send the message (and finish the standup) at the end
+    schedule_message(message_id, finish_time)
+    events.publish(channel_id, "standup_started",
+                   {"time_finish": finish_time.replace().timestamp()})
 
     return {
         "time_finish": finish_time.replace().timestamp()
@@ -104,16 +109,38 @@ def standup_send(token: str, channel_id: int, message: str):
         raise AccessError(
             description="You do not have permission to send a message to this channel")
 
-    # Get the standup
-    standup = abstractions.get_standup(channel['standup_id'])
+    # Add the line to the standup, which only gets written to its
+    # message when the standup finishes
     user = abstractions.get_user(authed_user_id)
+    line = f"{user['handle']}:    {message}\n"
+    abstractions.append_to('standups', channel['standup_id'], 'lines', line)
+    events.publish(channel_id, "standup_line", {"line": line})
 
-    # Get the message for the standup
-    message_dict = abstractions.get_message(standup['message_id'])
+    return {}
 
-    message_dict['content'] += f"{user['handle']}:    {message}\n"
 
-    # Update the message
-    abstractions.update_message(standup['message_id'], message_dict)
+def standup_summary(token: str, channel_id: int):
+    '''
+    Get what has been sent to the active standup in a channel so far
+    '''
+    # Check the tokens validity
+    if not check_valid_token(token):
+        raise AccessError(description="Invalid Token")
+    # Check if the channel is valid
+    channel = abstractions.get_channel(channel_id)
+    if channel is None:
+        raise InputError(description="This channel does not exist.")
+    # Check if there is an active standup in the channel
+    if not channel['standup_in_progress']:
+        raise InputError(
+            description="An active standup is not currently running in this channel")
+    # Check if the user is in the channel
+    if get_user_from_token(token) not in channel['user_member_ids']:
+        raise AccessError(
+            description="You do not have permission to see this channel's standup")
 
-    return {}
+    standup = abstractions.get_standup(channel['standup_id'])
+    return {
+        "message": "".join(standup.get('lines', [])),
+        "time_finish": standup['time_finished'].replace().timestamp()
+    }
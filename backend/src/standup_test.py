@@ -295,6 +295,35 @@ def test_standup_send_failure_4():
             second_user_data['token'], channel_data['channel_id'], "test message")
 
 
+@pytest.mark.integrationtest
+def test_standup_summary_success():
+    '''
+    Expectation:
+        - what has been sent so far can be read while the standup runs,
+          and is only written to the message once it finishes
+    '''
+    # Create a test user
+    user_data = setup_test_user()
+    # Create a test channel
+    channel_data = setup_test_channel(user_data['token'])
+
+    # Start the standup and send a message to it
+    standup_data = standup.standup_start(
+        user_data['token'], channel_data['channel_id'], 1)
+    standup.standup_send(user_data['token'], channel_data['channel_id'], "first")
+    summary = standup.standup_summary(user_data['token'], channel_data['channel_id'])
+    assert summary['message'] == "hayden.smith:    first\n"
+    assert summary['time_finish'] == standup_data['time_finish']
+
+    # Once it finishes the summary is sent and can't be read any more
+    time.sleep(1.5)
+    channel_messages = channel.channel_messages(
+        user_data['token'], channel_data['channel_id'], 0)
+    assert channel_messages['messages'][0]['message'] == "hayden.smith:    first\n"
+    with pytest.raises(InputError):
+        standup.standup_summary(user_data['token'], channel_data['channel_id'])
+
+
 @pytest.mark.systemtest
 def test_standup_start_http():
     # Create a user
@@ -0,0 +1,74 @@
+'''
+    This file contains the on-disk form of a text index (trigram -> ids),
+    saved next to each shard of a sharded collection so that the index
+    can be loaded at startup instead of being built from every record.
+    The file is read through mmap: a header, then each trigram with the
+    ids that have it, as big-endian unsigned ints.
+'''
+import mmap
+import os
+import struct
+import serializers
+
+# What the files end with
+EXTENSION = ".trigrams"
+MAGIC = b"STI1"
+HEADER = struct.Struct('>4sQI')
+KEY_HEADER = struct.Struct('>HI')
+
+
+def encode(version: int, postings: dict):
+    '''
+    Return the file contents for the trigram -> ids mapping postings, as
+    of version of the shard it was made from
+    '''
+    parts = [HEADER.pack(MAGIC, version, len(postings))]
+    for key in sorted(postings):
+        encoded = key.encode()
+        ids = sorted(postings[key])
+        parts.append(KEY_HEADER.pack(len(encoded), len(ids)))
+        parts.append(encoded)
+        parts.append(struct.pack(f'>{len(ids)}I', *ids))
+    return b"".join(parts)
+
+
+def write(path: str, version: int, postings: dict):
+    '''
+    Save postings to path (see encode)
+    '''
+    serializers.write_atomically(path, encode(version, postings))
+
+
+def read(path: str, version: int):
+    '''
+    Return the trigram -> ids mapping saved in path, or None if there
+    isn't one or it isn't for version of the shard
+    '''
+    try:
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size < HEADER.size:
+                return None
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                return decode(data, version)
+    except FileNotFoundError:
+        return None
+
+
+def decode(data, version: int):
+    '''
+    Return the trigram -> ids mapping in data (see encode), or None if it
+    isn't for version
+    '''
+    magic, saved_version, key_count = HEADER.unpack_from(data, 0)
+    if magic != MAGIC or saved_version != version:
+        return None
+    postings = {}
+    offset = HEADER.size
+    for _ in range(key_count):
+        key_length, id_count = KEY_HEADER.unpack_from(data, offset)
+        offset += KEY_HEADER.size
+        key = bytes(data[offset:offset + key_length]).decode()
+        offset += key_length
+        postings[key] = set(struct.unpack_from(f'>{id_count}I', data, offset))
+        offset += 4 * id_count
+    return postings
@@ -0,0 +1,25 @@
+'''
+Tests for the saved text indexes in text_index.py
+'''
+import text_index
+
+# pylint: disable=C0116
+
+
+def test_encode_and_decode():
+    postings = {"hel": {1, 7, 300000}, "ell": {7}, "é!": {2}}
+    data = text_index.encode(4, postings)
+    assert text_index.decode(data, 4) == postings
+    assert text_index.decode(text_index.encode(4, {}), 4) == {}
+
+
+def test_read(tmp_path):
+    path = str(tmp_path / ("1.content" + text_index.EXTENSION))
+    assert text_index.read(path, 1) is None
+    text_index.write(path, 2, {"abc": {1, 2}})
+    assert text_index.read(path, 2) == {"abc": {1, 2}}
+    # It is only used for the version of the shard it was made from
+    assert text_index.read(path, 1) is None
+    with open(path, 'wb') as f:
+        f.write(b"ST")
+    assert text_index.read(path, 2) is None
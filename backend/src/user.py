@@ -66,12 +66,8 @@ def user_profile_setname(token: str, name_first: str, name_last: str):
 
     # get the user id
     u_id = get_user_from_token(token)
-    # get the user_dict that contains all user detail
-    user_dict = abstractions.get_user(int(u_id))
-    # update the user dict with new details
-    user_dict['firstname'] = name_first
-    user_dict['lastname'] = name_last
-    abstractions.update_user(int(u_id), user_dict)
+    # update the user with new details
+    abstractions.patch_user(int(u_id), {"firstname": name_first, "lastname": name_last})
 
     return {}
 
@@ -94,18 +90,14 @@ def user_profile_setemail(token: str, email: str):
         raise InputError(description="Invalid Email Address")
 
     # check if the email is already by another user
-    u_ids = abstractions.get_all_user_ids()
     u_id = get_user_from_token(token)
-    for item in u_ids:
-        user_dict = abstractions.get_user(int(item))
-        # check if the email is used by a registered user
-        if user_dict['email'] == email and user_dict['user_id'] != u_id:
-            raise InputError(description="Email Address Already Used")
+    user_dict = abstractions.get_user_by_email(email)
+    # check if the email is used by a registered user
+    if user_dict is not None and user_dict['user_id'] != u_id:
+        raise InputError(description="Email Address Already Used")
 
     # update the user with the new email
-    user_dict = abstractions.get_user(int(u_id))
-    user_dict['email'] = email
-    abstractions.update_user(int(u_id), user_dict)
+    abstractions.patch_user(int(u_id), {"email": email})
 
     return {}
 
@@ -127,18 +119,12 @@ def user_profile_sethandle(token: str, handle_str: str):
     # check if the handle is already used
     # get the user id
     u_id = get_user_from_token(token)
-    user_ids = abstractions.get_all_user_ids()
-    for user_id in user_ids:
-        user_dict = abstractions.get_user(user_id)
-        if user_dict['handle'] == handle_str and user_dict['user_id'] != u_id:
-
-            raise InputError(description="Handle Already Used")
+    user_dict = abstractions.get_user_by_handle(handle_str)
+    if user_dict is not None and user_dict['user_id'] != u_id:
+        raise InputError(description="Handle Already Used")
 
-    # get the user details
-    user_dict = abstractions.get_user(u_id)
     # update the handle
-    user_dict['handle'] = handle_str
-    abstractions.update_user(u_id, user_dict)
+    abstractions.patch_user(u_id, {"handle": handle_str})
 
     return {}
 
@@ -207,11 +193,8 @@ def user_profile_uploadphoto(token: str, img_url: str, x_start: int, y_start: in
     cropped_file_to_save = images_folder / f"cropped{str(u_id)}.jpg"
     cropped.save(cropped_file_to_save)
 
-    # update the user_dict with img_url
-    user_dict = abstractions.get_user(u_id)
-    user_data = user_dict
-    user_data['profile_pic_url'] = f"cropped{str(u_id)}.jpg"
-    abstractions.update_user(u_id, user_data)
+    # update the user with img_url
+    abstractions.patch_user(u_id, {"profile_pic_url": f"cropped{str(u_id)}.jpg"})
 
     # upload the photo to the server
     return {}